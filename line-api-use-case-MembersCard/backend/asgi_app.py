@@ -0,0 +1,476 @@
+"""
+会員証バックエンドの非同期(ASGI)版
+
+main.appと同じinit/buyのリクエスト・レスポンスを、非同期のFirestoreクライアントと
+HTTPクライアント(httpx)で処理する。1つのイベントループで多数のリクエストを
+同時に処理でき、スレッド数で同時処理数が制限されない。
+それ以外のリクエスト(lookup、/pos/transactions、/reports/daily、/diagnostics/*)は
+main.appをスレッドで実行して処理する(/metricsは両方の集計を返却する)。
+LIFFのチャネルID・チャネルアクセストークンはmain.pyの設定を使用する。
+会員データを更新した場合は、main.appと共有する会員データのキャッシュも更新する。
+
+IDトークンの検証と並行して、トークンのsubから会員データを先読みする。
+先読みした結果は検証に成功しsubが一致した場合のみ使用し、それ以外の場合は破棄する。
+
+起動方法(backendディレクトリで実行):
+    uvicorn asgi_app:app --host 0.0.0.0 --port $PORT
+"""
+import os
+import re
+import json
+import uuid
+import asyncio
+import logging
+import httpx
+import send_message
+from members_card_user_info import (
+    AsyncMembersCardUserInfo, create_async_firestore_client,
+    point_expiration_date, is_already_exists, VERSION_FIELD)
+from member_profile_cache import CachedMembersCardUserInfo
+from token_verifier import IdTokenVerifier, TokenExpiredError
+from product_catalog import create_catalog
+from cart import Cart, DEMO_CART_LINES
+from point_ledger import ledger_entry, ONLINE_STORE_ID
+from idempotency import AsyncIdempotencyStore, IdempotencyConflict, is_valid_key
+from receipt_outbox import (
+    OUTBOX_MAX_ATTEMPTS, OUTBOX_BACKOFF_SECONDS, MAX_BACKOFF_SECONDS)
+from common import utils, http_client, tracing
+from common.single_flight import AsyncSingleFlight
+
+# リクエストボディの最大サイズ(バイト)
+MAX_BODY_BYTES = 64 * 1024
+# 終了時に送信中のレシートを待つ時間(秒)
+SHUTDOWN_TIMEOUT = 10
+# main.appで処理するリクエストの同時実行数
+WSGI_THREADS = int(os.getenv('ASGI_WSGI_THREADS', '8'))
+# 非同期で処理するmode(それ以外はmain.appで処理する)
+NATIVE_MODES = ('init', 'buy')
+# LINEのユーザーIDの形式(先読みはこの形式のsubの場合のみ行う)
+USER_ID_PATTERN = re.compile(r'U[0-9a-f]{32}')
+
+logger = logging.getLogger(__name__)
+
+
+def unverified_subject(id_token):
+    """
+    署名を検証せずにIDトークンのsubを取得する(先読み専用)
+
+    Parameters
+    ----------
+    id_token : str
+        LIFFで取得したIDトークン
+
+    Returns
+    -------
+    sub : str
+        ユーザーID。JWTとして読み取れない、またはユーザーIDの形式でない場合はNone
+    """
+    import jwt
+    try:
+        sub = jwt.decode(id_token, options={'verify_signature': False}
+                         ).get('sub')
+    except Exception:
+        return None
+    if not isinstance(sub, str) or not USER_ID_PATTERN.fullmatch(sub):
+        return None
+    return sub
+
+
+class MembersCardApp:
+    """会員証バックエンドのASGIアプリケーションクラス"""
+
+    def __init__(self):
+        """初期化メソッド。外部への接続はlifespanの開始時に行う。"""
+        self.client = None
+        self.table = None
+        self.barcode_allocator = None
+        self.profile_cache = None
+        self.product_catalog = None
+        self.wsgi_app = None
+        # チャネルの設定はmain.pyの値を使用する(lifespanの開始時に設定する)
+        self.id_token_verifier = None
+        self.channel_access_token = None
+        self.idempotency_store = AsyncIdempotencyStore()
+        # 同じユーザーの同時のinitを1回の処理にまとめる
+        self.init_flight = AsyncSingleFlight()
+        self._receipt_tasks = set()
+
+    async def startup(self):
+        """HTTPクライアントとFirestoreクライアントを作成する"""
+        # init/buy以外はFlask版(main.app)をスレッドで実行して処理する
+        import main
+        from uvicorn.middleware.wsgi import WSGIMiddleware
+        self.wsgi_app = WSGIMiddleware(main.app, workers=WSGI_THREADS)
+        self.id_token_verifier = IdTokenVerifier(main.LIFF_CHANNEL_ID)
+        self.channel_access_token = main.CHANNEL_ACCESS_TOKEN
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(http_client.HTTP_READ_TIMEOUT,
+                                  connect=http_client.HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=None,
+                                max_keepalive_connections=100))
+        self.table = AsyncMembersCardUserInfo(create_async_firestore_client())
+        # main.appの読み取りが古い会員データを返さないよう、同じキャッシュを更新する
+        table = main.user_info_table_controller.resolve()
+        if isinstance(table, CachedMembersCardUserInfo):
+            self.profile_cache = table
+        # バーコードのブロック確保はまれなため、main.appの採番クラスをスレッドで使用する
+        self.barcode_allocator = main.barcode_allocator
+        self.product_catalog = create_catalog()
+
+    async def shutdown(self):
+        """送信中のレシートを待ち、HTTPクライアントを閉じる"""
+        if self._receipt_tasks:
+            await asyncio.wait(self._receipt_tasks, timeout=SHUTDOWN_TIMEOUT)
+        await self.client.aclose()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        if scope['method'] == 'POST' and scope['path'] == '/':
+            body = await self._read_body(receive)
+            req_param = self._parse(body) if body is not None else None
+            if body is not None and (req_param is None or req_param.get(
+                    'mode') not in NATIVE_MODES):
+                # トレースはmain.app側で開始・終了する
+                await self._forward(scope, body, send)
+                return
+            tracing.start_request(
+                self._header(scope, b'x-cloud-trace-context'))
+            if body is None:
+                response = utils.create_error_response('Payload Too Large', 413)
+            else:
+                response = await self.handler(
+                    req_param, self._header(scope, b'if-none-match'))
+            await self._send(send, response.status,
+                             response.headers.get('Content-Type'),
+                             response.body, response.headers.get('ETag'))
+            tracing.finish_request('/', response.status)
+        elif scope['method'] == 'GET' and scope['path'] == '/metrics':
+            tracing.start_request(
+                self._header(scope, b'x-cloud-trace-context'))
+            await self._send(send, 200, tracing.METRICS_CONTENT_TYPE,
+                             tracing.render_metrics().encode('utf-8'))
+            tracing.finish_request('/metrics', 200)
+        else:
+            await self.wsgi_app(scope, receive, send)
+
+    @staticmethod
+    def _parse(body):
+        """リクエストボディを読み取る。JSONのオブジェクトでない場合はNone"""
+        try:
+            req_param = json.loads(body)
+        except ValueError:
+            return None
+        return req_param if isinstance(req_param, dict) else None
+
+    async def _forward(self, scope, body, send):
+        """読み込み済みのリクエストボディをmain.appに渡して処理する"""
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if sent:
+                return {'type': 'http.disconnect'}
+            sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        await self.wsgi_app(scope, receive, send)
+
+    @staticmethod
+    def _header(scope, name):
+        """リクエストヘッダーの値を取得する"""
+        for key, value in scope.get('headers', ()):
+            if key == name:
+                return value.decode('latin-1')
+        return None
+
+    async def _lifespan(self, receive, send):
+        """起動・終了イベントを処理する"""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def _read_body(receive):
+        """リクエストボディを読み込む。上限を超えた場合はNoneを返す。"""
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > MAX_BODY_BYTES:
+                return None
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    @classmethod
+    async def _send_json(cls, send, status, payload):
+        """JSONのレスポンスを送信する"""
+        await cls._send(send, status, 'application/json',
+                        utils.encode_json(payload))
+
+    @staticmethod
+    async def _send(send, status, content_type, body, etag=None):
+        """レスポンスを送信する"""
+        headers = [(b'content-length', str(len(body)).encode())]
+        if content_type is not None:
+            headers.append((b'content-type', content_type.encode('latin-1')))
+        if etag is not None:
+            headers.append((b'etag', etag.encode('latin-1')))
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': headers,
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def handler(self, req_param, if_none_match=None):
+        """
+        main.handlerと同じ形式でinit/buyのリクエストを処理する
+
+        Parameters
+        ----------
+        req_param : dict
+            リクエストボディ
+        if_none_match : str, optional
+            If-None-Matchヘッダーの値
+
+        Returns
+        -------
+        JsonResponse
+            フロントに返却するデータ
+        """
+        envelope = utils.use_envelope(req_param)
+        mode = req_param.get('mode')
+
+        # クライアントが保持する会員データのバージョン
+        client_versions = []
+        if mode == 'init':
+            client_versions = utils.parse_etags(if_none_match)
+            version = req_param.get(VERSION_FIELD)
+            if isinstance(version, str) and version:
+                client_versions.append(version)
+
+        # IDトークンの検証と並行して会員データ(またはバージョン)を先読みする
+        subject = unverified_subject(req_param.get('idToken')) \
+            if mode == 'init' else None
+        prefetch = None
+        if subject is not None:
+            prefetch = asyncio.ensure_future(
+                self.table.get_version(subject) if client_versions
+                else self.table.get_item(subject))
+        tracing.annotate('mode', mode if mode in NATIVE_MODES else 'other')
+        user_id = None
+        try:
+            with tracing.span('verifyToken'):
+                user_profile = await self.id_token_verifier.averify(
+                    req_param['idToken'], self.client)
+            user_id = user_profile['sub']
+        except TokenExpiredError:
+            return utils.create_error_response('Forbidden', 403, envelope)
+        except Exception:
+            logger.exception('不正なIDトークンが使用されています')
+            return utils.create_error_response('Error', envelope=envelope)
+        finally:
+            # 検証に失敗した場合、または検証済みのsubと一致しない場合は先読みを使用しない
+            if prefetch is not None and subject != user_id:
+                self._discard(prefetch)
+                prefetch = None
+
+        try:
+            if mode == 'init':
+                if client_versions:
+                    with tracing.span('getVersion'):
+                        version = await prefetch if prefetch is not None \
+                            else await self.table.get_version(user_id)
+                    prefetch = None
+                    if version is not None and version in client_versions:
+                        tracing.annotate('notModified', True)
+                        return utils.create_not_modified_response(
+                            version, envelope)
+                # 実行中の処理の結果を共有した場合、先読みは使用されない
+                result = await self.init_flight.do(
+                    user_id, lambda: self.init(user_id, prefetch))
+            elif mode == 'buy':
+                idempotency_key = req_param.get('idempotencyKey')
+                if idempotency_key is None:
+                    result = await self.buy(user_id, req_param['language'],
+                                            req_param['liffId'])
+                elif not is_valid_key(idempotency_key):
+                    return utils.create_error_response(
+                        'Bad Request', 400, envelope)
+                else:
+                    result = await self.idempotency_store.run(
+                        'buy:%s:%s' % (user_id, idempotency_key),
+                        lambda: self.buy(user_id, req_param['language'],
+                                         req_param['liffId']))
+            else:
+                return utils.create_error_response('ERROR', envelope=envelope)
+        except IdempotencyConflict:
+            return utils.create_error_response('Conflict', 409, envelope)
+        except Exception as e:
+            logger.error(e)
+            return utils.create_error_response('ERROR', envelope=envelope)
+        finally:
+            self._discard(prefetch)
+
+        return utils.with_etag(
+            utils.create_success_response(result, envelope),
+            result.get(VERSION_FIELD))
+
+    @staticmethod
+    def _discard(task):
+        """不要になった先読みを取り消す。完了済みの場合は結果を読み捨てる。"""
+        if task is None:
+            return
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled():
+            # 取得されない例外として警告が出力されないようにする
+            task.exception()
+
+    async def init(self, user_id, prefetch=None):
+        """
+        会員証を表示時、新規ユーザーの場合会員データを作成する。
+        既存ユーザーの場合、DBから会員データを取得する。
+
+        Parameters
+        ----------
+        user_id : str
+            LINEのユーザーID
+        prefetch : Future, optional
+            先読み中の会員データ
+
+        Returns
+        -------
+        dict
+            ユーザー情報
+        """
+        with tracing.span('getItem'):
+            user_info = await prefetch if prefetch is not None \
+                else await self.table.get_item(user_id)
+        if user_info:
+            return user_info
+
+        with tracing.span('allocateBarcode'):
+            barcode_num = await asyncio.to_thread(
+                self.barcode_allocator.allocate)
+        expiration_date = ''
+        point = 0
+        try:
+            with tracing.span('putItem'):
+                try:
+                    response = await self.table.put_item(
+                        user_id, barcode_num, expiration_date, point)
+                finally:
+                    await self._update_cache(user_id)
+        except Exception as e:
+            # 他のインスタンスが同時に作成した場合はそのデータを返却する
+            if not is_already_exists(e):
+                raise
+            with tracing.span('getItem'):
+                user_info = await self.table.get_item(user_id)
+            if user_info is None:
+                raise
+            return user_info
+        return {
+            'userId': user_id,
+            'barcodeNum': barcode_num,
+            'pointExpirationDate': expiration_date,
+            'point': point,
+            VERSION_FIELD: response.get(VERSION_FIELD),
+        }
+
+    async def buy(self, user_id, language, liffId):
+        """
+        商品を購入し、ポイント付与のDB更新と電子レシートの送信を行う。
+        レシートは送信完了を待たずに返却する。
+
+        Parameters
+        ----------
+        user_id : str
+            LINEのユーザーID
+        language : str
+            多言語化対応
+        liffId : str
+            LIFFのID
+
+        Returns
+        -------
+        dict
+            更新後のユーザー情報
+        """
+        cart = Cart(DEMO_CART_LINES, fee=300, postage=0)
+        with tracing.span('priceCart'):
+            summary = cart.price(self.product_catalog)
+        ledger = ledger_entry(user_id, summary['point'], summary['total'],
+                              ONLINE_STORE_ID, 'buy')
+        with tracing.span('addPoint'):
+            try:
+                user_info = await self.table.add_point(
+                    user_id, summary['point'], point_expiration_date(), ledger)
+            except Exception:
+                await self._update_cache(user_id)
+                raise
+            await self._update_cache(user_id, user_info)
+
+        with tracing.span('makeReceipt'):
+            receipt = send_message.make_receipt_message(
+                summary, language, liffId)
+        task = asyncio.ensure_future(self._send_receipt(user_id, receipt))
+        self._receipt_tasks.add(task)
+        task.add_done_callback(self._receipt_tasks.discard)
+        return user_info
+
+    async def _update_cache(self, user_id, item=None):
+        """
+        main.appと共有する会員データのキャッシュを更新する
+
+        Parameters
+        ----------
+        user_id : str
+            ユーザーID
+        item : dict, optional
+            更新後の会員ユーザー情報。指定が無い場合はキャッシュを削除する
+        """
+        if self.profile_cache is None:
+            return
+        # Redisのキャッシュはブロッキングのため、スレッドで実行する
+        if item is None:
+            await asyncio.to_thread(self.profile_cache.invalidate, user_id)
+        else:
+            await asyncio.to_thread(self.profile_cache.refresh, user_id, item)
+
+    async def _send_receipt(self, user_id, message):
+        """レシートを送信する。一時的なエラーの場合は同じリトライキーで再送する。"""
+        retry_key = str(uuid.uuid4())
+        delay = OUTBOX_BACKOFF_SECONDS
+        for attempt in range(1, OUTBOX_MAX_ATTEMPTS + 1):
+            try:
+                with tracing.span('pushMessage'):
+                    await send_message.apush_message_json(
+                        self.client, self.channel_access_token, user_id,
+                        message, retry_key)
+                return
+            except Exception as e:
+                if attempt == OUTBOX_MAX_ATTEMPTS or \
+                        not send_message.is_retryable_error(e):
+                    logger.exception('レシートの送信に失敗しました: %s',
+                                     retry_key)
+                    return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_BACKOFF_SECONDS)
+
+
+app = MembersCardApp()
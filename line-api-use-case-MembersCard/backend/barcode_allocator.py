@@ -0,0 +1,145 @@
+"""
+会員バーコードの採番モジュール
+
+EAN-13のインストアコード(先頭2)の連番をブロック単位でインスタンスに割り当て、
+重複しないバーコード番号を発行する。ブロックの確保はBarcodeBlocks/{ブロック番号}の
+ドキュメント作成(既に存在する場合は失敗する)で行うため、複数インスタンスでも重複しない。
+"""
+import os
+import logging
+import threading
+
+# 環境変数の宣言
+BARCODE_BLOCK_SIZE = int(os.getenv('BARCODE_BLOCK_SIZE', '100'))
+
+# インストアコードの先頭桁
+BARCODE_PREFIX = '2'
+# 連番部分の桁数(先頭桁とチェックデジットを除く)
+SEQUENCE_DIGITS = 11
+MAX_SEQUENCE = 10 ** SEQUENCE_DIGITS
+
+BLOCK_COLLECTION = 'BarcodeBlocks'
+SEQUENCE_DOCUMENT = ('BarcodeSequence', 'counter')
+
+logger = logging.getLogger(__name__)
+
+
+def ean13_check_digit(digits):
+    """
+    EAN-13のチェックデジットを計算する
+
+    Parameters
+    ----------
+    digits : str
+        チェックデジットを除く12桁の数字
+
+    Returns
+    -------
+    check_digit : int
+        チェックデジット
+    """
+    total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits))
+    return (10 - total % 10) % 10
+
+
+def is_valid_ean13(code):
+    """
+    EAN-13として妥当なバーコード番号か判定する
+
+    Parameters
+    ----------
+    code : str, int
+        バーコード番号
+
+    Returns
+    -------
+    result : bool
+        13桁の数字でチェックデジットが正しい場合True
+    """
+    code = str(code)
+    return len(code) == 13 and code.isdigit() and \
+        ean13_check_digit(code[:12]) == int(code[12])
+
+
+def to_barcode(sequence):
+    """
+    連番からバーコード番号を作成する
+
+    Parameters
+    ----------
+    sequence : int
+        連番
+
+    Returns
+    -------
+    barcode_num : int
+        13桁のバーコード番号
+    """
+    digits = BARCODE_PREFIX + str(sequence).zfill(SEQUENCE_DIGITS)
+    return int(digits + str(ean13_check_digit(digits)))
+
+
+class BarcodeAllocator:
+    """ブロック単位で連番を確保するバーコード採番クラス"""
+    __slots__ = ['_db', '_block_size', '_lock', '_next', '_end']
+
+    def __init__(self, db, block_size=BARCODE_BLOCK_SIZE):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        db : google.cloud.firestore.Client
+            Firestoreクライアント
+        block_size : int
+            1回に確保する連番の件数
+        """
+        self._db = db
+        self._block_size = block_size
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0
+
+    def allocate(self):
+        """
+        バーコード番号を発行する
+
+        Returns
+        -------
+        barcode_num : int
+            13桁のバーコード番号
+        """
+        with self._lock:
+            if self._next >= self._end:
+                self._reserve_block()
+            sequence = self._next
+            self._next += 1
+        return to_barcode(sequence)
+
+    def _reserve_block(self):
+        """未使用のブロックを確保する(ロック取得済みで呼び出す)"""
+        counter_ref = self._db.collection(SEQUENCE_DOCUMENT[0]).document(
+            SEQUENCE_DOCUMENT[1])
+        counter = counter_ref.get()
+        block = counter.to_dict().get('lastBlock', -1) + 1 \
+            if counter.exists else 0
+        while True:
+            if (block + 1) * self._block_size > MAX_SEQUENCE:
+                raise RuntimeError('バーコード番号を使い切りました')
+            try:
+                self._db.collection(BLOCK_COLLECTION).document(
+                    str(block)).create({'blockSize': self._block_size})
+                break
+            except Exception as e:
+                if type(e).__name__ not in ('AlreadyExists', 'Conflict'):
+                    raise
+                # 他のインスタンスが確保済み
+                block += 1
+        # 次回の確保位置の目安を記録する(失敗しても一意性には影響しない)
+        try:
+            counter_ref.set({'lastBlock': block}, merge=True)
+        except Exception:
+            logger.warning('採番位置の記録に失敗しました', exc_info=True)
+        self._next = block * self._block_size
+        self._end = self._next + self._block_size
+        logger.info('バーコードのブロックを確保しました: %s', block)
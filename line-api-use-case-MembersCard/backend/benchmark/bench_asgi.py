@@ -0,0 +1,136 @@
+"""
+同期(gunicorn + Flask)版と非同期(uvicorn + ASGI)版の比較ベンチマーク
+
+LINE APIのスタンドインサーバーとインメモリのFirestore(1回の読み書きごとに遅延を入れる)
+を使用して両方のサーバーを起動し、同時接続数を指定してinit/buyのリクエストを送り続けた
+場合の1秒あたりの処理件数と応答時間を比較する。
+
+使い方(backendディレクトリで実行):
+    python -m benchmark.bench_asgi [秒数] [同時接続数] [mode] [外部APIの遅延(ミリ秒)]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import subprocess
+import httpx
+from benchmark.fake_line_server import start_server, base_url, make_test_token
+
+USERS = 1000
+
+
+def free_port():
+    """空いているポートを取得する"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_env(line_url, latency_ms):
+    """両方のサーバーに共通の環境変数を作成する"""
+    env = dict(os.environ)
+    env.update({
+        'FIRESTORE_BACKEND': 'fake',
+        'FAKE_FIRESTORE_LATENCY_MS': str(latency_ms),
+        'PROFILE_CACHE_BACKEND': 'none',
+        'TOKEN_VERIFY_MODE': 'remote',
+        'TOKEN_CACHE_SIZE': '0',
+        'LINE_VERIFY_URL': line_url + '/oauth2/v2.1/verify',
+        'LINE_JWKS_URL': line_url + '/oauth2/v2.1/certs',
+        'LINE_PUSH_URL': line_url + '/v2/bot/message/push',
+    })
+    return env
+
+
+def start(command, env, port, stdout=subprocess.DEVNULL):
+    """サーバーを起動し、接続できるまで待つ"""
+    process = subprocess.Popen(command, env=env, stdout=stdout,
+                               stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('サーバーが起動しません: %s' % command)
+
+
+def percentile(values, p):
+    """パーセンタイル値を求める"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def load(url, seconds, concurrency, mode, tokens):
+    """同時接続数分のクライアントからリクエストを送り続ける"""
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + seconds
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        async def worker(index):
+            nonlocal errors
+            i = index
+            while time.monotonic() < deadline:
+                body = {'mode': mode, 'idToken': tokens[i % len(tokens)],
+                        'language': 'ja', 'liffId': 'benchmark'}
+                start = time.perf_counter()
+                response = await client.post(url, content=json.dumps(body))
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200 or \
+                        response.json().get('statusCode', 200) != 200:
+                    errors += 1
+                i += concurrency
+
+        start = time.monotonic()
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+        elapsed = time.monotonic() - start
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'requestsPerSec': round(len(latencies) / elapsed, 1),
+        'p50Ms': round(percentile(latencies, 50) * 1000, 1),
+        'p99Ms': round(percentile(latencies, 99) * 1000, 1),
+    }
+
+
+def main(seconds, concurrency, mode, latency_ms):
+    line_server = start_server(latency=latency_ms / 1000)
+    env = server_env(base_url(line_server), latency_ms)
+    tokens = [make_test_token('U%032d' % i) for i in range(USERS)]
+
+    servers = {
+        'gunicorn (1 worker, 8 threads)': lambda port: [
+            sys.executable, '-m', 'gunicorn', '--bind', '127.0.0.1:%s' % port,
+            '--workers', '1', '--threads', '8', '--timeout', '0', 'main:app'],
+        'uvicorn (asgi_app)': lambda port: [
+            sys.executable, '-m', 'uvicorn', '--host', '127.0.0.1',
+            '--port', str(port), '--no-access-log', 'asgi_app:app'],
+    }
+    for name, command in servers.items():
+        port = free_port()
+        process = start(command(port), env, port)
+        try:
+            url = 'http://127.0.0.1:%s/' % port
+            # 会員データを作成してから計測する
+            asyncio.run(load(url, 1, concurrency, 'init', tokens))
+            report = asyncio.run(load(url, seconds, concurrency, mode, tokens))
+        finally:
+            process.terminate()
+            process.wait()
+        print('%-32s %s' % (name, report))
+    line_server.shutdown()
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 10,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 64,
+         sys.argv[3] if len(sys.argv) > 3 else 'init',
+         float(sys.argv[4]) if len(sys.argv) > 4 else 20)
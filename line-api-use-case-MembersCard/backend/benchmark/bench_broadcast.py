@@ -0,0 +1,60 @@
+"""
+一斉送信のベンチマーク
+
+LINE APIのスタンドインサーバーに対して、マルチキャストによる一斉送信と
+1件ずつのプッシュ送信の1秒あたりの送信件数を比較する。
+
+使い方(backendディレクトリで実行):
+    python -m benchmark.bench_broadcast [宛先数] [応答遅延(ミリ秒)]
+"""
+import sys
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from benchmark.fake_line_server import start_server, base_url
+import send_message
+from broadcast import Broadcaster
+
+TOKEN = 'dummy-channel-access-token'
+# 内容の異なるメッセージの種類数(期限日ごとのお知らせ等)
+DISTINCT_MESSAGES = 3
+# プッシュ送信で比較する宛先数の上限
+MAX_PUSH_RECIPIENTS = 1000
+
+
+def make_notices(count):
+    """期限日の異なるポイント失効のお知らせを作成する"""
+    messages = [json.dumps({'type': 'text',
+                            'text': 'ポイントの有効期限は2021/04/%02dです。' % (i + 1)},
+                           ensure_ascii=False)
+                for i in range(DISTINCT_MESSAGES)]
+    return [('U%032d' % i, messages[i % DISTINCT_MESSAGES])
+            for i in range(count)]
+
+
+def main(count, latency_ms):
+    server = start_server(latency=latency_ms / 1000)
+    url = base_url(server)
+    notices = make_notices(count)
+
+    broadcaster = Broadcaster(TOKEN, url=url + '/v2/bot/message/multicast')
+    report = broadcaster.send(notices)
+    print('multicast: %s' % report)
+
+    push_notices = notices[:MAX_PUSH_RECIPIENTS]
+    send_message.PUSH_URL = url + '/v2/bot/message/push'
+    start = time.monotonic()
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(
+            lambda notice: send_message.push_message_json(TOKEN, *notice),
+            push_notices))
+    elapsed = time.monotonic() - start
+    print('push:      %s messages, %.1f messages/sec' %
+          (len(push_notices), len(push_notices) / elapsed))
+    print('server:    %s' % server.state.counts)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+         float(sys.argv[2]) if len(sys.argv) > 2 else 20)
@@ -0,0 +1,365 @@
+"""
+init/buyのエンドツーエンドの負荷試験
+
+LINE APIのスタンドインサーバー(IDトークン検証・プッシュ送信、応答遅延とエラー率を指定)と
+インメモリのFirestore(またはFirestoreエミュレータ)を使用してアプリケーションを起動し、
+同時接続数を変えてinit/buyのリクエストを送り続ける。
+1秒あたりの処理件数と応答時間のp50/p95/p99に加え、サーバーのトレースの詳細ログから
+処理(verifyToken, getItem, addPoint等)ごとの所要時間のp50/p95/p99を集計する。
+
+--save-baselineを指定すると結果をbenchmark/baselines/<名前>.jsonに保存し、後の変更の結果と
+比較できる。計測結果は実行環境(CPU・同時接続数等)に依存するため、ベースラインはリポジトリに含めず、
+比較する環境で変更前に作成する。
+比較では処理件数の低下、応答時間の増加が閾値を超えた項目を回帰として表示し、終了コード1を返す。
+
+使い方(backendディレクトリで実行):
+    python -m benchmark.bench_e2e --modes init,buy --concurrency 1,8,32 --save-baseline main
+    python -m benchmark.bench_e2e --modes init,buy --concurrency 1,8,32 --compare main
+
+Firestoreエミュレータを使用する場合はFIRESTORE_EMULATOR_HOSTを設定し、--firestore emulatorを指定する。
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import httpx
+from benchmark.fake_line_server import start_server, base_url, make_test_token
+from benchmark.bench_asgi import free_port, server_env, start, percentile
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'baselines')
+USERS = 1000
+PERCENTILES = (50, 95, 99)
+# 比較で回帰とみなす悪化の割合
+DEFAULT_MAX_REGRESSION = 0.1
+# 比較する処理ごとの所要時間のパーセンタイル
+COMPARED_STAGE_PERCENTILE = 'p95Ms'
+
+SERVERS = {
+    'gunicorn': lambda port: [
+        sys.executable, '-m', 'gunicorn', '--bind', '127.0.0.1:%s' % port,
+        '--workers', '1', '--threads', '8', '--timeout', '0', 'main:app'],
+    'asgi': lambda port: [
+        sys.executable, '-m', 'uvicorn', '--host', '127.0.0.1',
+        '--port', str(port), '--no-access-log', 'asgi_app:app'],
+}
+
+
+def summarize(values):
+    """
+    所要時間(秒)のリストのパーセンタイル値(ミリ秒)を求める
+
+    Returns
+    -------
+    summary : dict
+        {'count': 件数, 'p50Ms': ..., 'p95Ms': ..., 'p99Ms': ...}
+    """
+    summary = {'count': len(values)}
+    for p in PERCENTILES:
+        summary['p%sMs' % p] = round(percentile(values, p) * 1000, 2) \
+            if values else None
+    return summary
+
+
+def is_success(response):
+    """HTTPステータスと(互換形式の場合は)本文のstatusCodeが200の場合True"""
+    if response.status_code != 200:
+        return False
+    try:
+        body = response.json()
+    except ValueError:
+        return False
+    return not isinstance(body, dict) or body.get('statusCode', 200) == 200
+
+
+async def load(url, mode, concurrency, tokens, seconds=None, total=None):
+    """
+    同時接続数分のクライアントからリクエストを送り続ける
+
+    Parameters
+    ----------
+    url : str
+        アプリケーションのURL
+    mode : str
+        init, buy のいずれか
+    concurrency : int
+        同時接続数
+    tokens : list
+        ユーザー毎のIDトークン
+    seconds : float, optional
+        送り続ける秒数
+    total : int, optional
+        送信する件数(secondsの指定が無い場合)
+
+    Returns
+    -------
+    report : dict
+        処理件数、エラー件数、1秒あたりの処理件数、応答時間
+    """
+    latencies = []
+    errors = 0
+    sent = 0
+    deadline = time.monotonic() + seconds if seconds else None
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+
+    def more():
+        if deadline is not None:
+            return time.monotonic() < deadline
+        return sent < total
+
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        async def worker(index):
+            nonlocal errors, sent
+            i = index
+            while more():
+                sent += 1
+                body = {'mode': mode, 'idToken': tokens[i % len(tokens)],
+                        'language': 'ja', 'liffId': 'benchmark'}
+                start_at = time.perf_counter()
+                try:
+                    response = await client.post(url, content=json.dumps(body))
+                    ok = is_success(response)
+                except httpx.HTTPError:
+                    ok = False
+                latencies.append(time.perf_counter() - start_at)
+                if not ok:
+                    errors += 1
+                i += concurrency
+
+        start_at = time.monotonic()
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+        elapsed = time.monotonic() - start_at
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'requestsPerSec': round(len(latencies) / elapsed, 1),
+        'latencyMs': {key: value for key, value in
+                      summarize(latencies).items() if key != 'count'},
+    }
+
+
+def read_stages(log_path, offset):
+    """
+    サーバーのトレースの詳細ログから処理ごとの所要時間を集計する
+
+    Parameters
+    ----------
+    log_path : str
+        サーバーの標準出力を書き出したファイルのパス
+    offset : int
+        集計を開始するファイルの位置
+
+    Returns
+    -------
+    stages : dict
+        処理名をキーとしたパーセンタイル値。serverはサーバー側のリクエスト全体の所要時間
+    """
+    durations = {'server': []}
+    with open(log_path, encoding='utf-8', errors='replace') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.startswith('{'):
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if 'stages' not in entry:
+                continue
+            durations['server'].append(entry['durationMs'] / 1000)
+            for stage in entry['stages']:
+                durations.setdefault(stage['name'], []).append(
+                    stage['durationMs'] / 1000)
+    return {name: summarize(values)
+            for name, values in sorted(durations.items())}
+
+
+def run(args):
+    """
+    サーバーを起動し、モードと同時接続数の組み合わせごとに計測する
+
+    Returns
+    -------
+    result : dict
+        計測条件(config)と組み合わせごとの結果(runs)
+    """
+    line_server = start_server(latency=args.line_latency_ms / 1000,
+                               error_rate=args.line_error_rate, seed=0)
+    env = server_env(base_url(line_server), args.firestore_latency_ms)
+    env.update({
+        'FIRESTORE_BACKEND': args.firestore,
+        'TRACE_SAMPLE_RATE': str(args.trace_sample_rate),
+        'PYTHONUNBUFFERED': '1',
+    })
+    tokens = [make_test_token('U%032d' % i) for i in range(args.users)]
+    concurrencies = [int(value) for value in args.concurrency.split(',')]
+    modes = args.modes.split(',')
+
+    port = free_port()
+    log = tempfile.NamedTemporaryFile('w+b', suffix='.log', delete=False)
+    process = start(SERVERS[args.server](port), env, port, stdout=log)
+    runs = []
+    try:
+        url = 'http://127.0.0.1:%s/' % port
+        # 会員データを作成してから計測する
+        asyncio.run(load(url, 'init', max(concurrencies), tokens,
+                         total=len(tokens)))
+        for mode in modes:
+            for concurrency in concurrencies:
+                offset = os.path.getsize(log.name)
+                report = asyncio.run(load(url, mode, concurrency, tokens,
+                                          seconds=args.seconds))
+                # 最後のリクエストのログが書き出されるのを待つ
+                time.sleep(0.5)
+                report.update(mode=mode, concurrency=concurrency,
+                              stages=read_stages(log.name, offset))
+                runs.append(report)
+                print('%-5s c=%-4s %8.1f req/s  p50 %7.1fms  p95 %7.1fms  '
+                      'p99 %7.1fms  errors %s' % (
+                          mode, concurrency, report['requestsPerSec'],
+                          report['latencyMs']['p50Ms'],
+                          report['latencyMs']['p95Ms'],
+                          report['latencyMs']['p99Ms'], report['errors']),
+                      file=sys.stderr)
+    finally:
+        process.terminate()
+        process.wait()
+        log.close()
+        os.unlink(log.name)
+        line_counts = dict(line_server.state.counts)
+        line_server.shutdown()
+
+    return {
+        'config': {
+            'server': args.server,
+            'seconds': args.seconds,
+            'users': args.users,
+            'firestore': args.firestore,
+            'firestoreLatencyMs': args.firestore_latency_ms,
+            'lineLatencyMs': args.line_latency_ms,
+            'lineErrorRate': args.line_error_rate,
+            'traceSampleRate': args.trace_sample_rate,
+            'cpus': os.cpu_count(),
+        },
+        'recordedAt': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'runs': runs,
+        'line': line_counts,
+    }
+
+
+def compare(result, baseline, max_regression=DEFAULT_MAX_REGRESSION):
+    """
+    計測結果をベースラインと比較する
+
+    Parameters
+    ----------
+    result : dict
+        今回の計測結果
+    baseline : dict
+        保存済みの計測結果
+    max_regression : float
+        回帰とみなす悪化の割合
+
+    Returns
+    -------
+    rows : list
+        (モード, 同時接続数, 項目, ベースライン, 今回, 変化率, 回帰の場合True)のリスト
+    """
+    previous = {(r['mode'], r['concurrency']): r for r in baseline['runs']}
+    rows = []
+    for current in result['runs']:
+        base = previous.get((current['mode'], current['concurrency']))
+        if base is None:
+            continue
+        # (項目, ベースライン, 今回, 大きいほど良い場合True)
+        metrics = [('requestsPerSec', base['requestsPerSec'],
+                    current['requestsPerSec'], True)]
+        metrics.extend(('latency.' + key, base['latencyMs'][key],
+                        current['latencyMs'][key], False)
+                       for key in sorted(current['latencyMs']))
+        metrics.extend(
+            ('stage.%s.%s' % (name, COMPARED_STAGE_PERCENTILE),
+             base['stages'][name][COMPARED_STAGE_PERCENTILE],
+             stage[COMPARED_STAGE_PERCENTILE], False)
+            for name, stage in current['stages'].items()
+            if name in base.get('stages', {}))
+        for name, before, after, higher_is_better in metrics:
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = -change if higher_is_better else change
+            rows.append((current['mode'], current['concurrency'], name,
+                         before, after, round(change * 100, 1),
+                         worse > max_regression))
+    return rows
+
+
+def baseline_path(name):
+    """ベースラインのファイルのパスを取得する"""
+    return os.path.join(BASELINE_DIR, name + '.json')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='init/buyのエンドツーエンドの負荷試験')
+    parser.add_argument('--server', choices=sorted(SERVERS), default='gunicorn')
+    parser.add_argument('--modes', default='init,buy',
+                        help='カンマ区切りのモード(init, buy)')
+    parser.add_argument('--concurrency', default='1,8,32',
+                        help='カンマ区切りの同時接続数')
+    parser.add_argument('--seconds', type=float, default=10,
+                        help='組み合わせごとの計測秒数')
+    parser.add_argument('--users', type=int, default=USERS)
+    parser.add_argument('--firestore', choices=['fake', 'emulator'],
+                        default='fake')
+    parser.add_argument('--firestore-latency-ms', type=float, default=5,
+                        help='インメモリのFirestoreの1回の読み書きの遅延')
+    parser.add_argument('--line-latency-ms', type=float, default=20)
+    parser.add_argument('--line-error-rate', type=float, default=0)
+    parser.add_argument('--trace-sample-rate', type=float, default=1.0,
+                        help='処理ごとの所要時間を集計するリクエストの割合')
+    parser.add_argument('--save-baseline', metavar='NAME',
+                        help='結果をベースラインとして保存する')
+    parser.add_argument('--compare', metavar='NAME',
+                        help='保存済みのベースラインと比較する')
+    parser.add_argument('--max-regression', type=float,
+                        default=DEFAULT_MAX_REGRESSION)
+    args = parser.parse_args(argv)
+
+    if args.firestore == 'emulator' and \
+            not os.getenv('FIRESTORE_EMULATOR_HOST'):
+        parser.error('--firestore emulatorにはFIRESTORE_EMULATOR_HOSTの設定が必要です')
+    baseline = None
+    if args.compare:
+        with open(baseline_path(args.compare), encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    result = run(args)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(baseline_path(args.save_baseline), 'w',
+                  encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+
+    if baseline is None:
+        return 0
+    if baseline['config'] != result['config']:
+        print('警告: 計測条件がベースラインと異なります: %s' % baseline['config'],
+              file=sys.stderr)
+    rows = compare(result, baseline, args.max_regression)
+    for mode, concurrency, name, before, after, change, regressed in rows:
+        print('%-5s c=%-4s %-32s %10s -> %10s %+7.1f%%%s' % (
+            mode, concurrency, name, before, after, change,
+            '  REGRESSION' if regressed else ''), file=sys.stderr)
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""
+新規ユーザーのinitの同時実行の試験
+
+gunicorn(1 worker, 8 threads)でアプリケーションを起動し、新規ユーザーごとに同時に複数の
+initを送る(二重に開いた場合や、表示直後の自動の購入と重なった場合を模擬する)。
+同じユーザーへの応答のバーコード番号がすべて同じで、その後のinitでも変わらないことを確認し、
+実行中の処理の結果を共有した件数(/diagnostics/cacheのinitShared)を表示する。
+不整合があった場合は終了コード1を返す。
+
+使い方(backendディレクトリで実行):
+    python -m benchmark.bench_init_contention [ユーザー数] [1ユーザーの同時リクエスト数] [Firestoreの遅延(ミリ秒)]
+"""
+import sys
+import json
+import time
+import asyncio
+import httpx
+from benchmark.fake_line_server import start_server, base_url, make_test_token
+from benchmark.bench_asgi import free_port, server_env, start
+from benchmark.bench_e2e import SERVERS, is_success
+
+
+async def burst(url, tokens, per_user):
+    """ユーザーごとに同時にinitを送り、ユーザーごとのバーコード番号を集める"""
+    barcodes = {}
+    errors = 0
+    limits = httpx.Limits(max_connections=len(tokens) * per_user)
+
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        async def send(user_id, token):
+            nonlocal errors
+            response = await client.post(url, content=json.dumps(
+                {'mode': 'init', 'idToken': token}))
+            if not is_success(response):
+                errors += 1
+                return
+            barcodes.setdefault(user_id, set()).add(
+                response.json()['barcodeNum'])
+
+        await asyncio.gather(*(send(user_id, token)
+                               for user_id, token in tokens.items()
+                               for _ in range(per_user)))
+    return barcodes, errors
+
+
+def main(users, per_user, latency_ms):
+    line_server = start_server()
+    env = server_env(base_url(line_server), latency_ms)
+    tokens = {'U%032d' % i: make_test_token('U%032d' % i)
+              for i in range(users)}
+
+    port = free_port()
+    process = start(SERVERS['gunicorn'](port), env, port)
+    try:
+        url = 'http://127.0.0.1:%s/' % port
+        start_at = time.monotonic()
+        barcodes, errors = asyncio.run(burst(url, tokens, per_user))
+        elapsed = time.monotonic() - start_at
+        # 作成後のinitでもバーコード番号が変わらないことを確認する
+        again, again_errors = asyncio.run(burst(url, tokens, 1))
+        stats = httpx.get(url + 'diagnostics/cache').json()
+    finally:
+        process.terminate()
+        process.wait()
+        line_server.shutdown()
+
+    split = [user_id for user_id, numbers in barcodes.items()
+             if len(numbers) > 1]
+    changed = [user_id for user_id, numbers in again.items()
+               if barcodes.get(user_id) != numbers]
+    report = {
+        'requests': users * per_user,
+        'errors': errors + again_errors,
+        'requestsPerSec': round(users * per_user / elapsed, 1),
+        'usersWithSplitBarcodes': len(split),
+        'usersWithChangedBarcodes': len(changed),
+        'initShared': stats.get('initShared'),
+    }
+    print(json.dumps(report, ensure_ascii=False))
+    return 1 if split or changed or report['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200,
+                  int(sys.argv[2]) if len(sys.argv) > 2 else 4,
+                  float(sys.argv[3]) if len(sys.argv) > 3 else 20))
@@ -0,0 +1,137 @@
+"""
+POSレジの取引受付の負荷試験
+
+インメモリのFirestore(1回の読み書きごとに指定した遅延を入れる)に会員を登録し、
+複数のPOSレジから一定時間取引を送り続けた場合の1秒あたりの処理件数と応答時間を、
+会員ごとのまとめ書きを行う場合と取引ごとに書き込む場合で比較する。
+処理後に会員のポイント合計が付与したポイントの合計と一致することを確認する。
+
+使い方(backendディレクトリで実行):
+    python -m benchmark.bench_pos_ingest [秒数] [POSレジ数] [1リクエストの取引数] [Firestoreの遅延(ミリ秒)]
+"""
+import os
+import sys
+import time
+import random
+import threading
+
+os.environ.setdefault('FIRESTORE_BACKEND', 'fake')
+os.environ.setdefault('PROFILE_CACHE_BACKEND', 'memory')
+
+SEED = 20210101
+MEMBERS = 2000
+# 同じ会員の取引が集中するよう、取引の半分は上位1%の会員に割り当てる
+HOT_MEMBERS = MEMBERS // 100
+
+
+def percentile(values, p):
+    """パーセンタイル値を求める"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def make_transaction(rng, barcodes, seq):
+    """ランダムな取引を作成する"""
+    pool = barcodes[:HOT_MEMBERS] if rng.random() < 0.5 else barcodes
+    return {
+        'transactionId': 'T%010d' % seq,
+        'barcodeNum': rng.choice(pool),
+        'lines': [{'sku': '4900000000011', 'quantity': rng.randint(1, 3)},
+                  {'sku': '4900000000028', 'quantity': rng.randint(0, 2) or 1}],
+        'fee': 0,
+    }
+
+
+def run(main, barcodes, seconds, terminals, batch_size, coalesce):
+    """POSレジ数分のスレッドから取引を送り続ける"""
+    credit = main.credit_transactions
+    if not coalesce:
+        credit = make_direct_credit(main)
+    counter = iter(range(10 ** 9))
+    lock = threading.Lock()
+    latencies = []
+    report = {'transactions': 0, 'credited': 0, 'points': 0}
+    deadline = time.monotonic() + seconds
+
+    def terminal(index):
+        rng = random.Random(SEED + index)
+        while time.monotonic() < deadline:
+            with lock:
+                seqs = [next(counter) for _ in range(batch_size)]
+            transactions = [make_transaction(rng, barcodes, seq)
+                            for seq in seqs]
+            start = time.perf_counter()
+            results = credit(transactions)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                report['transactions'] += len(results)
+                for result in results:
+                    if result['status'] == 'credited':
+                        report['credited'] += 1
+                        report['points'] += result['point']
+
+    threads = [threading.Thread(target=terminal, args=(i,))
+               for i in range(terminals)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    report['transactionsPerSec'] = round(report['transactions'] / elapsed, 1)
+    report['p50Ms'] = round(percentile(latencies, 50) * 1000, 1)
+    report['p99Ms'] = round(percentile(latencies, 99) * 1000, 1)
+    return report
+
+
+def make_direct_credit(main):
+    """取引ごとにポイントを加算する比較用の処理を作成する"""
+    def credit(transactions):
+        expiration_date = main.point_expiration_date()
+        results = []
+        for transaction in transactions:
+            cart = main.Cart([(line['sku'], line['quantity'])
+                              for line in transaction['lines']])
+            summary = cart.price(main.product_catalog)
+            user_id = main.resolve_user_id(transaction['barcodeNum'])
+            main.user_info_table_controller.add_point(
+                user_id, summary['point'], expiration_date)
+            results.append({'transactionId': transaction['transactionId'],
+                            'status': 'credited', 'point': summary['point']})
+        return results
+    return credit
+
+
+def total_points(main):
+    """全会員のポイント合計を求める"""
+    db = main.user_info_table_controller.db
+    return sum(doc.to_dict().get('point', 0)
+               for doc in db.collection('MembersCardUserInfo').stream())
+
+
+def main(seconds, terminals, batch_size, latency_ms):
+    import main as app_main
+    db = app_main.user_info_table_controller.db
+    barcodes = [app_main.init('U%032d' % i)['barcodeNum']
+                for i in range(MEMBERS)]
+    db.latency = latency_ms / 1000
+
+    for coalesce in (True, False):
+        before_points = total_points(app_main)
+        before_commits = db.commits
+        report = run(app_main, barcodes, seconds, terminals, batch_size,
+                     coalesce)
+        report['commits'] = db.commits - before_commits
+        db.latency, latency = 0, db.latency
+        assert total_points(app_main) - before_points == report['points']
+        db.latency = latency
+        print('%s %s' % ('coalesced:' if coalesce else 'direct:   ', report))
+    app_main.point_coalescer.stop()
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 10,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 8,
+         int(sys.argv[3]) if len(sys.argv) > 3 else 20,
+         float(sys.argv[4]) if len(sys.argv) > 4 else 10)
@@ -0,0 +1,93 @@
+"""
+金額計算のベンチマークと性質検査
+
+ランダムに生成したカートについて、整数演算の結果が10進の厳密な計算結果
+(Decimal('0.10')等の文字列から生成した率で計算し切り捨て)と一致することを確認し、
+従来のfloat由来のDecimal(0.05)による計算結果と異なる件数を数えた上で、
+1カートあたりの処理時間を比較する。
+
+使い方(backendディレクトリで実行):
+    python -m benchmark.bench_pricing [カート数]
+"""
+import sys
+import math
+import time
+import random
+from decimal import Decimal, ROUND_FLOOR
+import pricing
+
+SEED = 20210101
+
+
+def legacy(amounts, fee, postage, discount):
+    """従来の計算方法"""
+    subtotal = sum(amounts) + postage + fee - discount
+    tax = math.floor(subtotal * Decimal(0.10))
+    point = math.floor(sum(amount * Decimal(0.05) for amount in amounts))
+    return {'subtotal': subtotal, 'tax': tax, 'total': subtotal + tax,
+            'point': point}
+
+
+def exact(amounts, fee, postage, discount):
+    """10進で厳密に計算した結果"""
+    merchandise = sum(amounts)
+    subtotal = merchandise + postage + fee - discount
+    tax = int((subtotal * Decimal('0.10')).to_integral_value(ROUND_FLOOR))
+    point = int((merchandise * Decimal('0.05')).to_integral_value(
+        ROUND_FLOOR))
+    return {'subtotal': subtotal, 'tax': tax, 'total': subtotal + tax,
+            'point': point}
+
+
+def random_carts(rng, count):
+    """ランダムなカートを生成する"""
+    carts = []
+    for _ in range(count):
+        amounts = [rng.randrange(1, 1000) * rng.choice((1, 10, 100))
+                   * rng.randrange(1, 10)
+                   for _ in range(rng.randrange(1, 51))]
+        carts.append((amounts, rng.choice((0, 300)), rng.choice((0, 500)),
+                      rng.randrange(0, 1000)))
+    return carts
+
+
+def check(carts):
+    """
+    全てのカートで厳密な計算結果と一致することを確認する
+
+    Returns
+    -------
+    drift : int
+        従来の計算方法と結果が異なるカートの件数
+    """
+    drift = 0
+    for cart in carts:
+        result = pricing.price_cart(*cart)
+        assert result == exact(*cart), cart
+        if result != legacy(*cart):
+            drift += 1
+    # 端数処理の境界値
+    for amount in range(-200, 201):
+        for rounding, mode in ((pricing.ROUND_FLOOR, 'ROUND_FLOOR'),
+                               (pricing.ROUND_CEILING, 'ROUND_CEILING'),
+                               (pricing.ROUND_HALF_UP, 'ROUND_HALF_UP')):
+            expected = int((amount * Decimal('0.05')).to_integral_value(mode))
+            assert pricing.apply_rate(amount, 500, rounding) == expected
+    return drift
+
+
+def main(count):
+    carts = random_carts(random.Random(SEED), count)
+    drift = check(carts)
+    print('checked %s carts (legacy drift: %s)' % (count, drift))
+
+    for name, func in (('legacy', lambda: [legacy(*c) for c in carts]),
+                       ('integer', lambda: pricing.price_carts(carts))):
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+        print('%-10s %8.2f us/cart' % (name, seconds / count * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
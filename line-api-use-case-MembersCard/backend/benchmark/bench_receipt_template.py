@@ -0,0 +1,75 @@
+"""
+電子レシート生成のマイクロベンチマーク
+
+従来のdict生成 + SDKモデル変換 + JSON化と、カートの計算 + コンパイル済み
+テンプレートへの埋め込みの1件あたりの処理時間を比較する。
+言語毎のテンプレートへの埋め込みの処理時間が言語によらないことも確認する。
+
+使い方(backendディレクトリで実行):
+    python -m benchmark.bench_receipt_template [回数]
+"""
+import sys
+import json
+import timeit
+from linebot.models import FlexSendMessage
+import send_message
+from benchmark import legacy_receipt
+from locale_catalog import LOCALE_CATALOG
+from cart import Cart
+from product_catalog import ProductCatalog, FileCatalogSource
+
+PRODUCT_INFO = {
+    "fee": 300,
+    "postage": 0,
+    "productName1": {
+        "ja": "キャンバストートバッグ"
+    },
+    "productName2": {
+        "ja": "デニムジャケット"
+    },
+    "unitPrice1": 21000,
+    "unitPrice2": 13500
+}
+CART = Cart([('4900000000011', 1), ('4900000000028', 1)], fee=300)
+LANGUAGE = 'ja'
+LIFF_ID = '0000000000-xxxxxxxx'
+
+
+def legacy():
+    """従来の生成方法"""
+    modified = legacy_receipt.modify_product_obj(PRODUCT_INFO, LANGUAGE)
+    flex_dict = legacy_receipt.make_flex_recept(
+        **modified, language=LANGUAGE, liffId=LIFF_ID)
+    return FlexSendMessage.new_from_json_dict(flex_dict).as_json_string()
+
+
+def template(catalog, language=LANGUAGE):
+    """カートとコンパイル済みテンプレートによる生成方法"""
+    summary = CART.price(catalog)
+    return send_message.make_receipt_message(summary, language, LIFF_ID)
+
+
+def without_date(message):
+    """比較のため日時を除いたメッセージを返す"""
+    message = json.loads(message)
+    del message['contents']['header']['contents'][1]
+    return message
+
+
+def main(number):
+    catalog = ProductCatalog(FileCatalogSource())
+
+    # 両者が同じメッセージを生成することを確認する
+    assert without_date(legacy()) == without_date(template(catalog))
+
+    cases = [('legacy', legacy), ('template', lambda: template(catalog))]
+    cases.extend(('template:' + locale,
+                  lambda locale=locale: template(catalog, locale))
+                 for locale in LOCALE_CATALOG.locales)
+    for name, func in cases:
+        seconds = min(timeit.repeat(func, number=number, repeat=5))
+        print('%-16s %8.2f us/receipt' % (name, seconds / number * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,146 @@
+"""
+起動方法(serving.pyのSERVING_PROFILE)ごとのCPU数に対するスケールの比較ベンチマーク
+
+LINE APIのスタンドインサーバーとインメモリのFirestoreを使用し、起動方法とCPU数の
+組み合わせごとにgunicorn -c serving.pyでアプリケーションを起動して、同時接続数を指定して
+リクエストを送り続けた場合の1秒あたりの処理件数と応答時間を計測する。
+サーバーはtasksetで先頭からCPU数分のコアに固定し(ワーカー数はserving.pyが
+CPUアフィニティから求める)、負荷をかけるこのプロセスは残りのコアで動かす。
+1CPUの場合に対する処理件数の倍率をspeedupとして表示する。
+
+インメモリのFirestoreはワーカーごとにデータを持つため、初回のinitで会員データを作成する
+initのみを計測する。buyを計測する場合はFirestoreエミュレータ(--firestore emulator)を使用する。
+
+使い方(backendディレクトリで実行):
+    python -m benchmark.bench_serving_profiles --profiles gthread,preload,gevent,asgi --cpus 1,2,4
+"""
+import os
+import sys
+import json
+import shutil
+import asyncio
+import argparse
+import subprocess
+from benchmark.fake_line_server import start_server, base_url, make_test_token
+from benchmark.bench_asgi import free_port, server_env, start
+from benchmark.bench_e2e import load
+
+USERS = 1000
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def pin_prefix(cpus):
+    """
+    サーバーを先頭からCPU数分のコアで動かすコマンドの前置部分を作成する
+
+    Returns
+    -------
+    prefix : list
+        tasksetのコマンド。tasksetが無い・コアが足りない場合は空のリスト
+    """
+    if shutil.which('taskset') is None or cpus > os.cpu_count():
+        return []
+    return ['taskset', '-c', '0-%d' % (cpus - 1)]
+
+
+def client_cpus(cpus):
+    """サーバーに割り当てなかったコア(無い場合は全てのコア)を取得する"""
+    rest = set(range(cpus, os.cpu_count()))
+    return rest or set(range(os.cpu_count()))
+
+
+def resolved_settings(env, prefix):
+    """serving.pyが選択するgunicornの設定を取得する"""
+    output = subprocess.run(
+        prefix + [sys.executable, 'serving.py'], env=env,
+        cwd=BACKEND_DIR, check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output)
+
+
+def run(args):
+    """
+    起動方法とCPU数の組み合わせごとに計測する
+
+    Returns
+    -------
+    runs : list
+        組み合わせごとの結果
+    """
+    line_server = start_server(latency=args.line_latency_ms / 1000)
+    env = server_env(base_url(line_server), args.firestore_latency_ms)
+    env['FIRESTORE_BACKEND'] = args.firestore
+    tokens = [make_test_token('U%032d' % i) for i in range(args.users)]
+    runs = []
+    try:
+        for profile in args.profiles.split(','):
+            baseline = None
+            for cpus in [int(value) for value in args.cpus.split(',')]:
+                port = free_port()
+                prefix = pin_prefix(cpus)
+                profile_env = dict(env, SERVING_PROFILE=profile,
+                                   PORT=str(port))
+                if not prefix:
+                    # コアに固定できない場合はCPU数を直接指定する
+                    profile_env['SERVING_CPUS'] = str(cpus)
+                settings = resolved_settings(profile_env, prefix)
+                command = prefix + [sys.executable, '-m', 'gunicorn',
+                                    '-c', 'serving.py']
+                os.sched_setaffinity(0, client_cpus(cpus))
+                process = start(command, profile_env, port)
+                try:
+                    url = 'http://127.0.0.1:%s/' % port
+                    # 各ワーカーの初期化と会員データの作成を済ませてから計測する
+                    asyncio.run(load(url, args.mode, args.concurrency,
+                                     tokens, total=len(tokens)))
+                    report = asyncio.run(load(url, args.mode,
+                                              args.concurrency, tokens,
+                                              seconds=args.seconds))
+                finally:
+                    process.terminate()
+                    process.wait()
+                if baseline is None:
+                    baseline = report['requestsPerSec']
+                report.update(
+                    profile=profile, cpus=cpus,
+                    workers=settings['workers'],
+                    speedup=round(report['requestsPerSec'] / baseline, 2)
+                    if baseline else None)
+                runs.append(report)
+                print('%-8s cpus=%-3s workers=%-3s %8.1f req/s  x%-5s '
+                      'p50 %7.1fms  p99 %7.1fms  errors %s' % (
+                          profile, cpus, report['workers'],
+                          report['requestsPerSec'], report['speedup'],
+                          report['latencyMs']['p50Ms'],
+                          report['latencyMs']['p99Ms'], report['errors']),
+                      file=sys.stderr)
+    finally:
+        os.sched_setaffinity(0, range(os.cpu_count()))
+        line_server.shutdown()
+    return runs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='起動方法ごとのCPU数に対するスケールの比較')
+    parser.add_argument('--profiles', default='gthread,preload,gevent,asgi',
+                        help='カンマ区切りの起動方法')
+    parser.add_argument('--cpus', default='1,2,4',
+                        help='カンマ区切りのCPU数')
+    parser.add_argument('--mode', choices=['init', 'buy'], default='init')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--seconds', type=float, default=10,
+                        help='組み合わせごとの計測秒数')
+    parser.add_argument('--users', type=int, default=USERS)
+    parser.add_argument('--firestore', choices=['fake', 'emulator'],
+                        default='fake')
+    parser.add_argument('--firestore-latency-ms', type=float, default=5,
+                        help='インメモリのFirestoreの1回の読み書きの遅延')
+    parser.add_argument('--line-latency-ms', type=float, default=20)
+    args = parser.parse_args(argv)
+    print(json.dumps({'cpuCount': os.cpu_count(), 'runs': run(args)},
+                     ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+"""
+ベンチマーク用のLINE APIのスタンドインサーバー
+
+プッシュ・マルチキャスト送信とIDトークン検証のエンドポイントを持ち、
+応答遅延とエラー率を指定できる。IDトークンは"test-{ユーザーID}"の形式か、
+署名を検証しないJWT(make_test_tokenで作成)を受け付ける。
+
+単体で起動する場合(backendディレクトリで実行):
+    python -m benchmark.fake_line_server --port 8090 --latency-ms 30 --error-rate 0.01
+
+アプリケーションの接続先は以下の環境変数で切り替える:
+    LINE_VERIFY_URL=http://localhost:8090/oauth2/v2.1/verify
+    LINE_JWKS_URL=http://localhost:8090/oauth2/v2.1/certs
+    LINE_PUSH_URL=http://localhost:8090/v2/bot/message/push
+    LINE_MULTICAST_URL=http://localhost:8090/v2/bot/message/multicast
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeLineState:
+    """応答設定と受信件数を保持するクラス"""
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=None):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        latency : float
+            応答遅延(秒)
+        error_rate : float
+            500エラーを返す割合(0〜1)
+        seed : int, optional
+            エラー発生の乱数シード
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counts = {'push': 0, 'multicast': 0, 'verify': 0,
+                       'recipients': 0, 'errors': 0}
+        self.retry_keys = set()
+
+    def should_fail(self):
+        """エラーを返すか判定する"""
+        with self._lock:
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.counts['errors'] += 1
+            return failed
+
+    def count(self, name, recipients=0):
+        """受信件数を加算する"""
+        with self._lock:
+            self.counts[name] += 1
+            self.counts['recipients'] += recipients
+
+    def accept_retry_key(self, retry_key):
+        """
+        リトライキーを記録する
+
+        Returns
+        -------
+        result : bool
+            初めて受け付けたキーの場合True
+        """
+        with self._lock:
+            if retry_key in self.retry_keys:
+                return False
+            self.retry_keys.add(retry_key)
+            return True
+
+
+def token_subject(id_token):
+    """
+    IDトークンからユーザーIDを取得する。
+    "test-{ユーザーID}"の形式、または署名を検証しないJWTのsubを受け付ける。
+
+    Returns
+    -------
+    sub : str
+        ユーザーID。受け付けない形式の場合はNone
+    """
+    if id_token.startswith('test-'):
+        return id_token[len('test-'):]
+    try:
+        import jwt
+        return jwt.decode(id_token, options={'verify_signature': False}
+                          ).get('sub')
+    except Exception:
+        return None
+
+
+def make_test_token(user_id):
+    """
+    ベンチマーク用のIDトークン(HS256で署名したJWT)を作成する。
+    ローカル検証は失敗するため、検証APIで検証される。
+
+    Parameters
+    ----------
+    user_id : str
+        ユーザーID
+
+    Returns
+    -------
+    id_token : str
+        IDトークン
+    """
+    import jwt
+    now = int(time.time())
+    return jwt.encode({'iss': 'https://access.line.me', 'sub': user_id,
+                       'iat': now, 'exp': now + 3600},
+                      'benchmark', algorithm='HS256')
+
+
+class FakeLineHandler(BaseHTTPRequestHandler):
+    """LINE APIのスタンドインのリクエストハンドラクラス"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def do_GET(self):
+        state = self.server.state
+        if self.path == '/oauth2/v2.1/certs':
+            # 公開鍵を返さないため、ローカル検証は検証APIにフォールバックする
+            self._reply(200, {'keys': []})
+        elif self.path == '/stats':
+            self._reply(200, state.counts)
+        else:
+            self._reply(404, {'message': 'Not found'})
+
+    def do_POST(self):
+        state = self.server.state
+        body = self._read_body()
+        if state.latency:
+            time.sleep(state.latency)
+        if state.should_fail():
+            self._reply(500, {'message': 'Internal server error'})
+            return
+
+        if self.path == '/oauth2/v2.1/verify':
+            params = parse_qs(body.decode('utf-8'))
+            subject = token_subject(params.get('id_token', [''])[0])
+            if subject is None:
+                self._reply(400, {'error': 'invalid_request',
+                                  'error_description': 'Invalid IdToken.'})
+                return
+            state.count('verify')
+            now = int(time.time())
+            self._reply(200, {
+                'iss': 'https://access.line.me',
+                'sub': subject,
+                'aud': params.get('client_id', [''])[0],
+                'exp': now + 3600,
+                'iat': now,
+            })
+        elif self.path in ('/v2/bot/message/push',
+                           '/v2/bot/message/multicast'):
+            retry_key = self.headers.get('X-Line-Retry-Key')
+            if retry_key and not state.accept_retry_key(retry_key):
+                self._reply(409, {'message': 'The retry key is already accepted'})
+                return
+            payload = json.loads(body)
+            if self.path.endswith('push'):
+                state.count('push', 1)
+            else:
+                state.count('multicast', len(payload['to']))
+            self._reply(200, {})
+        else:
+            self._reply(404, {'message': 'Not found'})
+
+
+def start_server(port=0, latency=0.0, error_rate=0.0, seed=None):
+    """
+    スタンドインサーバーをバックグラウンドのスレッドで起動する
+
+    Parameters
+    ----------
+    port : int
+        待ち受けポート。0の場合は空いているポートを使用する。
+    latency : float
+        応答遅延(秒)
+    error_rate : float
+        500エラーを返す割合(0〜1)
+    seed : int, optional
+        エラー発生の乱数シード
+
+    Returns
+    -------
+    server : ThreadingHTTPServer
+        起動したサーバー。server.stateで受信件数を参照できる。
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeLineHandler)
+    server.daemon_threads = True
+    server.state = FakeLineState(latency, error_rate, seed)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def base_url(server):
+    """
+    サーバーのベースURLを取得する
+
+    Parameters
+    ----------
+    server : ThreadingHTTPServer
+        start_serverで起動したサーバー
+
+    Returns
+    -------
+    url : str
+        http://127.0.0.1:{ポート}
+    """
+    return 'http://127.0.0.1:%s' % server.server_address[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LINE APIのスタンドインサーバー')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer(('0.0.0.0', args.port), FakeLineHandler)
+    server.daemon_threads = True
+    server.state = FakeLineState(args.latency_ms / 1000, args.error_rate)
+    print('listening on :%s' % args.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
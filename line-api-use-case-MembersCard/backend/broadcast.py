@@ -0,0 +1,199 @@
+"""
+一斉送信モジュール
+
+同じメッセージを複数の会員に送る場合に、同一内容のメッセージごとに宛先をまとめ、
+マルチキャスト(最大500件/リクエスト)で送信する。
+リクエストは再送を含めてトークンバケットでMessaging APIのレート制限内に抑える。
+429/5xxの場合は同じリトライキーで再送するため、重複して送信されない。
+429の場合はRetry-Afterの秒数(最大MULTICAST_MAX_RETRY_AFTER秒)待ってから再送する。
+https://developers.line.biz/ja/reference/messaging-api/#send-multicast-message
+"""
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from common import http_client
+from common.rate_limiter import TokenBucket
+from send_message import (
+    MessagingApiError, is_retryable_error, parse_retry_after)
+
+# 環境変数の宣言
+MULTICAST_URL = os.getenv(
+    'LINE_MULTICAST_URL', 'https://api.line.me/v2/bot/message/multicast')
+# マルチキャストの1秒あたりのリクエスト数の上限
+MULTICAST_RATE = float(os.getenv('MULTICAST_RATE', '100'))
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '8'))
+MULTICAST_MAX_ATTEMPTS = int(os.getenv('MULTICAST_MAX_ATTEMPTS', '3'))
+MULTICAST_BACKOFF_SECONDS = float(
+    os.getenv('MULTICAST_BACKOFF_SECONDS', '0.5'))
+# Retry-Afterに従って待つ時間の上限(秒)
+MULTICAST_MAX_RETRY_AFTER = float(
+    os.getenv('MULTICAST_MAX_RETRY_AFTER', '60'))
+
+# マルチキャストの1リクエストあたりの最大宛先数
+MAX_RECIPIENTS = 500
+
+logger = logging.getLogger(__name__)
+
+
+def group_by_message(notices):
+    """
+    同一内容のメッセージごとに宛先をまとめる
+
+    Parameters
+    ----------
+    notices : iterable
+        (ユーザーID, メッセージオブジェクトのJSON文字列)のタプル
+
+    Returns
+    -------
+    groups : dict
+        メッセージのハッシュをキーとした(メッセージ, 宛先のリスト)
+    """
+    groups = {}
+    for user_id, message_json in notices:
+        digest = hashlib.sha256(message_json.encode('utf-8')).digest()
+        group = groups.get(digest)
+        if group is None:
+            group = groups[digest] = (message_json, [])
+        group[1].append(user_id)
+    return groups
+
+
+def make_batches(groups):
+    """
+    宛先を最大500件ずつに分割する。同じメッセージ内で重複した宛先は除く。
+
+    Parameters
+    ----------
+    groups : dict
+        group_by_messageの戻り値
+
+    Yields
+    ------
+    batch : tuple
+        (メッセージ, 宛先のリスト)
+    """
+    for message_json, user_ids in groups.values():
+        recipients = list(dict.fromkeys(user_ids))
+        for i in range(0, len(recipients), MAX_RECIPIENTS):
+            yield message_json, recipients[i:i + MAX_RECIPIENTS]
+
+
+class Broadcaster:
+    """マルチキャストによる一斉送信クラス"""
+
+    def __init__(self, channel_access_token, rate=MULTICAST_RATE,
+                 workers=BROADCAST_WORKERS, url=MULTICAST_URL):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        channel_access_token : str
+            OAのチャネルアクセストークン
+        rate : float
+            1秒あたりのリクエスト数の上限
+        workers : int
+            並列に送信するリクエスト数
+        url : str
+            マルチキャストのエンドポイント
+        """
+        self._channel_access_token = channel_access_token
+        self._limiter = TokenBucket(rate)
+        self._workers = workers
+        self._url = url
+        self._lock = threading.Lock()
+
+    def send(self, notices):
+        """
+        メッセージを一斉送信する
+
+        Parameters
+        ----------
+        notices : iterable
+            (ユーザーID, メッセージオブジェクトのJSON文字列)のタプル
+
+        Returns
+        -------
+        report : dict
+            送信件数、リクエスト数、失敗件数、1秒あたりの送信件数
+        """
+        start = time.monotonic()
+        groups = group_by_message(notices)
+        report = {'messages': 0, 'requests': 0, 'failedRecipients': 0,
+                  'distinctMessages': len(groups)}
+
+        def send_batch(batch):
+            message_json, recipients = batch
+            try:
+                self.multicast(recipients, message_json)
+                sent, failed = len(recipients), 0
+            except Exception:
+                logger.exception('マルチキャストの送信に失敗しました')
+                sent, failed = 0, len(recipients)
+            with self._lock:
+                report['messages'] += sent
+                report['requests'] += 1
+                report['failedRecipients'] += failed
+
+        with ThreadPoolExecutor(self._workers) as executor:
+            list(executor.map(send_batch, make_batches(groups)))
+
+        elapsed = time.monotonic() - start
+        report['seconds'] = round(elapsed, 3)
+        report['messagesPerSec'] = round(report['messages'] / elapsed, 1) \
+            if elapsed else 0
+        logger.info('一斉送信が完了しました: %s', report)
+        return report
+
+    def multicast(self, user_ids, message_json, retry_key=None):
+        """
+        マルチキャストで送信する。429/5xx・通信エラーの場合は同じリトライキーで再送する。
+        再送を含む全てのリクエストでトークンバケットのトークンを取得する。
+
+        Parameters
+        ----------
+        user_ids : list
+            宛先のユーザーID(最大500件)
+        message_json : str
+            メッセージオブジェクトのJSON文字列
+        retry_key : str, optional
+            リトライキー(UUID)。指定が無い場合は新規に発行する。
+        """
+        headers = {
+            'Authorization': 'Bearer ' + self._channel_access_token,
+            'Content-Type': 'application/json',
+            'X-Line-Retry-Key': retry_key or str(uuid.uuid4()),
+        }
+        body = '{"to":%s,"messages":[%s]}' % (json.dumps(user_ids),
+                                              message_json)
+        delay = MULTICAST_BACKOFF_SECONDS
+        for attempt in range(1, MULTICAST_MAX_ATTEMPTS + 1):
+            self._limiter.acquire()
+            try:
+                response = http_client.request(
+                    'POST', self._url, headers=headers,
+                    data=body.encode('utf-8'))
+                # 409は同じリトライキーのリクエストが受理済みのため成功として扱う
+                if response.status_code not in (200, 409):
+                    raise MessagingApiError(
+                        response.status_code, response.text,
+                        parse_retry_after(
+                            response.headers.get('Retry-After')))
+                return
+            except Exception as e:
+                if attempt == MULTICAST_MAX_ATTEMPTS or \
+                        not is_retryable_error(e):
+                    raise
+                wait = delay
+                retry_after = getattr(e, 'retry_after', None)
+                if retry_after is not None:
+                    wait = max(wait, min(retry_after,
+                                         MULTICAST_MAX_RETRY_AFTER))
+                time.sleep(wait)
+                delay *= 2
@@ -0,0 +1,134 @@
+"""
+購入商品(カート)モジュール
+
+任意件数の明細から、小計・消費税・合計金額・付与ポイントを1回の走査で計算する。
+"""
+import pricing
+
+# 明細の最大件数
+MAX_LINE_ITEMS = 50
+# 1明細あたりの最大数量
+MAX_QUANTITY = 999
+# 決済手数料・送料・値引き額の上限(円)
+MAX_CHARGE = 1000000
+# デモの購入商品(SKU, 数量)
+DEMO_CART_LINES = [('4900000000011', 1), ('4900000000028', 1)]
+
+
+class CartError(Exception):
+    """カートの内容が不正な場合の例外"""
+
+
+def parse_count(value, minimum, maximum):
+    """
+    数量・金額を整数として検証する。
+    小数を切り捨てて受け付けないよう、整数(または数字のみの文字列)以外は不正とする。
+
+    Parameters
+    ----------
+    value : int, str
+        検証する値
+    minimum : int
+        最小値
+    maximum : int
+        最大値
+
+    Returns
+    -------
+    value : int
+        整数の値
+
+    Raises
+    ------
+    CartError
+        整数でない、または範囲外の場合
+    """
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        value = int(value)
+    # boolはintのサブクラスのため除く
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise CartError('整数ではありません: %r' % (value,))
+    if not minimum <= value <= maximum:
+        raise CartError('%s〜%sの範囲外です: %s' % (minimum, maximum, value))
+    return value
+
+
+class Cart:
+    """購入商品のカートクラス"""
+    __slots__ = ['lines', 'fee', 'postage', 'discount']
+
+    def __init__(self, lines, fee=0, postage=0, discount=0):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        lines : list
+            (SKU, 数量)のリスト
+        fee : int
+            決済手数料
+        postage : int
+            送料
+        discount : int
+            値引き額
+
+        Raises
+        ------
+        CartError
+            明細が無い・多すぎる場合、数量が1〜MAX_QUANTITYの整数でない場合、
+            金額が0〜MAX_CHARGEの整数でない場合
+        """
+        if not lines:
+            raise CartError('明細がありません')
+        if len(lines) > MAX_LINE_ITEMS:
+            raise CartError('明細は%s件までです' % MAX_LINE_ITEMS)
+        self.lines = [(sku, parse_count(quantity, 1, MAX_QUANTITY))
+                      for sku, quantity in lines]
+        self.fee = parse_count(fee, 0, MAX_CHARGE)
+        self.postage = parse_count(postage, 0, MAX_CHARGE)
+        self.discount = parse_count(discount, 0, MAX_CHARGE)
+
+    def price(self, catalog):
+        """
+        商品カタログの単価で金額とポイントを計算する
+
+        Parameters
+        ----------
+        catalog : ProductCatalog
+            商品カタログ
+
+        Returns
+        -------
+        summary : dict
+            明細と金額の計算結果
+
+        Raises
+        ------
+        CartError
+            値引き額が商品代金・送料・決済手数料の合計を超える場合
+        """
+        products = catalog.lookup([sku for sku, _ in self.lines])
+        items = []
+        merchandise = 0
+        for product, (sku, quantity) in zip(products, self.lines):
+            amount = product['unitPrice'] * quantity
+            merchandise += amount
+            items.append({
+                'sku': sku,
+                'name': product['name'],
+                'unitPrice': product['unitPrice'],
+                'quantity': quantity,
+                'amount': amount,
+            })
+
+        if self.discount > merchandise + self.fee + self.postage:
+            raise CartError('値引き額が合計金額を超えています')
+        summary = pricing.price_cart(
+            [merchandise], self.fee, self.postage, self.discount)
+        summary.update({
+            'items': items,
+            'fee': self.fee,
+            'postage': self.postage,
+            'discount': self.discount,
+        })
+        return summary
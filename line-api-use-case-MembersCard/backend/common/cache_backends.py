@@ -0,0 +1,224 @@
+"""
+キャッシュバックエンド
+
+プロセス内キャッシュとRedis互換ストアを同じインターフェース
+(get/set/add/delete/stats)で扱う。
+"""
+import json
+import time
+import threading
+from common import utils
+from common.ttl_cache import TTLCache
+
+
+class InProcessCacheBackend:
+    """プロセス内のLRUキャッシュを使用するバックエンドクラス"""
+    __slots__ = ['_cache', '_lock']
+
+    def __init__(self, max_size=10000, max_bytes=16 * 1024 * 1024):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        max_size : int
+            保持する最大件数
+        max_bytes : int
+            保持する値のサイズ合計の上限(バイト)
+        """
+        self._cache = TTLCache(max_size, max_bytes=max_bytes)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        値を取得する
+
+        Parameters
+        ----------
+        key : str
+            キー
+
+        Returns
+        -------
+        value : obj
+            格納されている値。存在しない場合はNone
+        """
+        return self._cache.get(key)
+
+    def set(self, key, value, ttl):
+        """
+        値を格納する
+
+        Parameters
+        ----------
+        key : str
+            キー
+        value : obj
+            格納する値
+        ttl : float
+            有効期間(秒)
+        """
+        size = len(json.dumps(value, default=utils.decimal_to_int))
+        self._cache.set(key, value, time.time() + ttl, size)
+
+    def add(self, key, value, ttl):
+        """
+        キーが存在しない場合のみ値を格納する
+
+        Parameters
+        ----------
+        key : str
+            キー
+        value : obj
+            格納する値
+        ttl : float
+            有効期間(秒)
+
+        Returns
+        -------
+        result : bool
+            格納した場合True
+        """
+        with self._lock:
+            if self._cache.get(key) is not None:
+                return False
+            self.set(key, value, ttl)
+            return True
+
+    def delete(self, key):
+        """
+        値を削除する
+
+        Parameters
+        ----------
+        key : str
+            キー
+        """
+        self._cache.delete(key)
+
+    def stats(self):
+        """
+        統計情報を取得する
+
+        Returns
+        -------
+        stats : dict
+            統計情報
+        """
+        return self._cache.stats()
+
+
+class RedisCacheBackend:
+    """Redis互換ストアを使用するバックエンドクラス"""
+    __slots__ = ['_client', '_prefix']
+
+    def __init__(self, client, prefix='membersCard:'):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        client : redis.Redis
+            get/set/deleteを持つRedis互換クライアント
+        prefix : str
+            キーの接頭辞
+        """
+        self._client = client
+        self._prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, prefix='membersCard:'):
+        """
+        接続URLからバックエンドを作成する
+
+        Parameters
+        ----------
+        url : str
+            redis://形式の接続URL
+        prefix : str
+            キーの接頭辞
+
+        Returns
+        -------
+        backend : RedisCacheBackend
+            作成したバックエンド
+        """
+        import redis
+        return cls(redis.Redis.from_url(url), prefix)
+
+    def get(self, key):
+        """値を取得する"""
+        value = self._client.get(self._prefix + key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, key, value, ttl):
+        """値を格納する"""
+        self._client.set(
+            self._prefix + key,
+            json.dumps(value, default=utils.decimal_to_int,
+                       ensure_ascii=False),
+            ex=max(1, int(ttl)))
+
+    def add(self, key, value, ttl):
+        """キーが存在しない場合のみ値を格納する"""
+        return bool(self._client.set(
+            self._prefix + key,
+            json.dumps(value, default=utils.decimal_to_int,
+                       ensure_ascii=False),
+            ex=max(1, int(ttl)), nx=True))
+
+    def delete(self, key):
+        """値を削除する"""
+        self._client.delete(self._prefix + key)
+
+    def stats(self):
+        """統計情報を取得する"""
+        return {}
+
+
+class FakeRedis:
+    """
+    テスト用のRedis互換インメモリストアクラス
+    RedisCacheBackendが使用するget/set(ex, nx)/deleteのみを実装する。
+    """
+    __slots__ = ['_data', '_lock']
+
+    def __init__(self):
+        """初期化メソッド"""
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """値を取得する"""
+        with self._lock:
+            return self._get(name)
+
+    def set(self, name, value, ex=None, nx=False):
+        """値を格納する"""
+        with self._lock:
+            if nx and self._get(name) is not None:
+                return None
+            if isinstance(value, str):
+                value = value.encode()
+            expires_at = time.time() + ex if ex else None
+            self._data[name] = (value, expires_at)
+            return True
+
+    def _get(self, name):
+        """有効期限を考慮して値を取得する(ロック取得済みで呼び出す)"""
+        entry = self._data.get(name)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.time():
+            del self._data[name]
+            return None
+        return value
+
+    def delete(self, *names):
+        """値を削除する"""
+        with self._lock:
+            return sum(
+                self._data.pop(name, None) is not None for name in names)
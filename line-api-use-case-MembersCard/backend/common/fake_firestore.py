@@ -0,0 +1,477 @@
+"""
+テスト用のFirestoreインメモリ実装
+
+google.cloud.firestore.Clientのうち、本アプリケーションとバッチジョブが使用する
+機能(ドキュメントの取得・登録・更新・作成・削除、単純なクエリ、バッチ書き込み、
+Increment)のみを実装する。AsyncFakeFirestoreClientは同じデータを
+google.cloud.firestore.AsyncClientと同じ非同期インターフェースで操作する。
+"""
+import copy
+import time
+import asyncio
+import itertools
+import threading
+from datetime import datetime, timezone
+
+
+class NotFound(Exception):
+    """更新対象のドキュメントが存在しない場合の例外"""
+
+
+class AlreadyExists(Exception):
+    """作成対象のドキュメントが既に存在する場合の例外"""
+
+
+class FailedPrecondition(Exception):
+    """書き込みの前提条件(最終更新日時)を満たさない場合の例外"""
+
+
+class Increment:
+    """数値フィールドの加算を表すクラス"""
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+
+def _apply(current, data):
+    """更新内容を適用した新しいdictを返す"""
+    result = dict(current)
+    for key, value in data.items():
+        # google.cloud.firestoreのIncrementも同じ名前・属性で扱う
+        if type(value).__name__ == 'Increment':
+            result[key] = result.get(key, 0) + value.value
+        else:
+            result[key] = copy.deepcopy(value)
+    return result
+
+
+class FakeDocumentSnapshot:
+    """ドキュメントのスナップショットクラス"""
+    __slots__ = ['reference', '_data', 'update_time', 'create_time']
+
+    def __init__(self, reference, data, update_time=None, create_time=None):
+        self.reference = reference
+        self._data = data
+        self.update_time = update_time
+        self.create_time = create_time
+
+    @property
+    def id(self):
+        return self.reference.id
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        if self._data is None:
+            return None
+        return copy.deepcopy(self._data)
+
+    def get(self, field):
+        return self._data[field]
+
+
+class FakeDocumentReference:
+    """ドキュメントの参照クラス"""
+    __slots__ = ['_client', 'path', 'id']
+
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def collection(self, name):
+        return FakeCollectionReference(self._client, self.path + '/' + name)
+
+    def get(self, field_paths=None, transaction=None):
+        self._client._round_trip()
+        return self._client._snapshot(self, field_paths)
+
+    def set(self, data, merge=False):
+        self._client._round_trip()
+        with self._client._lock:
+            return self._client._set(self.path, data, merge)
+
+    def create(self, data):
+        self._client._round_trip()
+        with self._client._lock:
+            if self.path in self._client._docs:
+                raise AlreadyExists(self.path)
+            return self._client._set(self.path, data, False)
+
+    def update(self, data, option=None):
+        self._client._round_trip()
+        with self._client._lock:
+            if self.path not in self._client._docs:
+                raise NotFound(self.path)
+            if option and self._client._docs[self.path][1] != \
+                    option['last_update_time']:
+                raise FailedPrecondition(self.path)
+            return self._client._set(self.path, data, True)
+
+    def delete(self):
+        with self._client._lock:
+            self._client._docs.pop(self.path, None)
+
+
+class FakeQuery:
+    """単純なクエリクラス"""
+    __slots__ = ['_client', '_path', '_filters', '_order', '_limit',
+                 '_start_after', '_fields']
+
+    OPERATORS = {
+        '==': lambda a, b: a == b,
+        '<': lambda a, b: a < b,
+        '<=': lambda a, b: a <= b,
+        '>': lambda a, b: a > b,
+        '>=': lambda a, b: a >= b,
+        'in': lambda a, b: a in b,
+    }
+
+    def __init__(self, client, path, filters=(), order=None, limit=None,
+                 start_after=None, fields=None):
+        self._client = client
+        self._path = path
+        self._filters = tuple(filters)
+        self._order = order
+        self._limit = limit
+        self._start_after = start_after
+        self._fields = fields
+
+    def _copy(self, **kwargs):
+        values = {'filters': self._filters, 'order': self._order,
+                  'limit': self._limit, 'start_after': self._start_after,
+                  'fields': self._fields}
+        values.update(kwargs)
+        return FakeQuery(self._client, self._path, **values)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + ((field, op, value),))
+
+    def order_by(self, field, direction=None):
+        return self._copy(order=field)
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, values):
+        return self._copy(start_after=values)
+
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+
+    def stream(self, transaction=None):
+        self._client._round_trip()
+        prefix = self._path + '/'
+        with self._client._lock:
+            docs = [(path, data) for path, data in self._client._docs.items()
+                    if path.startswith(prefix)
+                    and '/' not in path[len(prefix):]]
+        for field, op, value in self._filters:
+            compare = self.OPERATORS[op]
+            docs = [(path, data) for path, data in docs
+                    if field in data[0] and compare(data[0][field], value)]
+
+        # Firestoreと同様に、同じ値の場合はドキュメントのパス順に並べる
+        order = self._order or '__name__'
+        if order == '__name__':
+            def key(item):
+                return ('', item[0])
+        else:
+            def key(item):
+                return (item[1][0].get(order), item[0])
+        docs.sort(key=key)
+
+        if self._start_after is not None:
+            start = self._start_after
+            if isinstance(start, FakeDocumentSnapshot):
+                path = start.reference.path
+                start = ('', path) if order == '__name__' \
+                    else (start.get(order), path)
+                docs = [item for item in docs if key(item) > start]
+            else:
+                if isinstance(start, dict):
+                    start = start[order]
+                docs = [item for item in docs if key(item)[0] > start]
+        if self._limit is not None:
+            docs = docs[:self._limit]
+
+        for path, (data, update_time, create_time) in docs:
+            if self._fields is not None:
+                data = {k: v for k, v in data.items() if k in self._fields}
+            yield FakeDocumentSnapshot(
+                FakeDocumentReference(self._client, path),
+                copy.deepcopy(data), update_time, create_time)
+
+    def get(self, transaction=None):
+        return list(self.stream())
+
+
+class FakeCollectionReference(FakeQuery):
+    """コレクションの参照クラス"""
+    __slots__ = []
+
+    def __init__(self, client, path):
+        super().__init__(client, path)
+
+    @property
+    def id(self):
+        return self._path.rsplit('/', 1)[-1]
+
+    def document(self, document_id=None):
+        if document_id is None:
+            document_id = 'auto%012d' % next(self._client._ids)
+        return FakeDocumentReference(
+            self._client, self._path + '/' + document_id)
+
+    def add(self, data):
+        ref = self.document()
+        return ref.set(data), ref
+
+
+class FakeWriteBatch:
+    """バッチ書き込みクラス。commit時に全ての書き込みをまとめて適用する。"""
+    __slots__ = ['_client', '_writes']
+
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def __len__(self):
+        return len(self._writes)
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(('set', reference, data, merge))
+
+    def create(self, reference, data):
+        self._writes.append(('create', reference, data, False))
+
+    def update(self, reference, data, option=None):
+        self._writes.append(('update', reference, data, option or True))
+
+    def delete(self, reference):
+        self._writes.append(('delete', reference, None, False))
+
+    def commit(self):
+        if len(self._writes) > self._client.MAX_BATCH_SIZE:
+            raise ValueError('too many writes in a batch')
+        self._client._round_trip()
+        with self._client._lock:
+            docs = self._client._docs
+            # 全ての前提条件を確認してから適用する
+            for op, reference, _, option in self._writes:
+                if op == 'update' and reference.path not in docs:
+                    raise NotFound(reference.path)
+                if isinstance(option, dict) and \
+                        docs[reference.path][1] != option['last_update_time']:
+                    raise FailedPrecondition(reference.path)
+                if op == 'create' and reference.path in docs:
+                    raise AlreadyExists(reference.path)
+            results = []
+            for op, reference, data, merge in self._writes:
+                if op == 'delete':
+                    docs.pop(reference.path, None)
+                else:
+                    results.append(
+                        self._client._set(reference.path, data, bool(merge)))
+            self._writes = []
+            self._client.commits += 1
+            return results
+
+
+class FakeWriteResult:
+    """書き込み結果クラス"""
+    __slots__ = ['update_time']
+
+    def __init__(self, update_time):
+        self.update_time = update_time
+
+
+class FakeFirestoreClient:
+    """Firestoreクライアントのインメモリ実装クラス"""
+    MAX_BATCH_SIZE = 500
+
+    def __init__(self, latency=0.0):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        latency : float
+            ベンチマーク用に1回の読み書きごとに待機する時間(秒)
+        """
+        self.latency = latency
+        # パス -> (データ, 更新日時, 作成日時)
+        self._docs = {}
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self._clock = itertools.count(1)
+        self.commits = 0
+
+    def collection(self, name):
+        return FakeCollectionReference(self, name)
+
+    def document(self, path):
+        return FakeDocumentReference(self, path)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def write_option(self, **kwargs):
+        return kwargs
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        self._round_trip()
+        for reference in references:
+            yield self._snapshot(reference, field_paths)
+
+    def _round_trip(self):
+        """通信遅延を模擬する"""
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _now(self):
+        # 同一時刻の更新でも更新日時が変わるよう、マイクロ秒を単調増加させる
+        now = datetime.now(timezone.utc)
+        return now.replace(microsecond=next(self._clock) % 1000000)
+
+    def _set(self, path, data, merge):
+        """ドキュメントを書き込む(ロック取得済みで呼び出す)"""
+        current = self._docs.get(path)
+        now = self._now()
+        if current is None:
+            self._docs[path] = (_apply({}, data), now, now)
+        else:
+            base = current[0] if merge else {}
+            self._docs[path] = (_apply(base, data), now, current[2])
+        return FakeWriteResult(now)
+
+    def _snapshot(self, reference, field_paths):
+        """ドキュメントのスナップショットを作成する"""
+        with self._lock:
+            entry = self._docs.get(reference.path)
+        if entry is None:
+            return FakeDocumentSnapshot(reference, None)
+        data, update_time, create_time = entry
+        if field_paths is not None:
+            data = {k: v for k, v in data.items() if k in field_paths}
+        return FakeDocumentSnapshot(
+            reference, copy.deepcopy(data), update_time, create_time)
+
+
+class AsyncFakeDocumentReference:
+    """ドキュメントの参照クラス(非同期版)"""
+    __slots__ = ['_client', '_reference']
+
+    def __init__(self, client, reference):
+        self._client = client
+        self._reference = reference
+
+    @property
+    def path(self):
+        return self._reference.path
+
+    @property
+    def id(self):
+        return self._reference.id
+
+    def collection(self, name):
+        return AsyncFakeCollectionReference(
+            self._client, self._reference.collection(name))
+
+    async def get(self, field_paths=None, transaction=None):
+        await self._client._round_trip()
+        return self._reference.get(field_paths)
+
+    async def set(self, data, merge=False):
+        await self._client._round_trip()
+        return self._reference.set(data, merge)
+
+    async def create(self, data):
+        await self._client._round_trip()
+        return self._reference.create(data)
+
+    async def update(self, data, option=None):
+        await self._client._round_trip()
+        return self._reference.update(data, option)
+
+    async def delete(self):
+        await self._client._round_trip()
+        return self._reference.delete()
+
+
+class AsyncFakeCollectionReference:
+    """コレクションの参照クラス(非同期版)"""
+    __slots__ = ['_client', '_collection']
+
+    def __init__(self, client, collection):
+        self._client = client
+        self._collection = collection
+
+    def document(self, document_id=None):
+        return AsyncFakeDocumentReference(
+            self._client, self._collection.document(document_id))
+
+
+class AsyncFakeWriteBatch:
+    """バッチ書き込みクラス(非同期版)"""
+    __slots__ = ['_client', '_batch']
+
+    def __init__(self, client, batch):
+        self._client = client
+        self._batch = batch
+
+    def set(self, reference, data, merge=False):
+        self._batch.set(reference._reference, data, merge)
+
+    def create(self, reference, data):
+        self._batch.create(reference._reference, data)
+
+    def update(self, reference, data, option=None):
+        self._batch.update(reference._reference, data, option)
+
+    def delete(self, reference):
+        self._batch.delete(reference._reference)
+
+    async def commit(self):
+        await self._client._round_trip()
+        return self._batch.commit()
+
+
+class AsyncFakeFirestoreClient:
+    """非同期Firestoreクライアントのインメモリ実装クラス"""
+
+    def __init__(self, sync_client=None, latency=0.0):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        sync_client : FakeFirestoreClient, optional
+            データを共有する同期クライアント。指定が無い場合は新規に作成する。
+        latency : float
+            ベンチマーク用に1回の読み書きごとに待機する時間(秒)
+        """
+        self.sync_client = sync_client or FakeFirestoreClient()
+        self.latency = latency
+
+    def collection(self, name):
+        return AsyncFakeCollectionReference(
+            self, self.sync_client.collection(name))
+
+    def document(self, path):
+        return AsyncFakeDocumentReference(
+            self, self.sync_client.document(path))
+
+    def batch(self):
+        return AsyncFakeWriteBatch(self, self.sync_client.batch())
+
+    def write_option(self, **kwargs):
+        return kwargs
+
+    async def _round_trip(self):
+        """通信遅延を模擬する"""
+        if self.latency:
+            await asyncio.sleep(self.latency)
@@ -0,0 +1,110 @@
+"""
+外部API呼び出し用の共通HTTPクライアント
+
+プロセス内で1つのrequests.Sessionを共有し、接続をキープアライブで再利用する。
+冪等なメソッド(GET等)が429/5xxの場合はバックオフ付きでリトライする。
+POST(プッシュ送信・マルチキャスト等)はステータスではリトライせず、呼び出し元
+(電子レシート送信キュー等)がリトライキーを付けて再送する。
+フォークした子プロセスでは親プロセスの接続(ソケット)を共有しないよう、Sessionを作り直す。
+起動を速くするため、requestsは最初のリクエスト時に読み込む。
+"""
+import os
+import threading
+
+# 環境変数の宣言
+# gunicornのスレッド数と同数の接続をホスト毎にプールする
+HTTP_POOL_MAXSIZE = int(os.getenv(
+    'HTTP_POOL_MAXSIZE', os.getenv('GUNICORN_THREADS', '8')))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '3.05'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '10'))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '3'))
+HTTP_BACKOFF_FACTOR = float(os.getenv('HTTP_BACKOFF_FACTOR', '0.3'))
+
+DEFAULT_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _create_session():
+    """
+    接続プールとリトライを設定したSessionを作成する
+
+    Returns
+    -------
+    session : requests.Session
+        作成したSession
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    retry = Retry(
+        total=HTTP_MAX_RETRIES,
+        # 送信済みのリクエストを再送しないよう、読み取り時のエラーはリトライしない
+        read=0,
+        status_forcelist=RETRY_STATUS,
+        # 429/5xxのリトライは冪等なメソッドに限る(POSTは呼び出し元で再送する)
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """
+    プロセス内で共有するSessionを取得する
+
+    Returns
+    -------
+    session : requests.Session
+        共有Session
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _create_session()
+    return _session
+
+
+def _reset_after_fork():
+    """フォークした子プロセスで、親プロセスから引き継いだSessionを破棄する"""
+    global _session, _session_lock
+    _session = None
+    _session_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def request(method, url, timeout=DEFAULT_TIMEOUT, **kwargs):
+    """
+    共有Sessionでリクエストを送信する
+
+    Parameters
+    ----------
+    method : str
+        HTTPメソッド
+    url : str
+        リクエスト先URL
+    timeout : float, tuple, optional
+        タイムアウト(秒)。(接続, 読み取り)のタプルでも指定可能
+
+    Returns
+    -------
+    response : requests.Response
+        レスポンス
+    """
+    return get_session().request(method, url, timeout=timeout, **kwargs)
+
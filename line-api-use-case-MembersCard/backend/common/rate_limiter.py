@@ -0,0 +1,75 @@
+"""
+トークンバケット方式のレート制限
+"""
+import time
+import threading
+
+
+class TokenBucket:
+    """スレッドセーフなトークンバケットクラス"""
+    __slots__ = ['_rate', '_capacity', '_tokens', '_updated_at', '_lock']
+
+    def __init__(self, rate, capacity=None):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        rate : float
+            1秒あたりに補充するトークン数
+        capacity : float, optional
+            バケットの容量(瞬間的に許容する数)。指定が無い場合はrateと同じ。
+        """
+        self._rate = float(rate)
+        self._capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self._capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        """経過時間分のトークンを補充する(ロック取得済みで呼び出す)"""
+        elapsed = now - self._updated_at
+        if elapsed > 0:
+            self._tokens = min(self._capacity,
+                               self._tokens + elapsed * self._rate)
+            self._updated_at = now
+
+    def try_acquire(self, tokens=1):
+        """
+        トークンを取得する。不足している場合は待たずにFalseを返す。
+
+        Parameters
+        ----------
+        tokens : float
+            取得するトークン数
+
+        Returns
+        -------
+        result : bool
+            取得できた場合True
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        """
+        トークンを取得する。不足している場合は補充されるまで待機する。
+
+        Parameters
+        ----------
+        tokens : float
+            取得するトークン数
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self._rate
+            time.sleep(wait)
@@ -0,0 +1,99 @@
+"""
+同じキーの同時実行をまとめるモジュール
+
+同じキーの処理が実行中の場合は新たに実行せず、実行中の処理の完了を待って同じ結果
+(または例外)を返す。完了後に呼び出された場合は再度実行する(結果は保存しない)。
+結果は複数のリクエストで共有するため、呼び出し元では変更しない。
+"""
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """スレッド間で同じキーの同時実行をまとめるクラス"""
+    __slots__ = ['_lock', '_calls', 'shared']
+
+    def __init__(self):
+        """初期化メソッド"""
+        self._lock = threading.Lock()
+        # 実行中のキー -> 結果を受け取るFuture
+        self._calls = {}
+        # 実行中の処理の結果を共有した回数
+        self.shared = 0
+
+    def do(self, key, func):
+        """
+        キーの処理を実行する。同じキーの処理が実行中の場合はその結果を返す。
+
+        Parameters
+        ----------
+        key : str
+            キー
+        func : callable
+            引数なしで呼び出す処理
+
+        Returns
+        -------
+        result : obj
+            処理結果
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is None:
+                future = self._calls[key] = Future()
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+        if not leader:
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class AsyncSingleFlight:
+    """イベントループ内で同じキーの同時実行をまとめるクラス(非同期版)"""
+    __slots__ = ['_calls', 'shared']
+
+    def __init__(self):
+        """初期化メソッド"""
+        # 実行中のキー -> 処理のTask
+        self._calls = {}
+        # 実行中の処理の結果を共有した回数
+        self.shared = 0
+
+    async def do(self, key, func):
+        """
+        キーの処理を実行する。同じキーの処理が実行中の場合はその結果を返す。
+
+        Parameters
+        ----------
+        key : str
+            キー
+        func : callable
+            引数なしで呼び出すコルーチン関数
+
+        Returns
+        -------
+        result : obj
+            処理結果
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = asyncio.ensure_future(func())
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.shared += 1
+        # 待機中のリクエストが取り消されても、他のリクエストの処理は続ける
+        return await asyncio.shield(task)
@@ -0,0 +1,243 @@
+"""
+起動時間の計測と遅延初期化
+
+起動処理をフェーズごとに計測し、診断用のルートで返却できるようにする。
+Firestoreクライアント等の作成に時間がかかるオブジェクトはLazyProxyで包み、
+STARTUP_MODEに応じて初回使用時・起動直後のバックグラウンド・起動時のいずれかで作成する。
+gunicornのpreloadでアプリケーションを読み込んだ後にフォークする場合は、
+親プロセスでの作成を子プロセス(ワーカー)の起動時まで遅らせる。
+"""
+import os
+import time
+import logging
+import threading
+
+# 環境変数の宣言
+# lazy: 初回使用時に作成 / warm: 起動後にバックグラウンドで作成 / eager: 起動時に作成
+STARTUP_MODE = os.getenv('STARTUP_MODE', 'lazy')
+
+logger = logging.getLogger(__name__)
+
+_started_at = time.perf_counter()
+_checkpoint_at = _started_at
+_lock = threading.Lock()
+_phases = []
+_proxies = []
+_fork_callbacks = []
+# Trueの場合、start()での作成をフォーク後(after_fork)まで遅らせる
+_deferred = False
+
+
+def _process_age():
+    """
+    プロセス起動からの経過時間(秒)を取得する。
+    インタプリタの起動とこのモジュールを読み込むまでの時間を含む。
+
+    Returns
+    -------
+    seconds : float
+        経過時間。取得できない環境ではNone
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # プロセス名に空白が含まれる場合に備え、')'以降を分割する
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+_process_age_at_import = _process_age()
+
+
+def _elapsed_ms():
+    """起動(このモジュールの読み込み)からの経過時間(ミリ秒)を取得する"""
+    return round((time.perf_counter() - _started_at) * 1000, 1)
+
+
+def record(name, seconds):
+    """
+    フェーズの所要時間を記録する
+
+    Parameters
+    ----------
+    name : str
+        フェーズ名
+    seconds : float
+        所要時間(秒)
+    """
+    with _lock:
+        _phases.append({'name': name, 'ms': round(seconds * 1000, 1),
+                        'endAtMs': _elapsed_ms()})
+
+
+def checkpoint(name):
+    """
+    前回のチェックポイントからの所要時間をフェーズとして記録する
+
+    Parameters
+    ----------
+    name : str
+        フェーズ名
+    """
+    global _checkpoint_at
+    now = time.perf_counter()
+    with _lock:
+        since, _checkpoint_at = _checkpoint_at, now
+    record(name, now - since)
+
+
+def report():
+    """
+    起動時間の内訳を取得する
+
+    Returns
+    -------
+    report : dict
+        起動モード、プロセス起動から計測開始までの時間、フェーズごとの所要時間、
+        遅延初期化の状態
+    """
+    with _lock:
+        phases = list(_phases)
+    return {
+        'mode': STARTUP_MODE,
+        'beforeImportMs': round(_process_age_at_import * 1000, 1)
+        if _process_age_at_import is not None else None,
+        'phases': phases,
+        'lazy': {proxy.name: proxy.initialized for proxy in _proxies},
+    }
+
+
+class LazyProxy:
+    """
+    初回の属性アクセス時にオブジェクトを作成するプロキシクラス
+    作成はスレッドセーフに1回だけ行い、所要時間を起動時間の内訳に記録する。
+    """
+    __slots__ = ['_factory', '_instance', '_lock', 'name']
+
+    def __init__(self, factory, name):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        factory : callable
+            引数なしでオブジェクトを作成する関数
+        name : str
+            起動時間の内訳に記録する名前
+        """
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+        self.name = name
+        _proxies.append(self)
+
+    @property
+    def initialized(self):
+        """作成済みの場合True"""
+        return self._instance is not None
+
+    def resolve(self):
+        """
+        オブジェクトを取得する。未作成の場合は作成する。
+
+        Returns
+        -------
+        instance : obj
+            作成したオブジェクト
+        """
+        instance = self._instance
+        if instance is not None:
+            return instance
+        with self._lock:
+            if self._instance is None:
+                start = time.perf_counter()
+                self._instance = self._factory()
+                record('lazy:' + self.name, time.perf_counter() - start)
+            return self._instance
+
+    def reset(self):
+        """
+        作成済みのオブジェクトを破棄し、次回の使用時に作成し直す。
+        フォーク前に作成したロックは保持されている可能性があるため作り直す。
+        """
+        self._lock = threading.Lock()
+        self._instance = None
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+
+def initialize_all():
+    """登録されている全てのLazyProxyのオブジェクトを作成する"""
+    for proxy in list(_proxies):
+        try:
+            proxy.resolve()
+        except Exception:
+            # 初回使用時に再度作成を試みる
+            logger.exception('%sの初期化に失敗しました', proxy.name)
+
+
+def start(mode=STARTUP_MODE):
+    """
+    起動モードに応じて遅延初期化のオブジェクトを作成する
+
+    Parameters
+    ----------
+    mode : str
+        lazy, warm, eager のいずれか
+    """
+    if _deferred:
+        return
+    if mode == 'eager':
+        initialize_all()
+    elif mode == 'warm':
+        threading.Thread(target=initialize_all, name='startup-warm',
+                         daemon=True).start()
+    elif mode != 'lazy':
+        raise ValueError('未対応の起動モードです: %s' % mode)
+
+
+def defer_until_fork():
+    """
+    start()での作成をフォーク後まで遅らせる。
+    gRPCのチャネルや接続プールはフォークした子プロセスで共有できないため、
+    preloadする親プロセスでは作成しない。
+    """
+    global _deferred
+    _deferred = True
+
+
+def register_after_fork(callback):
+    """
+    フォーク後の子プロセスで呼び出す処理を登録する
+
+    Parameters
+    ----------
+    callback : callable
+        引数なしで呼び出す関数(スレッドの再起動等)
+    """
+    _fork_callbacks.append(callback)
+
+
+def after_fork(mode=STARTUP_MODE):
+    """
+    フォーク後の子プロセスで、親プロセスから引き継いだオブジェクトを作り直す。
+    LazyProxyのオブジェクトを破棄し、登録された処理を呼び出した後、
+    起動モードに応じて作成する。
+
+    Parameters
+    ----------
+    mode : str
+        lazy, warm, eager のいずれか
+    """
+    global _deferred, _lock
+    _deferred = False
+    _lock = threading.Lock()
+    for proxy in _proxies:
+        proxy.reset()
+    for callback in _fork_callbacks:
+        callback()
+    start(mode)
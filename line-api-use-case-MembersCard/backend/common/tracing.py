@@ -0,0 +1,418 @@
+"""
+リクエスト単位のトレースと処理時間の計測モジュール
+
+リクエストごとにトレースを開始し、トークン検証・DB操作・レシート作成・メッセージ送信等の
+各処理をspanで計測する。計測した時間は処理ごとのヒストグラムに集計し、
+/metricsのルートでPrometheusのテキスト形式で返却する。
+
+Cloud Runが付与するX-Cloud-Trace-Contextヘッダーのトレースを引き継ぎ、
+サンプリング対象のリクエストは処理ごとの所要時間を含むJSON形式のログを1行出力する。
+Cloud Loggingではtraceフィールドによりリクエストログと関連付けて表示される。
+
+サンプリング対象外のリクエストはヒストグラムへの集計のみ行い、spanの記録とログ出力は行わない。
+"""
+import os
+import sys
+import json
+import time
+import random
+import bisect
+import logging
+import threading
+import contextvars
+
+# 環境変数の宣言
+# 詳細ログを出力するリクエストの割合(0.0〜1.0)
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0'))
+# X-Cloud-Trace-Contextヘッダーでサンプリング指定(o=1)されたリクエストも詳細ログを出力する
+TRACE_HONOR_HEADER = os.getenv('TRACE_HONOR_HEADER', '1') == '1'
+# ログのtraceフィールドに使用するプロジェクトID
+GOOGLE_CLOUD_PROJECT = os.getenv('GOOGLE_CLOUD_PROJECT', '')
+
+TRACE_HEADER = 'X-Cloud-Trace-Context'
+# 1リクエストで記録するspanの上限
+MAX_SPANS = 64
+# ヒストグラムのバケット(秒)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 詳細ログは1行1件のJSONとして標準出力に書き出す(Cloud Runで構造化ログとして扱われる)
+trace_logger = logging.getLogger('tracing')
+trace_logger.propagate = False
+if not trace_logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    trace_logger.addHandler(_handler)
+    trace_logger.setLevel(logging.INFO)
+
+_current = contextvars.ContextVar('trace', default=None)
+
+
+class Histogram:
+    """ラベルの組み合わせごとに値の分布を集計するヒストグラムクラス"""
+    __slots__ = ['name', 'help', 'label_names', 'buckets', '_series', '_lock']
+
+    def __init__(self, name, help, label_names, buckets=DEFAULT_BUCKETS):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        name : str
+            メトリクス名
+        help : str
+            メトリクスの説明
+        label_names : tuple
+            ラベル名
+        buckets : tuple
+            バケットの上限値(昇順)
+        """
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # ラベル値のタプル -> [バケットごとの件数(累積しない)..., +Infの件数, 合計値]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        """
+        値を1件集計する
+
+        Parameters
+        ----------
+        labels : tuple
+            label_namesの順のラベル値
+        value : float
+            集計する値
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = \
+                    [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def snapshot(self):
+        """
+        集計結果を取得する
+
+        Returns
+        -------
+        snapshot : dict
+            ラベル値のタプル -> {'buckets': 累積件数のリスト, 'count': 件数, 'sum': 合計値}
+        """
+        with self._lock:
+            items = [(labels, list(series))
+                     for labels, series in self._series.items()]
+        result = {}
+        for labels, series in items:
+            cumulative = []
+            total = 0
+            for count in series[:-1]:
+                total += count
+                cumulative.append(total)
+            result[labels] = {'buckets': cumulative, 'count': total,
+                              'sum': series[-1]}
+        return result
+
+    def render(self):
+        """
+        Prometheusのテキスト形式に変換する
+
+        Returns
+        -------
+        lines : list
+            出力する行のリスト
+        """
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s histogram' % self.name]
+        bounds = [_format_float(b) for b in self.buckets] + ['+Inf']
+        for labels, series in sorted(self.snapshot().items()):
+            pairs = ['%s="%s"' % (name, _escape(value))
+                     for name, value in zip(self.label_names, labels)]
+            for bound, count in zip(bounds, series['buckets']):
+                lines.append('%s_bucket{%s} %d' % (
+                    self.name, ','.join(pairs + ['le="%s"' % bound]), count))
+            label_text = '{%s}' % ','.join(pairs) if pairs else ''
+            lines.append('%s_sum%s %s' % (
+                self.name, label_text, _format_float(series['sum'])))
+            lines.append('%s_count%s %d' % (
+                self.name, label_text, series['count']))
+        return lines
+
+
+def _escape(value):
+    """ラベル値をエスケープする"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _format_float(value):
+    """数値をPrometheusの形式で表す"""
+    return repr(float(value))
+
+
+REQUEST_DURATION = Histogram(
+    'members_card_request_duration_seconds',
+    'Request duration in seconds.', ('route', 'mode', 'status'))
+STAGE_DURATION = Histogram(
+    'members_card_stage_duration_seconds',
+    'Duration of each processing stage in seconds.', ('stage',))
+
+_registry = [REQUEST_DURATION, STAGE_DURATION]
+
+
+def register(histogram):
+    """
+    /metricsで返却するヒストグラムを追加する
+
+    Parameters
+    ----------
+    histogram : Histogram
+        追加するヒストグラム
+    """
+    _registry.append(histogram)
+
+
+def render_metrics():
+    """
+    登録されている全てのメトリクスをPrometheusのテキスト形式で取得する
+
+    Returns
+    -------
+    text : str
+        メトリクスのテキスト
+    """
+    lines = []
+    for histogram in _registry:
+        lines.extend(histogram.render())
+    return '\n'.join(lines) + '\n'
+
+
+class Trace:
+    """1リクエストのトレース情報を保持するクラス"""
+    __slots__ = ['trace_id', 'parent_span_id', 'sampled', 'started_at',
+                 'spans', 'attributes']
+
+    def __init__(self, trace_id, parent_span_id, sampled):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        trace_id : str
+            トレースID(32桁の16進数)。ヘッダーが無くサンプリング対象外の場合はNone
+        parent_span_id : str
+            呼び出し元のspan ID
+        sampled : bool
+            詳細ログを出力する場合True
+        """
+        self.trace_id = trace_id
+        self.parent_span_id = parent_span_id
+        self.sampled = sampled
+        self.started_at = time.perf_counter()
+        self.spans = []
+        self.attributes = {}
+
+
+def parse_trace_header(header):
+    """
+    X-Cloud-Trace-Contextヘッダーを解析する
+    形式: TRACE_ID/SPAN_ID;o=OPTIONS
+
+    Parameters
+    ----------
+    header : str
+        ヘッダーの値
+
+    Returns
+    -------
+    trace_id : str
+        トレースID。ヘッダーが無いか不正な場合はNone
+    span_id : str
+        呼び出し元のspan ID
+    sampled : bool
+        o=1が指定されている場合True
+    """
+    if not header:
+        return None, None, False
+    trace_part, _, options = header.partition(';')
+    trace_id, _, span_id = trace_part.partition('/')
+    if len(trace_id) != 32:
+        return None, None, False
+    try:
+        int(trace_id, 16)
+    except ValueError:
+        return None, None, False
+    return trace_id, span_id or None, options.strip() == 'o=1'
+
+
+def start_request(header=None):
+    """
+    リクエストのトレースを開始する
+
+    Parameters
+    ----------
+    header : str, optional
+        X-Cloud-Trace-Contextヘッダーの値
+
+    Returns
+    -------
+    trace : Trace
+        開始したトレース
+    """
+    trace_id, span_id, sampled = parse_trace_header(header)
+    sampled = (sampled and TRACE_HONOR_HEADER) or \
+        (TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE)
+    if sampled and trace_id is None:
+        trace_id = '%032x' % random.getrandbits(128)
+    trace = Trace(trace_id, span_id, sampled)
+    _current.set(trace)
+    return trace
+
+
+def annotate(key, value):
+    """
+    実行中のトレースに属性を設定する(modeはリクエストのヒストグラムのラベルにも使用する)
+
+    Parameters
+    ----------
+    key : str
+        属性名
+    value : obj
+        属性値
+    """
+    trace = _current.get()
+    if trace is not None:
+        trace.attributes[key] = value
+
+
+def finish_request(route, status):
+    """
+    リクエストのトレースを終了し、所要時間を集計する。
+    サンプリング対象の場合は詳細ログを出力する。
+
+    Parameters
+    ----------
+    route : str
+        ルート(URLのパターン)
+    status : int
+        HTTPステータスコード
+    """
+    trace = _current.get()
+    if trace is None:
+        return
+    _current.set(None)
+    duration = time.perf_counter() - trace.started_at
+    REQUEST_DURATION.observe(
+        (route, trace.attributes.get('mode', ''), str(status)), duration)
+    if trace.sampled:
+        trace_logger.info(json.dumps(
+            _log_entry(trace, route, status, duration),
+            ensure_ascii=False, default=str))
+
+
+def _log_entry(trace, route, status, duration):
+    """詳細ログの内容を作成する"""
+    entry = {
+        'severity': 'INFO',
+        'message': '%s %s %d %.1fms' % (
+            route, trace.attributes.get('mode', ''), status, duration * 1000),
+        'route': route,
+        'status': status,
+        'durationMs': round(duration * 1000, 2),
+        'stages': [_stage_entry(trace, *stage) for stage in trace.spans],
+    }
+    entry.update(trace.attributes)
+    if GOOGLE_CLOUD_PROJECT:
+        entry['logging.googleapis.com/trace'] = 'projects/%s/traces/%s' % (
+            GOOGLE_CLOUD_PROJECT, trace.trace_id)
+    else:
+        entry['trace'] = trace.trace_id
+    if trace.parent_span_id:
+        entry['logging.googleapis.com/spanId'] = trace.parent_span_id
+    return entry
+
+
+def _stage_entry(trace, name, start, elapsed, error):
+    """詳細ログのspan1件分の内容を作成する"""
+    stage = {'name': name,
+             'startMs': round((start - trace.started_at) * 1000, 2),
+             'durationMs': round(elapsed * 1000, 2)}
+    if error:
+        stage['error'] = error
+    return stage
+
+
+def current_trace_id():
+    """
+    実行中のトレースのIDを取得する(エラーログへの付与等に使用する)
+
+    Returns
+    -------
+    trace_id : str
+        トレースID。トレースが無い場合はNone
+    """
+    trace = _current.get()
+    return trace.trace_id if trace is not None else None
+
+
+class Span:
+    """
+    処理の所要時間を計測するコンテキストマネージャクラス
+    所要時間は処理ごとのヒストグラムに集計し、サンプリング対象のトレースにはspanとして記録する。
+    """
+    __slots__ = ['name', '_start']
+
+    def __init__(self, name):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        name : str
+            処理名(ヒストグラムのstageラベル)
+        """
+        self.name = name
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        STAGE_DURATION.observe((self.name,), end - self._start)
+        trace = _current.get()
+        if trace is not None and trace.sampled and \
+                len(trace.spans) < MAX_SPANS:
+            trace.spans.append(
+                (self.name, self._start, end - self._start,
+                 exc_type.__name__ if exc_type is not None else None))
+        return False
+
+
+def span(name):
+    """
+    処理の所要時間を計測する
+
+    Parameters
+    ----------
+    name : str
+        処理名
+
+    Returns
+    -------
+    span : Span
+        withで使用するコンテキストマネージャ
+
+    Examples
+    --------
+    >>> with tracing.span('getItem'):
+    ...     user_info = table.get_item(user_id)
+    """
+    return Span(name)
@@ -0,0 +1,146 @@
+"""
+有効期限付きLRUキャッシュ
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    スレッドセーフな有効期限付きLRUキャッシュクラス
+    エントリ毎に有効期限(UNIX時間)を持ち、上限件数または上限サイズを超えた場合は
+    最も古く参照されたものから削除する。
+    """
+    __slots__ = ['_max_size', '_max_bytes', '_default_ttl', '_data', '_lock',
+                 '_bytes', 'hits', 'misses', 'evictions']
+
+    def __init__(self, max_size=1024, default_ttl=300, max_bytes=None):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        max_size : int
+            保持する最大件数
+        default_ttl : int
+            expires_atの指定が無い場合の有効期間(秒)
+        max_bytes : int, optional
+            保持する値のサイズ合計の上限(バイト)。指定が無い場合は件数のみで制限する。
+        """
+        self._max_size = max_size
+        self._max_bytes = max_bytes
+        self._default_ttl = default_ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """
+        キャッシュから値を取得する
+
+        Parameters
+        ----------
+        key : hashable
+            キー
+        default : obj, optional
+            存在しない、または有効期限切れの場合に返す値
+
+        Returns
+        -------
+        value : obj
+            キャッシュされた値
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at, size = entry
+            if expires_at <= now:
+                del self._data[key]
+                self._bytes -= size
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expires_at=None, size=0):
+        """
+        キャッシュに値を格納する
+
+        Parameters
+        ----------
+        key : hashable
+            キー
+        value : obj
+            格納する値
+        expires_at : float, optional
+            有効期限(UNIX時間)。指定が無い場合はdefault_ttl秒後とする。
+        size : int, optional
+            値のサイズ(バイト)。max_bytesを指定した場合に使用する。
+        """
+        now = time.time()
+        if expires_at is None:
+            expires_at = now + self._default_ttl
+        if expires_at <= now:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._data[key] = (value, expires_at, size)
+            self._bytes += size
+            while len(self._data) > self._max_size or (
+                    self._max_bytes is not None
+                    and self._bytes > self._max_bytes and len(self._data) > 1):
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= evicted[2]
+                self.evictions += 1
+
+    def delete(self, key):
+        """
+        キャッシュから値を削除する
+
+        Parameters
+        ----------
+        key : hashable
+            キー
+        """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[2]
+
+    def clear(self):
+        """キャッシュを全て削除する"""
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """
+        キャッシュの統計情報を取得する
+
+        Returns
+        -------
+        stats : dict
+            ヒット数、ミス数、削除数、件数、サイズ、ヒット率
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._data),
+            'bytes': self._bytes,
+            'hitRatio': self.hits / total if total else 0.0,
+        }
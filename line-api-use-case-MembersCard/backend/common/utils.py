@@ -1,104 +1,284 @@
-"""
-共通関数
-"""
-from decimal import Decimal
-from datetime import (datetime, timedelta)
-import decimal
-import os
-
-
-
-def create_response(status_code, body):
-    """
-    フロントに返却するデータを作成する
-
-    Parameters
-    ----------
-    status_code : int
-        フロントに返却するステータスコード
-    body:dict,str
-        フロントに返却するbodyに格納するデータ
-    Returns
-    -------
-    response : dict
-        フロントに返却するデータ
-    """
-    response = {
-        'statusCode': status_code,
-        # 'headers': {"Access-Control-Allow-Origin": "*"},  # AWS CDK FunctionURLでCORS設定行うためコメントアウト
-        'body': body
-    }
-    return response
-
-
-def create_error_response(body, status=500):
-    """
-    エラー発生時にフロントに返却するデータを作成する
-
-    Parameters
-    ----------
-    body : dict,str
-        フロントに返却するbodyに格納するデータ
-    status:int
-        フロントに返却するステータスコード
-    Returns
-    -------
-    create_response:dict
-        フロントに返却するデータ
-    """
-    return create_response(status, body)
-
-
-def create_success_response(body):
-    """
-    正常終了時にフロントに返却するデータを作成する
-
-    Parameters
-    ----------
-    body : dict,str
-        フロントに返却するbodyに格納するデータ
-    Returns
-    -------
-    create_response:dict
-        フロントに返却するデータ
-    """
-    return create_response(200, body)
-
-
-def separate_comma(num):
-    """
-    数値を3桁毎のカンマ区切りにする
-
-    Parameters
-    ----------
-    num : int
-        カンマ区切りにする数値
-
-    Returns
-    -------
-    result : str
-        カンマ区切りにした文字列
-    """
-    return '{:,}'.format(num)
-
-
-def decimal_to_int(obj):
-    """
-    Decimal型をint型に変換する。
-    json形式に変換する際にDecimal型でエラーが出るため作成。
-    主にDynamoDBの数値データに対して使用する。
-
-    Parameters
-    ----------
-    obj : obj
-        Decimal型の可能性があるオブジェクト
-
-    Returns
-    -------
-    int, other
-        Decimal型の場合int型で返す。
-        その他の型の場合そのまま返す。
-    """
-    if isinstance(obj, Decimal):
-        return int(obj)
-
+"""
+共通関数
+"""
+from collections import namedtuple
+from decimal import Decimal
+from datetime import (datetime, timedelta, timezone)
+import decimal
+import json
+import os
+
+# 環境変数の宣言
+# 1: 従来のLIFFクライアント向けに、HTTPステータス200・statusCodeとJSON文字列のbodyで返却する
+RESPONSE_ENVELOPE = os.getenv('RESPONSE_ENVELOPE', '0') == '1'
+
+# 日本標準時(夏時間が無いため固定のオフセットで表す)
+JST = timezone(timedelta(hours=9), 'JST')
+# リクエストのresponseFormatで従来形式を指定する値
+ENVELOPE_FORMAT = 'envelope'
+JSON_HEADERS = {'Content-Type': 'application/json; charset=utf-8'}
+
+
+def json_default(obj):
+    """
+    JSONに変換できない型を変換する(Decimal型はint型にする)
+
+    Parameters
+    ----------
+    obj : obj
+        JSONに変換できない値
+
+    Returns
+    -------
+    int
+        Decimal型の値をint型にしたもの
+
+    Raises
+    ------
+    TypeError
+        Decimal型以外の場合
+    """
+    if isinstance(obj, Decimal):
+        return int(obj)
+    raise TypeError('%s型はJSONに変換できません' % type(obj).__name__)
+
+
+# 区切り文字の空白を省き、ASCII以外の文字をエスケープしないエンコーダー
+# (json.dumpsに引数を指定すると呼び出し毎にエンコーダーが作成されるため、1つを共有する)
+_json_encoder = json.JSONEncoder(
+    ensure_ascii=False, separators=(',', ':'), default=json_default)
+
+
+def encode_json(obj):
+    """
+    値をJSONのバイト列に変換する
+
+    Parameters
+    ----------
+    obj : obj
+        変換する値(Decimal型を含んでもよい)
+
+    Returns
+    -------
+    body : bytes
+        UTF-8のJSON
+    """
+    return _json_encoder.encode(obj).encode('utf-8')
+
+
+class JsonResponse(namedtuple('JsonResponse', ['body', 'status', 'headers'])):
+    """
+    フロントに返却するレスポンスクラス
+    Flaskのビュー関数の戻り値(ボディ, ステータス, ヘッダー)としてそのまま返却できる。
+    """
+    __slots__ = ()
+
+
+def use_envelope(req_param=None):
+    """
+    従来形式(statusCodeとJSON文字列のbodyを持つ外側のJSON)で返却するか判定する
+
+    Parameters
+    ----------
+    req_param : dict, optional
+        リクエストパラメーター。responseFormatにenvelopeを指定した場合は従来形式とする。
+
+    Returns
+    -------
+    bool
+        従来形式で返却する場合True
+    """
+    if isinstance(req_param, dict):
+        response_format = req_param.get('responseFormat')
+        if response_format is not None:
+            return response_format == ENVELOPE_FORMAT
+    return RESPONSE_ENVELOPE
+
+
+def create_response(status_code, body, envelope=None):
+    """
+    フロントに返却するデータを作成する。
+    bodyは1度だけJSONに変換し、HTTPステータスにstatus_codeを設定する。
+    従来形式の場合はHTTPステータスを200とし、statusCodeとJSON文字列のbodyで包む。
+
+    Parameters
+    ----------
+    status_code : int
+        フロントに返却するステータスコード
+    body : dict, list, str
+        フロントに返却するbodyに格納するデータ
+    envelope : bool, optional
+        従来形式で返却する場合True。指定が無い場合はRESPONSE_ENVELOPEに従う。
+
+    Returns
+    -------
+    response : JsonResponse
+        フロントに返却するデータ
+    """
+    if envelope is None:
+        envelope = RESPONSE_ENVELOPE
+    if envelope:
+        if not isinstance(body, str):
+            body = _json_encoder.encode(body)
+        return JsonResponse(
+            encode_json({'statusCode': status_code, 'body': body}),
+            200, JSON_HEADERS)
+    return JsonResponse(encode_json(body), status_code, JSON_HEADERS)
+
+
+def create_error_response(body, status=500, envelope=None):
+    """
+    エラー発生時にフロントに返却するデータを作成する
+
+    Parameters
+    ----------
+    body : str
+        フロントに返却するエラーメッセージ
+    status : int
+        フロントに返却するステータスコード
+    envelope : bool, optional
+        従来形式で返却する場合True
+
+    Returns
+    -------
+    create_response : JsonResponse
+        フロントに返却するデータ(従来形式以外ではmessageにエラーメッセージを格納する)
+    """
+    envelope = RESPONSE_ENVELOPE if envelope is None else envelope
+    return create_response(
+        status, body if envelope else {'message': body}, envelope)
+
+
+def create_success_response(body, envelope=None):
+    """
+    正常終了時にフロントに返却するデータを作成する
+
+    Parameters
+    ----------
+    body : dict, list
+        フロントに返却するbodyに格納するデータ
+    envelope : bool, optional
+        従来形式で返却する場合True
+
+    Returns
+    -------
+    create_response : JsonResponse
+        フロントに返却するデータ
+    """
+    return create_response(200, body, envelope)
+
+
+def create_not_modified_response(version, envelope=None):
+    """
+    クライアントの保持するデータが最新の場合にフロントに返却するデータを作成する
+
+    Parameters
+    ----------
+    version : str
+        データのバージョン
+    envelope : bool, optional
+        従来形式で返却する場合True
+
+    Returns
+    -------
+    response : JsonResponse
+        ボディの無い304のレスポンス(従来形式ではstatusCodeが304、bodyが空文字列)
+    """
+    if envelope is None:
+        envelope = RESPONSE_ENVELOPE
+    if envelope:
+        return with_etag(create_response(304, '', True), version)
+    return JsonResponse(b'', 304, {'ETag': format_etag(version)})
+
+
+def with_etag(response, version):
+    """
+    レスポンスにETagヘッダーを付与する
+
+    Parameters
+    ----------
+    response : JsonResponse
+        フロントに返却するデータ
+    version : str
+        データのバージョン。Noneの場合は付与しない
+
+    Returns
+    -------
+    response : JsonResponse
+        ETagヘッダーを付与したデータ
+    """
+    if version is None:
+        return response
+    return response._replace(
+        headers=dict(response.headers, ETag=format_etag(version)))
+
+
+def format_etag(version):
+    """バージョンをETagヘッダーの値("で囲んだ文字列)にする"""
+    return '"%s"' % version
+
+
+def parse_etags(header):
+    """
+    If-None-Matchヘッダーの値からバージョンを取り出す
+
+    Parameters
+    ----------
+    header : str
+        If-None-Matchヘッダーの値(カンマ区切りで複数指定可、弱いETagも受け付ける)
+
+    Returns
+    -------
+    versions : list
+        バージョンのリスト
+    """
+    if not header:
+        return []
+    versions = []
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        tag = tag.strip('"')
+        if tag:
+            versions.append(tag)
+    return versions
+
+
+def separate_comma(num):
+    """
+    数値を3桁毎のカンマ区切りにする
+
+    Parameters
+    ----------
+    num : int
+        カンマ区切りにする数値
+
+    Returns
+    -------
+    result : str
+        カンマ区切りにした文字列
+    """
+    return '{:,}'.format(num)
+
+
+def decimal_to_int(obj):
+    """
+    Decimal型をint型に変換する。
+    json形式に変換する際にDecimal型でエラーが出るため作成。
+    主にDynamoDBの数値データに対して使用する。
+
+    Parameters
+    ----------
+    obj : obj
+        Decimal型の可能性があるオブジェクト
+
+    Returns
+    -------
+    int, other
+        Decimal型の場合int型で返す。
+        その他の型の場合そのまま返す。
+    """
+    if isinstance(obj, Decimal):
+        return int(obj)
+
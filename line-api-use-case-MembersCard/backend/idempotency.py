@@ -0,0 +1,348 @@
+"""
+冪等キーによる重複リクエストの抑止モジュール
+
+クライアントが指定した冪等キーごとに最初の処理結果を一定期間保存し、
+同じキーで再送されたリクエストにはDB更新やメッセージ送信を行わずに保存済みの結果を返す。
+同じキーのリクエストが処理中の場合は、先行するリクエストの完了を待って同じ結果を返す。
+
+結果はプロセス内のLRUに保存し、複数インスタンスで共有する場合は
+RedisまたはFirestoreのストアにも保存する。ASGI版ではAsyncIdempotencyStore
+(プロセス内のみ)を使用する。
+"""
+import os
+import time
+import logging
+import threading
+from common.cache_backends import (
+    InProcessCacheBackend, RedisCacheBackend, FakeRedis)
+
+# 環境変数の宣言
+# memory: プロセス内のみ / redis: Redis互換ストア / firestore: Firestore / fake: テスト用インメモリRedis
+IDEMPOTENCY_BACKEND = os.getenv('IDEMPOTENCY_BACKEND', 'memory')
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', '86400'))
+# 処理中の同じキーのリクエストの完了を待つ時間(秒)
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv('IDEMPOTENCY_WAIT_SECONDS', '10'))
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+# 冪等キーの最大長
+MAX_KEY_LENGTH = 128
+# 共有ストアの処理中の印の有効期間(秒)。処理中にインスタンスが停止しても再実行できるようにする
+PENDING_TTL = 60
+# 共有ストアを確認する間隔(秒)
+POLL_INTERVAL = 0.05
+
+logger = logging.getLogger(__name__)
+
+
+class IdempotencyConflict(Exception):
+    """同じ冪等キーのリクエストが処理中で、完了を待てなかった場合の例外"""
+
+
+class FirestoreIdempotencyBackend:
+    """
+    Firestoreを使用する共有ストアクラス
+    expiresAtフィールドにFirestoreのTTLポリシーを設定すると期限切れのキーが削除される。
+    """
+    __slots__ = ['_db', '_collection']
+
+    def __init__(self, db, collection='IdempotencyKeys'):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        db : google.cloud.firestore.Client
+            Firestoreクライアント
+        collection : str
+            保存先のコレクション名
+        """
+        self._db = db
+        self._collection = collection
+
+    def _ref(self, key):
+        return self._db.collection(self._collection).document(key)
+
+    def get(self, key):
+        """値を取得する"""
+        doc = self._ref(key).get()
+        if not doc.exists:
+            return None
+        item = doc.to_dict()
+        if item['expiresAt'] <= time.time():
+            return None
+        return item['value']
+
+    def set(self, key, value, ttl):
+        """値を格納する"""
+        self._ref(key).set({'value': value, 'expiresAt': time.time() + ttl})
+
+    def add(self, key, value, ttl):
+        """キーが存在しない(または期限切れの)場合のみ値を格納する"""
+        try:
+            self._ref(key).create(
+                {'value': value, 'expiresAt': time.time() + ttl})
+            return True
+        except Exception as e:
+            if type(e).__name__ not in ('AlreadyExists', 'Conflict'):
+                raise
+        doc = self._ref(key).get()
+        if not doc.exists:
+            # 確認の間に削除された
+            return self.add(key, value, ttl)
+        if doc.to_dict()['expiresAt'] > time.time():
+            return False
+        # 期限切れのキーは最終更新日時を条件に置き換える
+        try:
+            self._ref(key).update(
+                {'value': value, 'expiresAt': time.time() + ttl},
+                option=self._db.write_option(
+                    last_update_time=doc.update_time))
+            return True
+        except Exception as e:
+            if type(e).__name__ not in ('FailedPrecondition', 'NotFound'):
+                raise
+            return False
+
+    def delete(self, key):
+        """値を削除する"""
+        self._ref(key).delete()
+
+    def stats(self):
+        """統計情報を取得する"""
+        return {}
+
+
+def create_shared_backend(name=IDEMPOTENCY_BACKEND, db=None):
+    """
+    設定に応じた共有ストアを作成する
+
+    Parameters
+    ----------
+    name : str
+        memory, redis, firestore, fake のいずれか
+    db : google.cloud.firestore.Client, optional
+        firestoreの場合に使用するFirestoreクライアント
+
+    Returns
+    -------
+    backend : obj
+        共有ストア。memoryの場合はNone
+    """
+    if name == 'memory':
+        return None
+    if name == 'redis':
+        return RedisCacheBackend.from_url(REDIS_URL, prefix='idempotency:')
+    if name == 'firestore':
+        return FirestoreIdempotencyBackend(db)
+    if name == 'fake':
+        return RedisCacheBackend(FakeRedis(), prefix='idempotency:')
+    raise ValueError('未対応の冪等キーのストアです: %s' % name)
+
+
+def is_valid_key(key):
+    """
+    冪等キーの形式を確認する
+
+    Parameters
+    ----------
+    key : str
+        冪等キー
+
+    Returns
+    -------
+    result : bool
+        1〜128文字の英数字・ハイフン・アンダースコアの場合True
+    """
+    return isinstance(key, str) and 0 < len(key) <= MAX_KEY_LENGTH and \
+        key.replace('-', '').replace('_', '').isalnum() and key.isascii()
+
+
+class IdempotencyStore:
+    """冪等キーごとに処理結果を保存するクラス"""
+    __slots__ = ['_local', '_shared', '_ttl', '_wait', '_lock', '_inflight',
+                 'replays']
+
+    def __init__(self, shared=None, ttl=IDEMPOTENCY_TTL,
+                 wait=IDEMPOTENCY_WAIT_SECONDS, max_size=10000):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        shared : obj, optional
+            複数インスタンスで共有するストア(get/set/add/delete)
+        ttl : float
+            処理結果を保存する期間(秒)
+        wait : float
+            処理中の同じキーのリクエストの完了を待つ時間(秒)
+        max_size : int
+            プロセス内に保存する最大件数
+        """
+        self._local = InProcessCacheBackend(max_size)
+        self._shared = shared
+        self._ttl = ttl
+        self._wait = wait
+        self._lock = threading.Lock()
+        # 処理中のキー -> 完了を通知するEvent
+        self._inflight = {}
+        self.replays = 0
+
+    def run(self, key, func):
+        """
+        キーに対応する処理結果を返す。未処理の場合はfuncを実行して結果を保存する。
+        funcが例外を送出した場合は結果を保存せず、同じキーで再実行できる。
+
+        Parameters
+        ----------
+        key : str
+            冪等キー(ユーザーID等で利用者ごとに区別したもの)
+        func : callable
+            引数なしで呼び出す処理
+
+        Returns
+        -------
+        result : obj
+            処理結果(JSONに変換できる値)
+
+        Raises
+        ------
+        IdempotencyConflict
+            同じキーのリクエストの完了を待てなかった場合
+        """
+        deadline = time.monotonic() + self._wait
+        while True:
+            entry = self._local.get(key)
+            if entry is not None:
+                return self._replay(entry)
+            with self._lock:
+                event = self._inflight.get(key)
+                if event is None:
+                    event = self._inflight[key] = threading.Event()
+                    break
+            # 同じプロセスで処理中のリクエストの完了を待つ
+            if not event.wait(max(0, deadline - time.monotonic())):
+                raise IdempotencyConflict(key)
+
+        try:
+            return self._run_once(key, func, deadline)
+        finally:
+            with self._lock:
+                self._inflight.pop(key)
+            event.set()
+
+    def _run_once(self, key, func, deadline):
+        """共有ストアで重複を確認してから処理を実行する"""
+        entry = {'state': 'pending'}
+        if self._shared is not None and \
+                not self._shared.add(key, entry, PENDING_TTL):
+            # 他のインスタンスで処理済みまたは処理中
+            while True:
+                entry = self._shared.get(key)
+                if entry is None:
+                    if self._shared.add(key, {'state': 'pending'},
+                                        PENDING_TTL):
+                        break
+                elif entry['state'] == 'done':
+                    self._local.set(key, entry, self._ttl)
+                    return self._replay(entry)
+                if time.monotonic() >= deadline:
+                    raise IdempotencyConflict(key)
+                time.sleep(POLL_INTERVAL)
+
+        try:
+            result = func()
+        except Exception:
+            if self._shared is not None:
+                self._shared.delete(key)
+            raise
+        entry = {'state': 'done', 'result': result}
+        self._local.set(key, entry, self._ttl)
+        if self._shared is not None:
+            try:
+                self._shared.set(key, entry, self._ttl)
+            except Exception:
+                logger.warning('冪等キーの保存に失敗しました: %s', key,
+                               exc_info=True)
+        return result
+
+    def _replay(self, entry):
+        """保存済みの処理結果を返す"""
+        self.replays += 1
+        logger.info('冪等キーが一致したため保存済みの結果を返却します')
+        return entry['result']
+
+
+class AsyncIdempotencyStore:
+    """
+    冪等キーごとに処理結果を保存するクラス(非同期版)
+    処理結果はプロセス内のLRUにのみ保存する。
+    """
+    __slots__ = ['_local', '_ttl', '_wait', '_inflight', 'replays']
+
+    def __init__(self, ttl=IDEMPOTENCY_TTL, wait=IDEMPOTENCY_WAIT_SECONDS,
+                 max_size=10000):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        ttl : float
+            処理結果を保存する期間(秒)
+        wait : float
+            処理中の同じキーのリクエストの完了を待つ時間(秒)
+        max_size : int
+            プロセス内に保存する最大件数
+        """
+        self._local = InProcessCacheBackend(max_size)
+        self._ttl = ttl
+        self._wait = wait
+        # 処理中のキー -> 完了を通知するEvent
+        self._inflight = {}
+        self.replays = 0
+
+    async def run(self, key, func):
+        """
+        キーに対応する処理結果を返す。未処理の場合はfuncを実行して結果を保存する。
+
+        Parameters
+        ----------
+        key : str
+            冪等キー(ユーザーID等で利用者ごとに区別したもの)
+        func : callable
+            引数なしで呼び出すコルーチン関数
+
+        Returns
+        -------
+        result : obj
+            処理結果(JSONに変換できる値)
+
+        Raises
+        ------
+        IdempotencyConflict
+            同じキーのリクエストの完了を待てなかった場合
+        """
+        import asyncio
+        deadline = time.monotonic() + self._wait
+        while True:
+            entry = self._local.get(key)
+            if entry is not None:
+                self.replays += 1
+                return entry['result']
+            event = self._inflight.get(key)
+            if event is None:
+                break
+            try:
+                await asyncio.wait_for(
+                    event.wait(), max(0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                raise IdempotencyConflict(key)
+
+        event = self._inflight[key] = asyncio.Event()
+        try:
+            result = await func()
+            self._local.set(key, {'state': 'done', 'result': result},
+                            self._ttl)
+            return result
+        finally:
+            del self._inflight[key]
+            event.set()
@@ -0,0 +1,348 @@
+"""
+取引台帳の集計バッチジョブ
+
+取引台帳(PointLedger)の取引をentryIdの順に読み込み、日別(全店舗)と日別・店舗別の
+取引件数・付与ポイント・売上金額をLedgerRollupsに加算する。
+集計済みの位置(最後のentryId)を集計と同じバッチで記録するため、
+前回の続きから新しい取引のみを読み込み、途中で中断しても二重に加算されない。
+
+読み込み・絞り込み・集計はジェネレータのパイプラインで処理するため、
+台帳の件数に関係なくメモリ使用量は集計ドキュメントの件数に比例する。
+台帳はFirestore(エミュレータを含む)のほか、--exportで書き出したJSON Linesファイルから
+読み込むこともできる。
+
+使い方(backendディレクトリで実行):
+    python ledger_aggregator.py
+    python ledger_aggregator.py --export ledger.jsonl
+    python ledger_aggregator.py --source ledger.jsonl --rebuild --firestore emulator
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from datetime import datetime
+from common.utils import JST
+from members_card_user_info import create_firestore_client, increment
+from point_ledger import (
+    LEDGER_COLLECTION, ROLLUP_COLLECTION, ROLLUP_CHECKPOINT_ID,
+    entry_id_prefix, rollup_id)
+
+# 環境変数の宣言
+# 集計対象とするまでの待ち時間(秒)。他のインスタンスで書き込み中の取引を取りこぼさないようにする
+LEDGER_SETTLE_SECONDS = float(os.getenv('LEDGER_SETTLE_SECONDS', '60'))
+
+# 台帳を読み込む件数
+PAGE_SIZE = 1000
+# チェックポイントの分を除いた1バッチあたりの集計ドキュメント数
+ROLLUPS_PER_BATCH = 499
+
+logger = logging.getLogger(__name__)
+
+
+def read_firestore(db, after=None, before=None, page_size=PAGE_SIZE):
+    """
+    Firestoreの台帳から取引をentryIdの順に読み込む
+
+    Parameters
+    ----------
+    db : google.cloud.firestore.Client
+        Firestoreクライアント
+    after : str, optional
+        このentryIdより後の取引のみを読み込む
+    before : str, optional
+        このentryIdより前の取引のみを読み込む
+    page_size : int
+        1回の問い合わせで読み込む件数
+
+    Yields
+    ------
+    entry : dict
+        取引
+    """
+    query = db.collection(LEDGER_COLLECTION)
+    if before is not None:
+        query = query.where('entryId', '<', before)
+    query = query.order_by('entryId')
+    while True:
+        page = query.limit(page_size)
+        if after is not None:
+            page = page.start_after({'entryId': after})
+        count = 0
+        for doc in page.stream():
+            entry = doc.to_dict()
+            count += 1
+            after = entry['entryId']
+            yield entry
+        if count < page_size:
+            return
+
+
+def read_jsonl(path):
+    """
+    JSON Linesファイルから取引を読み込む
+
+    Parameters
+    ----------
+    path : str
+        ファイルのパス(1行1件、entryIdの順)
+
+    Yields
+    ------
+    entry : dict
+        取引
+    """
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def write_jsonl(entries, path):
+    """
+    取引をJSON Linesファイルに書き出す
+
+    Parameters
+    ----------
+    entries : iterable
+        取引
+    path : str
+        ファイルのパス
+
+    Returns
+    -------
+    count : int
+        書き出した件数
+    """
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            count += 1
+    return count
+
+
+def between(entries, after=None, before=None):
+    """
+    entryIdがafterより後、beforeより前の取引のみを返す
+
+    Parameters
+    ----------
+    entries : iterable
+        取引
+    after : str, optional
+        集計済みの最後のentryId
+    before : str, optional
+        集計対象とするentryIdの上限
+
+    Yields
+    ------
+    entry : dict
+        取引
+    """
+    for entry in entries:
+        entry_id = entry['entryId']
+        if after is not None and entry_id <= after:
+            continue
+        if before is not None and entry_id >= before:
+            continue
+        yield entry
+
+
+def rollup_keys(entries):
+    """
+    取引ごとに加算先の集計(全店舗と店舗別の2件)を返す
+
+    Parameters
+    ----------
+    entries : iterable
+        取引
+
+    Yields
+    ------
+    key : tuple
+        (集計ドキュメントのID, 日付, 店舗ID)。全店舗の集計の店舗IDはNone
+    entry : dict
+        取引
+    """
+    for entry in entries:
+        day = entry['day']
+        yield (rollup_id(day), day, None), entry
+        yield (rollup_id(day, entry['storeId']), day, entry['storeId']), entry
+
+
+def read_checkpoint(db):
+    """
+    集計済みの最後のentryIdを取得する
+
+    Parameters
+    ----------
+    db : google.cloud.firestore.Client
+        Firestoreクライアント
+
+    Returns
+    -------
+    entry_id : str
+        集計済みの最後のentryId。未集計の場合はNone
+    """
+    doc = db.collection(ROLLUP_COLLECTION).document(
+        ROLLUP_CHECKPOINT_ID).get()
+    return doc.to_dict().get('lastEntryId') if doc.exists else None
+
+
+class RollupAggregator:
+    """
+    取引を日別・店舗別に集計して書き込むクラス
+    通常は差分を加算し、rebuildの場合は集計をすべて計算してから値を置き換える。
+    """
+    __slots__ = ['_db', '_rebuild', '_max_rollups', '_rollups',
+                 '_last_entry_id', 'entries', 'commits']
+
+    def __init__(self, db, rebuild=False, max_rollups=ROLLUPS_PER_BATCH):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        db : google.cloud.firestore.Client
+            Firestoreクライアント
+        rebuild : bool
+            集計を作り直す場合True
+        max_rollups : int
+            1回のバッチで書き込む集計ドキュメント数
+        """
+        self._db = db
+        self._rebuild = rebuild
+        self._max_rollups = max_rollups
+        # (集計ドキュメントのID, 日付, 店舗ID) -> [取引件数, ポイント, 売上金額]
+        self._rollups = {}
+        self._last_entry_id = None
+        self.entries = 0
+        self.commits = 0
+
+    def consume(self, keyed_entries):
+        """
+        rollup_keysの結果を集計し、書き込む
+
+        Parameters
+        ----------
+        keyed_entries : iterable
+            (集計のキー, 取引)
+        """
+        for key, entry in keyed_entries:
+            entry_id = entry['entryId']
+            if entry_id != self._last_entry_id:
+                # 1件の取引の加算先が同じバッチに入るよう、取引の区切りで書き込む
+                if not self._rebuild and \
+                        len(self._rollups) > self._max_rollups - 2:
+                    self.flush()
+                self._last_entry_id = entry_id
+                self.entries += 1
+            totals = self._rollups.get(key)
+            if totals is None:
+                totals = self._rollups[key] = [0, 0, 0]
+            totals[0] += 1
+            totals[1] += entry['points']
+            totals[2] += entry['sales']
+        self.flush()
+
+    def flush(self):
+        """
+        集計を書き込み、集計済みの位置を記録する。
+        差分の加算は1回のバッチに収まる件数ごとに呼び出す。
+        """
+        if not self._rollups:
+            return
+        items = list(self._rollups.items())
+        self._rollups = {}
+        now = datetime.now(JST).strftime('%Y/%m/%d %H:%M:%S')
+        collection = self._db.collection(ROLLUP_COLLECTION)
+        for i in range(0, len(items), self._max_rollups):
+            batch = self._db.batch()
+            for (doc_id, day, store_id), (count, points, sales) in \
+                    items[i:i + self._max_rollups]:
+                if self._rebuild:
+                    batch.set(collection.document(doc_id), {
+                        'day': day, 'storeId': store_id,
+                        'transactions': count, 'points': points,
+                        'sales': sales, 'updatedTime': now})
+                else:
+                    batch.set(collection.document(doc_id), {
+                        'day': day, 'storeId': store_id,
+                        'transactions': increment(count),
+                        'points': increment(points),
+                        'sales': increment(sales), 'updatedTime': now},
+                        merge=True)
+            if i + self._max_rollups >= len(items):
+                # 集計済みの位置は最後のバッチで記録する
+                batch.set(collection.document(ROLLUP_CHECKPOINT_ID), {
+                    'lastEntryId': self._last_entry_id, 'updatedTime': now})
+            batch.commit()
+            self.commits += 1
+
+
+def run(db, source=None, rebuild=False, settle_seconds=LEDGER_SETTLE_SECONDS):
+    """
+    台帳の取引を集計する
+
+    Parameters
+    ----------
+    db : google.cloud.firestore.Client
+        集計を書き込むFirestoreクライアント
+    source : str, optional
+        台帳のJSON Linesファイル。指定が無い場合はFirestoreの台帳を読み込む
+    rebuild : bool
+        集計済みの位置に関係なくすべての取引を集計し、集計を作り直す場合True
+    settle_seconds : float
+        この秒数より前に発生した取引のみを集計する
+
+    Returns
+    -------
+    report : dict
+        処理結果
+    """
+    start = time.monotonic()
+    after = None if rebuild else read_checkpoint(db)
+    before = entry_id_prefix(time.time() - settle_seconds)
+    if source is None:
+        entries = read_firestore(db, after=after, before=before)
+    else:
+        entries = between(read_jsonl(source), after=after, before=before)
+
+    aggregator = RollupAggregator(db, rebuild=rebuild)
+    aggregator.consume(rollup_keys(entries))
+    return {
+        'entries': aggregator.entries,
+        'commits': aggregator.commits,
+        'checkpoint': read_checkpoint(db),
+        'seconds': round(time.monotonic() - start, 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='取引台帳の集計バッチジョブ')
+    parser.add_argument('--source',
+                        help='台帳のJSON Linesファイル(指定が無い場合はFirestore)')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='すべての取引を集計し、集計を作り直す')
+    parser.add_argument('--export',
+                        help='Firestoreの台帳をJSON Linesファイルに書き出す')
+    parser.add_argument('--firestore', default=None,
+                        help='firestore, emulator, fake のいずれか')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    db = create_firestore_client(args.firestore) if args.firestore \
+        else create_firestore_client()
+    if args.export:
+        report = {'exported': write_jsonl(read_firestore(db), args.export)}
+    else:
+        report = run(db, source=args.source, rebuild=args.rebuild)
+    print(json.dumps(report, ensure_ascii=False))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,266 @@
+"""
+多言語対応の文言カタログモジュール
+
+content/locales/<言語>.jsonの文言("名前空間.キー": 文言)を起動時に1度だけ読み込み、
+言語毎に既定言語の文言で欠けているキーを補った平坦なdictとして保持する。
+キーと文言はinternし、既定言語から補った文言は全言語で同じオブジェクトを共有する。
+リクエスト毎の処理は言語の解決(メモ化済み)とdictの参照のみとなる。
+
+フロントエンドの文言("front."の名前空間)は同じカタログから書き出す。
+    python locale_catalog.py --export-front ../front/public/front/lang_message
+"""
+import os
+import sys
+import json
+import glob
+import argparse
+import logging
+import threading
+
+# 環境変数の宣言
+LOCALE_CATALOG_DIR = os.getenv(
+    'LOCALE_CATALOG_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 'content', 'locales'))
+# 文言が無いキーと未対応の言語に使用する言語
+DEFAULT_LOCALE = os.getenv('DEFAULT_LOCALE', 'ja')
+
+# 言語コード(小文字)の別名
+LOCALE_ALIASES = {
+    'zh-hant': 'zh-TW',
+    'zh-hk': 'zh-TW',
+    'zh-mo': 'zh-TW',
+}
+# 言語の解決結果をメモ化する最大件数(クライアントが指定する値のため上限を設ける)
+MAX_RESOLVED_LANGUAGES = 256
+# フロントエンドに書き出す名前空間
+FRONT_NAMESPACE = 'front.'
+
+logger = logging.getLogger(__name__)
+
+
+class LocaleCatalog:
+    """言語毎の文言を保持するカタログクラス"""
+    __slots__ = ['default_locale', 'locales', '_tables', '_fallbacks',
+                 '_resolved', '_lock']
+
+    def __init__(self, catalogs, default_locale=DEFAULT_LOCALE):
+        """
+        初期化メソッド。既定言語の文言で欠けているキーを補う。
+
+        Parameters
+        ----------
+        catalogs : dict
+            言語をキーとした文言のdict
+        default_locale : str
+            文言が無いキーと未対応の言語に使用する言語
+        """
+        if default_locale not in catalogs:
+            raise ValueError('既定言語の文言がありません: %s' % default_locale)
+        default = {sys.intern(key): sys.intern(text)
+                   for key, text in catalogs[default_locale].items()}
+        self._tables = {}
+        for locale, messages in catalogs.items():
+            unknown = set(messages).difference(default)
+            if unknown:
+                raise ValueError('既定言語に無いキーがあります(%s): %s' % (
+                    locale, ', '.join(sorted(unknown))))
+            table = dict(default)
+            table.update((sys.intern(key), sys.intern(text))
+                         for key, text in messages.items())
+            self._tables[locale] = table
+            if len(messages) < len(default):
+                logger.info('%sの文言が%s件無いため、%sの文言を使用します',
+                            locale, len(default) - len(messages),
+                            default_locale)
+        self.default_locale = default_locale
+        self.locales = tuple(sorted(self._tables))
+        # 商品名等の言語をキーとした値を選ぶ順序
+        self._fallbacks = {
+            locale: (locale,) if locale == default_locale
+            else (locale, default_locale) for locale in self.locales}
+        self._resolved = {locale.lower(): locale for locale in self.locales}
+        self._lock = threading.Lock()
+
+    def resolve(self, language):
+        """
+        指定された言語に対応する言語を決定する。
+        大文字小文字と区切り文字("_", "-")の違い、別名、地域の指定を吸収し、
+        未対応の言語の場合は既定言語とする。
+
+        Parameters
+        ----------
+        language : str
+            クライアントが指定した言語(例: ja, en-US, zh_TW)
+
+        Returns
+        -------
+        locale : str
+            対応する言語
+        """
+        if not isinstance(language, str):
+            return self.default_locale
+        locale = self._resolved.get(language)
+        if locale is not None:
+            return locale
+
+        normalized = language.strip().replace('_', '-').lower()
+        locale = self._resolved.get(normalized) or \
+            self._resolved.get(LOCALE_ALIASES.get(normalized, '').lower())
+        if locale is None:
+            # 地域を除いた言語(例: en-US -> en)
+            base = normalized.split('-', 1)[0]
+            locale = self._resolved.get(base, self.default_locale)
+        with self._lock:
+            if len(self._resolved) < len(self.locales) + \
+                    MAX_RESOLVED_LANGUAGES:
+                self._resolved[language] = locale
+        return locale
+
+    def table(self, locale):
+        """
+        言語の文言のdictを取得する
+
+        Parameters
+        ----------
+        locale : str
+            resolveで決定した言語
+
+        Returns
+        -------
+        table : dict
+            キーをキーとした文言(既定言語の文言で補ったもの)
+        """
+        return self._tables[locale]
+
+    def text(self, key, language):
+        """
+        キーに対応する文言を取得する
+
+        Parameters
+        ----------
+        key : str
+            文言のキー
+        language : str
+            クライアントが指定した言語
+
+        Returns
+        -------
+        text : str
+            文言。指定言語に無い場合は既定言語の文言
+
+        Raises
+        ------
+        KeyError
+            既定言語にも存在しないキーの場合
+        """
+        return self._tables[self.resolve(language)][key]
+
+    def pick(self, values, locale):
+        """
+        言語をキーとした値(商品名等)から言語に対応する値を選ぶ
+
+        Parameters
+        ----------
+        values : dict
+            言語をキーとした値
+        locale : str
+            resolveで決定した言語
+
+        Returns
+        -------
+        value : obj
+            言語の値。無い場合は既定言語の値、それも無い場合は最初の値
+        """
+        for candidate in self._fallbacks[locale]:
+            if candidate in values:
+                return values[candidate]
+        return next(iter(values.values()))
+
+    def front_messages(self, locale):
+        """
+        フロントエンド用の文言をGlottologistの形式で取得する
+
+        Parameters
+        ----------
+        locale : str
+            言語
+
+        Returns
+        -------
+        messages : dict
+            {キー: {言語: 文言}}の形式の文言
+        """
+        start = len(FRONT_NAMESPACE)
+        return {key[start:]: {locale: text}
+                for key, text in self._tables[locale].items()
+                if key.startswith(FRONT_NAMESPACE)}
+
+
+def load_catalog(path=LOCALE_CATALOG_DIR, default_locale=DEFAULT_LOCALE):
+    """
+    ディレクトリ内の言語毎の文言ファイルを読み込む
+
+    Parameters
+    ----------
+    path : str
+        <言語>.jsonを配置したディレクトリのパス
+    default_locale : str
+        文言が無いキーと未対応の言語に使用する言語
+
+    Returns
+    -------
+    catalog : LocaleCatalog
+        文言カタログ
+    """
+    catalogs = {}
+    for file_path in sorted(glob.glob(os.path.join(path, '*.json'))):
+        locale = os.path.splitext(os.path.basename(file_path))[0]
+        with open(file_path, encoding='utf-8') as f:
+            catalogs[locale] = json.load(f)
+    return LocaleCatalog(catalogs, default_locale)
+
+
+def export_front(catalog, path):
+    """
+    フロントエンド用の文言を言語毎のファイル(<言語>.json)に書き出す
+
+    Parameters
+    ----------
+    catalog : LocaleCatalog
+        文言カタログ
+    path : str
+        書き出し先のディレクトリのパス
+
+    Returns
+    -------
+    locales : list
+        書き出した言語のリスト
+    """
+    os.makedirs(path, exist_ok=True)
+    for locale in catalog.locales:
+        with open(os.path.join(path, locale + '.json'), 'w',
+                  encoding='utf-8') as f:
+            json.dump(catalog.front_messages(locale), f, ensure_ascii=False,
+                      indent=2)
+            f.write('\n')
+    return list(catalog.locales)
+
+
+# インポート時に1度だけ読み込む
+LOCALE_CATALOG = load_catalog()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='文言カタログの書き出し')
+    parser.add_argument('--export-front', required=True,
+                        help='フロントエンド用の文言を書き出すディレクトリ')
+    args = parser.parse_args(argv)
+
+    locales = export_front(LOCALE_CATALOG, args.export_front)
+    print(json.dumps({'exported': locales}, ensure_ascii=False))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
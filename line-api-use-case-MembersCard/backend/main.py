@@ -1,24 +1,44 @@
+from common import startup
 import os
+import hmac
 import json
-import math
-import random
-import datetime
-import requests
-from decimal import Decimal
-from dateutil.tz import gettz
-from dateutil.relativedelta import relativedelta
+import atexit
 import logging
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 import send_message
-from members_card_user_info import MembersCardUserInfo
-from common import utils
+from receipt_outbox import ReceiptOutbox
+from members_card_user_info import (
+    MembersCardUserInfo, point_expiration_date, is_already_exists,
+    VERSION_FIELD)
+from barcode_allocator import BarcodeAllocator
+from member_profile_cache import CachedMembersCardUserInfo, create_cache_backend
+from token_verifier import IdTokenVerifier, TokenExpiredError
+from product_catalog import create_catalog
+from cart import Cart, CartError, DEMO_CART_LINES
+from point_coalescer import PointCoalescer
+import point_ledger
+from idempotency import (
+    IdempotencyStore, IdempotencyConflict, create_shared_backend, is_valid_key)
+from common import utils, tracing
+from common.ttl_cache import TTLCache
+from common.single_flight import SingleFlight
 from flask import Flask, request
 
+startup.checkpoint('import')
 
 
 # 変数の宣言
 LOGGER_LEVEL = 'INFO'
 LIFF_CHANNEL_ID = 'xxxxxxxxxx'
 CHANNEL_ACCESS_TOKEN = 'xxxxxxxxxx'
+# POSレジからの問い合わせに使用するAPIキー
+POS_API_KEY = os.getenv('POS_API_KEY', '')
+# POSレジから1リクエストで受け付ける取引の最大件数
+MAX_POS_TRANSACTIONS = 500
+# POSレジの取引のポイント加算を待つ時間(秒)
+POS_CREDIT_TIMEOUT = 10
+# 店舗IDが指定されていないPOSレジの取引の店舗ID
+DEFAULT_POS_STORE_ID = 'pos'
 
 
 
@@ -30,60 +50,239 @@ else:
     logger.setLevel(logging.INFO)
 
 
-# テーブル操作クラスの初期化
-user_info_table_controller = MembersCardUserInfo()
+def _create_user_info_table():
+    """テーブル操作クラス(キャッシュ付き)を作成する"""
+    table = MembersCardUserInfo()
+    profile_cache_backend = create_cache_backend()
+    if profile_cache_backend is not None:
+        table = CachedMembersCardUserInfo(table, profile_cache_backend)
+    return table
+
+
+# テーブル操作クラスの初期化(Firestoreクライアントの作成は初回使用時に行う)
+user_info_table_controller = startup.LazyProxy(
+    _create_user_info_table, 'userInfoTable')
+
+# バーコード採番クラスの初期化
+barcode_allocator = startup.LazyProxy(
+    lambda: BarcodeAllocator(user_info_table_controller.db),
+    'barcodeAllocator')
+# バーコード番号とユーザーIDの対応は変わらないため、長めに保持する
+barcode_cache = TTLCache(max_size=100000, default_ttl=86400)
+
+# POSレジの取引のポイント加算をまとめて書き込むクラスの初期化
+point_coalescer = PointCoalescer(user_info_table_controller)
+atexit.register(point_coalescer.stop)
+
+# 冪等キーのストアの初期化
+idempotency_store = startup.LazyProxy(
+    lambda: IdempotencyStore(
+        create_shared_backend(db=user_info_table_controller.db)),
+    'idempotencyStore')
+
+# 同じユーザーの同時のinit(二重に開いた場合等)を1回の処理にまとめる
+init_flight = SingleFlight()
+
+# 商品カタログの読み込み
+product_catalog = startup.LazyProxy(create_catalog, 'productCatalog')
+
+# IDトークン検証クラスの初期化
+id_token_verifier = IdTokenVerifier(LIFF_CHANNEL_ID)
+
+
+def _send_receipt(user_id, message, retry_key):
+    """レシート送信キューから呼び出される送信処理"""
+    with tracing.span('pushMessage'):
+        send_message.push_message_json(
+            CHANNEL_ACCESS_TOKEN, user_id, message, retry_key)
+
+
+# 電子レシート送信キューの初期化
+receipt_outbox = ReceiptOutbox(
+    _send_receipt, is_retryable=send_message.is_retryable_error)
+atexit.register(receipt_outbox.stop)
+
+# preloadしてフォークした場合、ワーカーごとに送信・書き込みスレッドを起動し直す
+startup.register_after_fork(receipt_outbox.after_fork)
+startup.register_after_fork(point_coalescer.after_fork)
 
 app = Flask(__name__)
 
+startup.checkpoint('wiring')
+startup.start()
+
+
+@app.before_request
+def start_trace():
+    """リクエストのトレースを開始する"""
+    tracing.start_request(request.headers.get(tracing.TRACE_HEADER))
+
+
+@app.after_request
+def finish_trace(response):
+    """リクエストのトレースを終了し、所要時間を集計する"""
+    rule = request.url_rule
+    tracing.finish_request(rule.rule if rule is not None else 'unmatched',
+                           response.status_code)
+    return response
+
 @app.route('/', methods=['POST'])
 def handler():
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.INFO)
     req_param = json.loads(request.data)
+    # 従来のLIFFクライアントはresponseFormatにenvelopeを指定する
+    envelope = utils.use_envelope(req_param)
+
+    # POSレジからのバーコード問い合わせはIDトークンではなくAPIキーで認証する
+    if req_param.get('mode') == 'lookup':
+        tracing.annotate('mode', 'lookup')
+        if not is_pos_authorized(req_param.get('posApiKey')):
+            return utils.create_error_response('Forbidden', 403, envelope)
+        try:
+            result = lookup(req_param['barcodeNum'])
+        except ValueError:
+            return utils.create_error_response('Bad Request', 400, envelope)
+        except Exception as e:
+            logger.error(e)
+            return utils.create_error_response('ERROR', envelope=envelope)
+        if result is None:
+            return utils.create_error_response('Not Found', 404, envelope)
+        return utils.create_success_response(result, envelope)
     
     # idTokenを検証し、ユーザーIDを取得
-    # https://developers.line.biz/ja/reference/line-login/#verify-id-token
+    # https://developers.line.biz/ja/docs/line-login/verify-id-token/
     try:
-        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-        body = {
-            'id_token': req_param['idToken'],
-            'client_id': LIFF_CHANNEL_ID
-        }
-        response = requests.post(
-            'https://api.line.me/oauth2/v2.1/verify',
-            headers=headers,
-            data=body
-        )
-        user_profile = json.loads(response.text)
-        
-        if 'error' in user_profile and 'expired' in user_profile['error_description']:  # noqa 501
-            return utils.create_error_response('Forbidden', 403)
-        else:
-            req_param['userId'] = user_profile['sub']
-            
+        with tracing.span('verifyToken'):
+            user_profile = id_token_verifier.verify(req_param['idToken'])
+        req_param['userId'] = user_profile['sub']
+
+    except TokenExpiredError:
+        return utils.create_error_response('Forbidden', 403, envelope)
     except Exception:
         logger.exception('不正なIDトークンが使用されています')
-        return utils.create_error_response('Error')
+        return utils.create_error_response('Error', envelope=envelope)
 
     user_id = user_profile['sub']
 
     mode = req_param['mode']
+    tracing.annotate('mode', mode if mode in ('init', 'buy') else 'other')
     # modeによって振り分ける
     try:
         if mode == 'init':
-            result = init(user_id)
+            # クライアントが保持する会員データが最新の場合は会員データを返却しない
+            client_versions = requested_versions(req_param)
+            if client_versions:
+                with tracing.span('getVersion'):
+                    version = unchanged_version(user_id, client_versions)
+                if version is not None:
+                    tracing.annotate('notModified', True)
+                    return utils.create_not_modified_response(
+                        version, envelope)
+            result = init_flight.do(user_id, lambda: init(user_id))
         elif mode == 'buy':
-            result = buy(user_id, req_param['language'], req_param['liffId'])
+            # 冪等キーが指定された場合、同じキーの再送には最初の結果を返却する
+            idempotency_key = req_param.get('idempotencyKey')
+            if idempotency_key is None:
+                result = buy(user_id, req_param['language'],
+                             req_param['liffId'])
+            elif not is_valid_key(idempotency_key):
+                return utils.create_error_response(
+                    'Bad Request', 400, envelope)
+            else:
+                result = idempotency_store.run(
+                    'buy:%s:%s' % (user_id, idempotency_key),
+                    lambda: buy(user_id, req_param['language'],
+                                req_param['liffId']))
 
+    except IdempotencyConflict:
+        return utils.create_error_response('Conflict', 409, envelope)
+    except Exception as e:
+        logger.error(e)
+        return utils.create_error_response('ERROR', envelope=envelope)
+
+    return utils.with_etag(utils.create_success_response(result, envelope),
+                           result.get(VERSION_FIELD))
+
+
+@app.route('/pos/transactions', methods=['POST'])
+def pos_transactions():
+    """
+    POSレジの取引(1件または複数件)を受け付け、会員にポイントを付与する。
+    取引ごとの結果をresultsに受け付け順で返却する。
+    """
+    logger = logging.getLogger(__name__)
+    if not is_pos_authorized(request.headers.get('X-Pos-Api-Key')):
+        return utils.create_error_response('Forbidden', 403)
+    try:
+        req_param = json.loads(request.data)
+        transactions = req_param['transactions'] \
+            if 'transactions' in req_param else [req_param]
+    except (ValueError, TypeError):
+        return utils.create_error_response('Bad Request', 400)
+    if not isinstance(transactions, list) or \
+            len(transactions) > MAX_POS_TRANSACTIONS:
+        return utils.create_error_response('Bad Request', 400)
+
+    try:
+        results = credit_transactions(transactions)
+    except Exception as e:
+        logger.error(e)
+        return utils.create_error_response('ERROR')
+
+    return utils.create_success_response({'results': results})
+
+
+@app.route('/reports/daily', methods=['GET'])
+def daily_report():
+    """
+    日別の取引件数・付与ポイント・売上金額を返却する。
+    from, to(%Y%m%d形式)とstoreId(省略時は全店舗)を指定する。
+    """
+    logger = logging.getLogger(__name__)
+    if not is_pos_authorized(request.headers.get('X-Pos-Api-Key')):
+        return utils.create_error_response('Forbidden', 403)
+    store_id = request.args.get('storeId')
+    if store_id is not None and not point_ledger.is_valid_store_id(store_id):
+        return utils.create_error_response('Bad Request', 400)
+    try:
+        rollups = point_ledger.read_rollups(
+            user_info_table_controller.db, request.args.get('from', ''),
+            request.args.get('to', ''), store_id)
+    except ValueError:
+        return utils.create_error_response('Bad Request', 400)
     except Exception as e:
         logger.error(e)
         return utils.create_error_response('ERROR')
+    return utils.create_success_response({'rollups': rollups})
 
-    success_response = json.dumps(result,
-                                  default=utils.decimal_to_int,
-                                  ensure_ascii=False)
 
-    return utils.create_success_response(success_response)
+@app.route('/diagnostics/cache', methods=['GET'])
+def cache_stats():
+    """キャッシュの統計情報を返却する"""
+    stats = {'idToken': id_token_verifier.cache_stats(),
+             'initShared': init_flight.shared,
+             'receiptsDropped': receipt_outbox.dropped}
+    # 未作成のオブジェクトは診断のために作成しない
+    if idempotency_store.initialized:
+        stats['idempotencyReplays'] = idempotency_store.replays
+    if user_info_table_controller.initialized and isinstance(
+            user_info_table_controller.resolve(), CachedMembersCardUserInfo):
+        stats['memberProfile'] = user_info_table_controller.stats()
+    return stats
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """処理時間のヒストグラムをPrometheusのテキスト形式で返却する"""
+    return tracing.render_metrics(), 200, {
+        'Content-Type': tracing.METRICS_CONTENT_TYPE}
+
+
+@app.route('/diagnostics/startup', methods=['GET'])
+def startup_stats():
+    """起動時間の内訳を返却する"""
+    return startup.report()
 
 
 def init(user_id):
@@ -103,11 +302,13 @@ def init(user_id):
     """
     
     # ユーザーデータ取得
-    user_info = user_info_table_controller.get_item(user_id)
+    with tracing.span('getItem'):
+        user_info = user_info_table_controller.get_item(user_id)
     
     # ログインユーザーのデータが無い場合、ユーザーデータを作成する
     if not user_info:
-        barcode_num = random.randrange(10**12, 10**13)
+        with tracing.span('allocateBarcode'):
+            barcode_num = barcode_allocator.allocate()
     
         expiration_date = ''
         point = 0
@@ -117,15 +318,206 @@ def init(user_id):
             'pointExpirationDate': expiration_date,
             'point': point,
         }
-        # ユーザーデータ作成
-        user_info_table_controller.put_item(
-            user_id, barcode_num, expiration_date, point)
+        # ユーザーデータ作成(他のインスタンスが同時に作成した場合はそのデータを返却する)
+        try:
+            with tracing.span('putItem'):
+                response = user_info_table_controller.put_item(
+                    user_id, barcode_num, expiration_date, point)
+        except Exception as e:
+            if not is_already_exists(e):
+                raise
+            with tracing.span('getItem'):
+                user_info = user_info_table_controller.get_item(user_id)
+            if user_info is None:
+                # バーコード番号の重複
+                raise
+            return user_info
+        item[VERSION_FIELD] = response.get(VERSION_FIELD)
         
         return item
 
     return user_info
 
 
+def requested_versions(req_param):
+    """
+    クライアントが保持する会員データのバージョンを取得する
+
+    Parameters
+    ----------
+    req_param : dict
+        リクエストパラメーター
+
+    Returns
+    -------
+    versions : list
+        If-None-Matchヘッダーとリクエストのversionで指定されたバージョン
+    """
+    versions = utils.parse_etags(request.headers.get('If-None-Match'))
+    version = req_param.get(VERSION_FIELD)
+    if isinstance(version, str) and version:
+        versions.append(version)
+    return versions
+
+
+def unchanged_version(user_id, client_versions):
+    """
+    会員データのバージョンのみを取得し、クライアントが保持するバージョンと比較する。
+
+    Parameters
+    ----------
+    user_id : str
+        LINEのユーザーID
+    client_versions : list
+        クライアントが保持するバージョン
+
+    Returns
+    -------
+    version : str
+        一致した場合はそのバージョン。会員データが無い・変更された場合はNone
+    """
+    version = user_info_table_controller.get_version(user_id)
+    return version if version is not None and version in client_versions \
+        else None
+
+
+def is_pos_authorized(api_key):
+    """
+    POSレジのAPIキーを検証する
+
+    Parameters
+    ----------
+    api_key : str
+        リクエストのAPIキー
+
+    Returns
+    -------
+    bool
+        APIキーが一致する場合True(APIキーが未設定の場合は常にFalse)
+    """
+    if not POS_API_KEY or not isinstance(api_key, str):
+        return False
+    return hmac.compare_digest(api_key.encode('utf-8'),
+                               POS_API_KEY.encode('utf-8'))
+
+
+def lookup(barcode_num):
+    """
+    スキャンしたバーコード番号から会員データを取得する。
+
+    Parameters
+    ----------
+    barcode_num : str, int
+        バーコード番号
+
+    Returns
+    -------
+    dict
+        会員ユーザー情報。該当する会員がいない場合はNone
+    """
+    with tracing.span('resolveBarcode'):
+        user_id = resolve_user_id(barcode_num)
+    if user_id is None:
+        return None
+    with tracing.span('getItem'):
+        return user_info_table_controller.get_item(user_id)
+
+
+def resolve_user_id(barcode_num):
+    """
+    バーコード番号から会員のユーザーIDを取得する。
+
+    Parameters
+    ----------
+    barcode_num : str, int
+        バーコード番号
+
+    Returns
+    -------
+    str
+        ユーザーID。該当する会員がいない場合はNone
+    """
+    barcode_num = str(barcode_num)
+    if len(barcode_num) != 13 or not barcode_num.isdigit():
+        raise ValueError('バーコード番号が不正です: %s' % barcode_num)
+
+    user_id = barcode_cache.get(barcode_num)
+    if user_id is None:
+        user_id = user_info_table_controller.find_user_id_by_barcode(
+            barcode_num)
+        if user_id is not None:
+            barcode_cache.set(barcode_num, user_id)
+    return user_id
+
+
+def credit_transactions(transactions):
+    """
+    POSレジの取引の金額を計算し、会員にポイントを付与する。
+    同じ会員の取引は短時間ためてから1回の加算にまとめて書き込む。
+    同じ店舗ID・取引IDの取引は1回のみ加算し、再送された取引はcreditedを返却する。
+
+    Parameters
+    ----------
+    transactions : list
+        取引(transactionId, storeId, barcodeNum, lines[{sku, quantity}], fee,
+        postage, discount)のリスト
+
+    Returns
+    -------
+    list
+        取引ごとの結果(transactionId, status, point)。statusはcredited, pending
+        (待ち時間内に加算が完了しなかった), failed, invalid, memberNotFound のいずれか
+    """
+    logger = logging.getLogger(__name__)
+    expiration_date = point_expiration_date()
+    results = []
+    futures = []
+    for transaction in transactions:
+        result = {'transactionId': transaction.get('transactionId')
+                  if isinstance(transaction, dict) else None}
+        results.append(result)
+        try:
+            cart = Cart([(line['sku'], line['quantity'])
+                         for line in transaction['lines']],
+                        fee=transaction.get('fee', 0),
+                        postage=transaction.get('postage', 0),
+                        discount=transaction.get('discount', 0))
+            summary = cart.price(product_catalog)
+            store_id = transaction.get('storeId', DEFAULT_POS_STORE_ID)
+            if not point_ledger.is_valid_store_id(store_id):
+                raise ValueError('店舗IDが不正です: %s' % store_id)
+            transaction_id = transaction.get('transactionId')
+            if transaction_id is not None and \
+                    not point_ledger.is_valid_transaction_id(transaction_id):
+                raise ValueError('取引IDが不正です: %s' % transaction_id)
+            user_id = resolve_user_id(transaction['barcodeNum'])
+        except (CartError, KeyError, ValueError, TypeError, AttributeError):
+            result['status'] = 'invalid'
+            continue
+        if user_id is None:
+            result['status'] = 'memberNotFound'
+            continue
+        result['point'] = summary['point']
+        ledger = point_ledger.ledger_entry(
+            user_id, summary['point'], summary['total'], store_id, 'pos',
+            transaction_id=transaction_id)
+        futures.append((result, point_coalescer.submit(
+            user_id, summary['point'], expiration_date, ledger)))
+
+    with tracing.span('creditPoints'):
+        for result, future in futures:
+            try:
+                future.result(POS_CREDIT_TIMEOUT)
+                result['status'] = 'credited'
+            except FuturesTimeoutError:
+                # 待ち時間を過ぎても加算される場合がある(同じ取引IDで再送すれば二重に加算されない)
+                result['status'] = 'pending'
+            except Exception as e:
+                logger.error(e)
+                result['status'] = 'failed'
+    return results
+
+
 def buy(user_id, language, liffId):
     """
     商品を購入し、ポイント付与のDB更新と電子レシートの送信を行う。
@@ -140,42 +532,36 @@ def buy(user_id, language, liffId):
 
     """
     
-    # 商品データ
-    product_info = {
-        "fee": 300,
-        "postage": 0,
-        "productName1": {
-            "ja": "キャンバストートバッグ"
-        },
-        "productName2": {
-            "ja": "デニムジャケット"
-        },
-        "unitPrice1": 21000,
-        "unitPrice2": 13500
-    }
+    # 購入商品(デモのため固定)
+    cart = Cart(DEMO_CART_LINES, fee=300, postage=0)
+    with tracing.span('priceCart'):
+        summary = cart.price(product_catalog)
 
     # 付与ポイントの取得
-    user_info = user_info_table_controller.get_item(user_id)
-    before_awarded_point = user_info['point']
-    add_point = math.floor((product_info['unitPrice1'] * Decimal(0.05)) + (product_info['unitPrice2'] * Decimal(0.05))) #複数商品を出力するため
-    after_awarded_point = before_awarded_point + add_point
+    add_point = summary['point']
 
     # 更新期限日の取得
-    today = datetime.datetime.now(gettz('Asia/Tokyo'))
-    expiration_date = (today + relativedelta(years=1)
-                       ).strftime('%Y/%m/%d')
-
-    # DB更新
-    user_info_table_controller.update_point_expiration_date(
-        user_id, after_awarded_point, expiration_date)
+    expiration_date = point_expiration_date()
 
-    user_info['pointExpirationDate'] = expiration_date
-    user_info['point'] = after_awarded_point
+    # DB更新(ポイントはDB側で加算し、同じ書き込みで取引台帳に追記する)
+    ledger = point_ledger.ledger_entry(
+        user_id, add_point, summary['total'], point_ledger.ONLINE_STORE_ID,
+        'buy')
+    with tracing.span('addPoint'):
+        user_info = user_info_table_controller.add_point(
+            user_id, add_point, expiration_date, ledger)
 
-    # メッセージ送信
-    oa_channel_access_token = CHANNEL_ACCESS_TOKEN
-    send_message.send_push_message(
-        oa_channel_access_token, user_id, product_info, language, liffId)
+    # メッセージ送信(送信キューに追加し、送信完了を待たずに返却する)
+    with tracing.span('makeReceipt'):
+        receipt = send_message.make_receipt_message(summary, language, liffId)
+    with tracing.span('enqueueReceipt'):
+        enqueued = receipt_outbox.enqueue(user_id, receipt)
+    if not enqueued:
+        # ポイントは加算済みのため購入は成功として返却し、未送信を記録する
+        tracing.annotate('receiptDropped', True)
+        logging.getLogger(__name__).warning(
+            'レシートを送信キューに追加できませんでした: %s (累計%s件)',
+            user_id, receipt_outbox.dropped)
 
     return user_info
 
@@ -0,0 +1,216 @@
+"""
+会員データの読み取りキャッシュモジュール
+
+MembersCardUserInfoの前段に置き、get_itemの結果を短時間キャッシュする。
+更新系メソッドを呼び出した場合はキャッシュを更新または削除する。
+"""
+import os
+import time
+import threading
+from common.cache_backends import (
+    InProcessCacheBackend, RedisCacheBackend, FakeRedis)
+from members_card_user_info import VERSION_FIELD
+
+# 環境変数の宣言
+# memory: プロセス内 / redis: Redis互換ストア / fake: テスト用インメモリRedis / none: キャッシュしない
+PROFILE_CACHE_BACKEND = os.getenv('PROFILE_CACHE_BACKEND', 'memory')
+PROFILE_CACHE_TTL = float(os.getenv('PROFILE_CACHE_TTL', '30'))
+PROFILE_CACHE_MAX_BYTES = int(
+    os.getenv('PROFILE_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+
+def create_cache_backend(name=PROFILE_CACHE_BACKEND):
+    """
+    設定に応じたキャッシュバックエンドを作成する
+
+    Parameters
+    ----------
+    name : str
+        memory, redis, fake, none のいずれか
+
+    Returns
+    -------
+    backend : obj
+        キャッシュバックエンド。noneの場合はNone
+    """
+    if name == 'memory':
+        return InProcessCacheBackend(max_bytes=PROFILE_CACHE_MAX_BYTES)
+    if name == 'redis':
+        return RedisCacheBackend.from_url(REDIS_URL)
+    if name == 'fake':
+        return RedisCacheBackend(FakeRedis())
+    if name == 'none':
+        return None
+    raise ValueError('未対応のキャッシュバックエンドです: %s' % name)
+
+
+class CachedMembersCardUserInfo:
+    """キャッシュ付きMembersCardUserInfo操作用クラス"""
+    __slots__ = ['_table', '_backend', '_ttl', '_lock',
+                 'hits', 'misses', '_hit_seconds', '_miss_seconds']
+
+    def __init__(self, table, backend, ttl=PROFILE_CACHE_TTL):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        table : MembersCardUserInfo
+            キャッシュ対象のテーブル操作クラス
+        backend : obj
+            キャッシュバックエンド
+        ttl : float
+            キャッシュの有効期間(秒)
+        """
+        self._table = table
+        self._backend = backend
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._hit_seconds = 0.0
+        self._miss_seconds = 0.0
+
+    def __getattr__(self, name):
+        # キャッシュ対象外のメソッドはそのまま委譲する
+        return getattr(self._table, name)
+
+    def get_item(self, user_id):
+        """
+        データ取得。キャッシュに無い場合はDBから取得してキャッシュする。
+
+        Parameters
+        ----------
+        user_id : str
+            ユーザーID
+
+        Returns
+        -------
+        item : dict
+            会員ユーザー情報
+        """
+        start = time.perf_counter()
+        item = self._backend.get(user_id)
+        if item is not None:
+            self._record(True, time.perf_counter() - start)
+            return dict(item)
+
+        item = self._table.get_item(user_id)
+        # 未登録ユーザーは直後に作成されるためキャッシュしない
+        if item is not None:
+            self._backend.set(user_id, item, self._ttl)
+            item = dict(item)
+        self._record(False, time.perf_counter() - start)
+        return item
+
+    def get_version(self, user_id):
+        """
+        会員データのバージョンを取得する。
+        キャッシュにある場合はキャッシュの会員データのバージョンを返し、コピーを作成しない。
+        無い場合はDBからバージョンのみを取得する(会員データはキャッシュしない)。
+
+        Parameters
+        ----------
+        user_id : str
+            ユーザーID
+
+        Returns
+        -------
+        version : str
+            会員データのバージョン。会員データが無い場合はNone
+        """
+        item = self._backend.get(user_id)
+        if item is not None and item.get(VERSION_FIELD) is not None:
+            return item[VERSION_FIELD]
+        return self._table.get_version(user_id)
+
+    def put_item(self, user_id, barcode_num, expiration_date, point):
+        """データ登録し、キャッシュを削除する"""
+        try:
+            return self._table.put_item(
+                user_id, barcode_num, expiration_date, point)
+        finally:
+            self._backend.delete(user_id)
+
+    def update_point_expiration_date(self, user_id, point, expiration_date):
+        """ポイントと期限日を更新し、キャッシュを削除する"""
+        try:
+            return self._table.update_point_expiration_date(
+                user_id, point, expiration_date)
+        finally:
+            self._backend.delete(user_id)
+
+    def add_point(self, user_id, add_point, expiration_date, ledger=None):
+        """ポイントを加算し、更新後のデータでキャッシュを置き換える"""
+        try:
+            item = self._table.add_point(
+                user_id, add_point, expiration_date, ledger)
+        except Exception:
+            self._backend.delete(user_id)
+            raise
+        self._backend.set(user_id, item, self._ttl)
+        return dict(item)
+
+    def add_points(self, credits, expiration_date, ledger=()):
+        """複数会員のポイントを加算し、キャッシュを削除する"""
+        try:
+            return self._table.add_points(credits, expiration_date, ledger)
+        finally:
+            for user_id in credits:
+                self._backend.delete(user_id)
+
+    def refresh(self, user_id, item):
+        """
+        他の経路(非同期版のアプリケーション)で更新した会員データでキャッシュを置き換える
+
+        Parameters
+        ----------
+        user_id : str
+            ユーザーID
+        item : dict
+            更新後の会員ユーザー情報
+        """
+        self._backend.set(user_id, item, self._ttl)
+
+    def invalidate(self, user_id):
+        """
+        他の経路(非同期版のアプリケーション)で更新した会員データのキャッシュを削除する
+
+        Parameters
+        ----------
+        user_id : str
+            ユーザーID
+        """
+        self._backend.delete(user_id)
+
+    def _record(self, hit, seconds):
+        """ヒット・ミスの件数と所要時間を記録する"""
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self._hit_seconds += seconds
+            else:
+                self.misses += 1
+                self._miss_seconds += seconds
+
+    def stats(self):
+        """
+        キャッシュの統計情報を取得する
+
+        Returns
+        -------
+        stats : dict
+            ヒット率、ヒット時・ミス時の平均所要時間(ミリ秒)、バックエンドの統計情報
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRatio': self.hits / total if total else 0.0,
+            'avgHitMs': self._hit_seconds * 1000 / self.hits
+            if self.hits else 0.0,
+            'avgMissMs': self._miss_seconds * 1000 / self.misses
+            if self.misses else 0.0,
+            'backend': self._backend.stats(),
+        }
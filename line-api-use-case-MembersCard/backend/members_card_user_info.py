@@ -3,22 +3,370 @@ MembersCardUserInfo操作用モジュール
 
 """
 import os
-from datetime import datetime
-from dateutil.tz import gettz
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
+import calendar
+from datetime import datetime, timedelta
+from common.utils import JST
+from point_ledger import add_ledger_writes
+
+
+# 環境変数の宣言
+# firestore: 本番のFirestore / emulator: Firestoreエミュレータ / fake: インメモリ実装
+FIRESTORE_BACKEND = os.getenv('FIRESTORE_BACKEND', 'firestore')
+
+# ポイント期限日の日付単位の索引(PointExpiryIndex/{yyyymmdd}/members/{userId})
+EXPIRY_INDEX_COLLECTION = 'PointExpiryIndex'
+# バーコード番号から会員を引く索引(BarcodeIndex/{barcodeNum})
+BARCODE_INDEX_COLLECTION = 'BarcodeIndex'
+# 会員データに付与するバージョン(ドキュメントの最終更新日時から作成する)のキー
+VERSION_FIELD = 'version'
+
+
+def create_firestore_client(backend=FIRESTORE_BACKEND):
+    """
+    設定に応じたFirestoreクライアントを作成する
+
+    Parameters
+    ----------
+    backend : str
+        firestore, emulator, fake のいずれか
+
+    Returns
+    -------
+    db : google.cloud.firestore.Client
+        Firestoreクライアント
+    """
+    if backend == 'firestore':
+        # firebase_adminは読み込みに時間がかかるため、クライアント作成時に読み込む
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+        # firebase_adminはアプリごとにFirestoreクライアント(gRPCチャネル)を保持するため、
+        # フォークした子プロセスでは親プロセスのアプリを使用せず、プロセスごとに作成する
+        name = 'members-card-%d' % os.getpid()
+        try:
+            app = firebase_admin.get_app(name)
+        except ValueError:
+            cred = credentials.Certificate("./content/key.json")
+            app = firebase_admin.initialize_app(cred, name=name)
+        return firestore.client(app)
+    if backend == 'emulator':
+        # FIRESTORE_EMULATOR_HOSTが設定されている場合、エミュレータに接続する
+        from google.cloud.firestore import Client
+        return Client(project=os.getenv('GOOGLE_CLOUD_PROJECT', 'demo-members-card'))
+    if backend == 'fake':
+        from common.fake_firestore import FakeFirestoreClient
+        return FakeFirestoreClient(
+            float(os.getenv('FAKE_FIRESTORE_LATENCY_MS', '0')) / 1000)
+    raise ValueError('未対応のFirestoreです: %s' % backend)
+
+
+def create_async_firestore_client(backend=FIRESTORE_BACKEND):
+    """
+    設定に応じた非同期Firestoreクライアントを作成する
+
+    Parameters
+    ----------
+    backend : str
+        firestore, emulator, fake のいずれか
+
+    Returns
+    -------
+    db : google.cloud.firestore.AsyncClient
+        非同期Firestoreクライアント
+    """
+    if backend == 'firestore':
+        from google.cloud.firestore import AsyncClient
+        from google.oauth2 import service_account
+        cred = service_account.Credentials.from_service_account_file(
+            "./content/key.json")
+        return AsyncClient(project=cred.project_id, credentials=cred)
+    if backend == 'emulator':
+        from google.cloud.firestore import AsyncClient
+        return AsyncClient(project=os.getenv('GOOGLE_CLOUD_PROJECT', 'demo-members-card'))
+    if backend == 'fake':
+        from common.fake_firestore import AsyncFakeFirestoreClient
+        return AsyncFakeFirestoreClient(
+            latency=float(os.getenv('FAKE_FIRESTORE_LATENCY_MS', '0')) / 1000)
+    raise ValueError('未対応のFirestoreです: %s' % backend)
+
+def expiry_bucket(expiration_date):
+    """
+    ポイント期限日から索引の日付キーを作成する
+
+    Parameters
+    ----------
+    expiration_date : str
+        '%Y/%m/%d'形式のポイント期限日
+
+    Returns
+    -------
+    bucket : str
+        '%Y%m%d'形式の日付キー
+    """
+    return expiration_date.replace('/', '')
+
+
+def expiration_timestamp(expiration_date):
+    """
+    ポイント期限日からポイントが失効する日時(UNIX時間)を求める。
+    期限日の当日までは有効とし、翌日0時(日本時間)に失効する。
+
+    Parameters
+    ----------
+    expiration_date : str
+        '%Y/%m/%d'形式のポイント期限日
+
+    Returns
+    -------
+    timestamp : int
+        失効日時のUNIX時間(秒)
+    """
+    day = datetime.strptime(expiration_date, '%Y/%m/%d').replace(
+        tzinfo=JST)
+    return int((day + timedelta(days=1)).timestamp())
+
+
+def expiry_bucket_ref(db, expiration_date):
+    """
+    ポイント期限日の索引のうち、指定した期限日のコレクションの参照を取得する
+
+    Parameters
+    ----------
+    db : google.cloud.firestore.Client
+        Firestoreクライアント
+    expiration_date : str
+        '%Y/%m/%d'形式のポイント期限日
+
+    Returns
+    -------
+    reference : CollectionReference
+        期限日のコレクションの参照
+    """
+    return db.collection(EXPIRY_INDEX_COLLECTION).document(
+        expiry_bucket(expiration_date)).collection('members')
+
+
+def expiry_index_ref(db, expiration_date, user_id):
+    """
+    ポイント期限日の索引ドキュメントの参照を取得する
+
+    Parameters
+    ----------
+    db : google.cloud.firestore.Client
+        Firestoreクライアント
+    expiration_date : str
+        '%Y/%m/%d'形式のポイント期限日
+    user_id : str
+        ユーザーID
+
+    Returns
+    -------
+    reference : DocumentReference
+        索引ドキュメントの参照
+    """
+    return expiry_bucket_ref(db, expiration_date).document(user_id)
+
+
+def barcode_index_ref(db, barcode_num):
+    """
+    バーコード番号の索引ドキュメントの参照を取得する
+
+    Parameters
+    ----------
+    db : google.cloud.firestore.Client
+        Firestoreクライアント
+    barcode_num : int
+        バーコード番号
+
+    Returns
+    -------
+    reference : DocumentReference
+        索引ドキュメントの参照
+    """
+    return db.collection(BARCODE_INDEX_COLLECTION).document(str(barcode_num))
+
+
+def document_version(update_time):
+    """
+    ドキュメントの最終更新日時からバージョンを作成する
+
+    Parameters
+    ----------
+    update_time : datetime
+        ドキュメントの最終更新日時(DatetimeWithNanosecondsの場合はナノ秒まで使用する)
+
+    Returns
+    -------
+    version : str
+        UNIX時間(ナノ秒)の16進数表記。最終更新日時が無い場合はNone
+    """
+    if update_time is None:
+        return None
+    nanos = getattr(update_time, 'nanosecond', None)
+    if nanos is None:
+        nanos = update_time.microsecond * 1000
+    return '%x' % (calendar.timegm(update_time.utctimetuple()) * 10 ** 9
+                   + nanos)
+
+
+def versioned_item(doc):
+    """
+    ドキュメントのスナップショットから、バージョンを付与した会員データを作成する
+
+    Parameters
+    ----------
+    doc : DocumentSnapshot
+        会員データのスナップショット
+
+    Returns
+    -------
+    item : dict
+        会員ユーザー情報。ドキュメントが存在しない場合はNone
+    """
+    if not doc.exists:
+        return None
+    item = doc.to_dict()
+    item[VERSION_FIELD] = document_version(doc.update_time)
+    return item
+
+
+def point_expiration_date():
+    """
+    本日購入した場合のポイント期限日(1年後)を取得する
+
+    Returns
+    -------
+    expiration_date : str
+        '%Y/%m/%d'形式のポイント期限日
+    """
+    from dateutil.relativedelta import relativedelta
+    today = datetime.now(JST)
+    return (today + relativedelta(years=1)).strftime('%Y/%m/%d')
+
+
+def increment(value):
+    """
+    数値フィールドをサーバー側で加算する値を作成する
+
+    Parameters
+    ----------
+    value : int
+        加算する値
+
+    Returns
+    -------
+    increment : google.cloud.firestore.Increment
+        加算を表す値
+    """
+    from google.cloud.firestore import Increment
+    return Increment(value)
+
+def add_member_writes(db, batch, user_id, barcode_num, expiration_date,
+                      point):
+    """
+    会員データの登録と、バーコード番号の索引の作成をバッチに追加する。
+    会員データと索引は作成のみ許可し、他のインスタンスが同じ会員を同時に登録した場合や
+    番号が重複した場合は登録全体を失敗させる(AlreadyExists)。
+
+    Parameters
+    ----------
+    db : google.cloud.firestore.Client
+        Firestoreクライアント
+    batch : WriteBatch
+        書き込みバッチ
+    user_id : str
+        ユーザーID
+    barcode_num : int
+        バーコード番号
+    expiration_date : str
+        ポイント期限日
+    point : int
+        ポイント
+    """
+    now = datetime.now(JST).strftime("%Y/%m/%d %H:%M:%S")
+    batch.create(db.collection('MembersCardUserInfo').document(user_id), {
+        'userId': user_id,
+        'barcodeNum': barcode_num,
+        'pointExpirationDate': expiration_date,
+        'pointExpirationAt': expiration_timestamp(expiration_date)
+        if expiration_date else None,
+        'point': point,
+        'createdTime': now,
+        'updatedTime': now,
+    })
+    batch.create(barcode_index_ref(db, barcode_num), {'userId': user_id})
+
+
+def is_already_exists(error):
+    """
+    作成対象のドキュメントが既に存在したことによる例外か判定する
+
+    Parameters
+    ----------
+    error : Exception
+        書き込み時の例外
+
+    Returns
+    -------
+    bool
+        AlreadyExists(またはConflict)の場合True
+    """
+    return type(error).__name__ in ('AlreadyExists', 'Conflict')
+
+
+def add_expiration_writes(db, batch, user_ref, fields, user_id,
+                          expiration_date):
+    """
+    会員データの更新と、ポイント期限日の索引の登録をバッチに追加する。
+    期限日が変わった場合の旧索引は、失効処理の際に会員データと照合して削除する。
+
+    Parameters
+    ----------
+    db : google.cloud.firestore.Client
+        Firestoreクライアント
+    batch : WriteBatch
+        書き込みバッチ
+    user_ref : DocumentReference
+        会員データの参照
+    fields : dict
+        期限日以外の更新内容
+    user_id : str
+        ユーザーID
+    expiration_date : str
+        '%Y/%m/%d'形式のポイント期限日
+    """
+    fields['pointExpirationDate'] = expiration_date
+    if not expiration_date:
+        fields['pointExpirationAt'] = None
+        batch.update(user_ref, fields)
+        return
+    expires_at = expiration_timestamp(expiration_date)
+    fields['pointExpirationAt'] = expires_at
+    batch.update(user_ref, fields)
+    batch.set(expiry_index_ref(db, expiration_date, user_id), {
+        'userId': user_id,
+        'pointExpirationAt': expires_at,
+    })
 
 
 class MembersCardUserInfo:
     """MembersCardUserInfo操作用クラス"""
     __slots__ = ['_db']
 
-    def __init__(self):
-        """初期化メソッド"""
-        cred = credentials.Certificate("./content/key.json")
-        app = firebase_admin.initialize_app(cred)
-        self._db = firestore.client()
+    def __init__(self, db=None):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        db : google.cloud.firestore.Client, optional
+            Firestoreクライアント。指定が無い場合は設定に応じて作成する。
+        """
+        self._db = db if db is not None else create_firestore_client()
+
+    @property
+    def db(self):
+        """Firestoreクライアント"""
+        return self._db
     
     def put_item(self, user_id, barcode_num, expiration_date, point):
         """
@@ -38,26 +386,47 @@ class MembersCardUserInfo:
         Returns
         -------
         response : dict
-            レスポンス情報
+            レスポンス情報(versionに登録した会員データのバージョン)
 
         """
-        item = {
-            'userId': user_id,
-            'barcodeNum': barcode_num,
-            'pointExpirationDate': expiration_date,
-            'point': point,
-            'createdTime': datetime.now(
-                gettz('Asia/Tokyo')).strftime("%Y/%m/%d %H:%M:%S"),
-            'updatedTime': datetime.now(
-                gettz('Asia/Tokyo')).strftime("%Y/%m/%d %H:%M:%S"),
-        }
-
         try:
-            doc_ref = self._db.collection('MembersCardUserInfo').document(user_id)
-            doc_ref.set(item)
+            batch = self._db.batch()
+            add_member_writes(self._db, batch, user_id, barcode_num,
+                              expiration_date, point)
+            # 書き込み結果はバッチへの追加順で、先頭が会員データとなる
+            results = batch.commit()
         except Exception as e:
             raise e        
-        return {'result': 'success'}
+        return {'result': 'success',
+                VERSION_FIELD: document_version(results[0].update_time)}
+
+    def find_user_id_by_barcode(self, barcode_num):
+        """
+        バーコード番号から会員のユーザーIDを取得する。
+        索引が無い会員(索引の導入前に登録された会員)は会員データを検索し、索引を登録する。
+
+        Parameters
+        ----------
+        barcode_num : int
+            バーコード番号
+
+        Returns
+        -------
+        user_id : str
+            ユーザーID。該当する会員がいない場合はNone
+        """
+        index_ref = barcode_index_ref(self._db, barcode_num)
+        doc = index_ref.get()
+        if doc.exists:
+            return doc.to_dict()['userId']
+        docs = list(self._db.collection('MembersCardUserInfo').where(
+            'barcodeNum', '==', int(barcode_num)).limit(1).stream())
+        if not docs:
+            return None
+        user_id = docs[0].id
+        index_ref.set({'userId': user_id})
+        return user_id
+
        
     def update_point_expiration_date(self, user_id, point, expiration_date):
         """
@@ -80,16 +449,81 @@ class MembersCardUserInfo:
         """
         user_ref = self._db.collection('MembersCardUserInfo').document(user_id)
         try:
-            response = user_ref.update({
+            batch = self._db.batch()
+            add_expiration_writes(self._db, batch, user_ref, {
                 'point': point,
-                'pointExpirationDate': expiration_date,
                 'updatedTime': datetime.now(
-                    gettz('Asia/Tokyo')).strftime("%Y/%m/%d %H:%M:%S")
-            })
+                    JST).strftime("%Y/%m/%d %H:%M:%S")
+            }, user_id, expiration_date)
+            response = batch.commit()
         except Exception as e:
             raise e
         return response
         
+    def add_point(self, user_id, add_point, expiration_date, ledger=None):
+        """
+        ポイントを加算し、期限日を更新する。
+        ポイントはサーバー側でアトミックに加算するため、同時に購入された場合も失われない。
+
+        Parameters
+        ----------
+        user_id : str
+            ユーザーID
+        add_point : int
+            加算するポイント
+        expiration_date : str
+            ポイント期限日
+        ledger : dict, optional
+            同じバッチで取引台帳に追記する取引
+
+        Returns
+        -------
+        item : dict
+            更新後の会員ユーザー情報(versionにバージョンを付与する)
+
+        """
+        user_ref = self._db.collection('MembersCardUserInfo').document(user_id)
+        try:
+            batch = self._db.batch()
+            add_expiration_writes(self._db, batch, user_ref, {
+                'point': increment(add_point),
+                'updatedTime': datetime.now(
+                    JST).strftime("%Y/%m/%d %H:%M:%S")
+            }, user_id, expiration_date)
+            if ledger is not None:
+                add_ledger_writes(self._db, batch, [ledger])
+            batch.commit()
+            item = versioned_item(user_ref.get())
+        except Exception as e:
+            raise e
+        return item
+
+    def add_points(self, credits, expiration_date, ledger=()):
+        """
+        複数会員のポイントを1回のバッチでまとめて加算し、期限日を更新する。
+
+        Parameters
+        ----------
+        credits : dict
+            ユーザーIDをキーとした加算するポイント
+        expiration_date : str
+            ポイント期限日
+        ledger : list, optional
+            同じバッチで取引台帳に追記する取引。
+            会員数の2倍と取引数の合計が500件以下になるように指定する
+        """
+        now = datetime.now(JST).strftime("%Y/%m/%d %H:%M:%S")
+        batch = self._db.batch()
+        for user_id, add_point in credits.items():
+            user_ref = self._db.collection('MembersCardUserInfo').document(
+                user_id)
+            add_expiration_writes(self._db, batch, user_ref, {
+                'point': increment(add_point),
+                'updatedTime': now,
+            }, user_id, expiration_date)
+        add_ledger_writes(self._db, batch, ledger)
+        batch.commit()
+
     def get_item(self, user_id):
         """
         データ取得
@@ -102,17 +536,149 @@ class MembersCardUserInfo:
         Returns
         -------
         item : dict
-            会員ユーザー情報
+            会員ユーザー情報(versionにバージョンを付与する)
 
         """
         doc_ref = self._db.collection('MembersCardUserInfo').document(user_id)
 
         try:
             doc = doc_ref.get()
-            if doc.exists:
-                item = doc.to_dict()
-            else:
-                item = None
+            item = versioned_item(doc)
         except Exception as e:
             raise e
-        return item
\ No newline at end of file
+        return item
+
+    def get_version(self, user_id):
+        """
+        会員データのバージョンのみを取得する(フィールドは読み込まない)
+
+        Parameters
+        ----------
+        user_id : str
+            ユーザーID
+
+        Returns
+        -------
+        version : str
+            会員データのバージョン。会員データが無い場合はNone
+        """
+        doc = self._db.collection('MembersCardUserInfo').document(
+            user_id).get(field_paths=[])
+        return document_version(doc.update_time) if doc.exists else None
+
+
+class AsyncMembersCardUserInfo:
+    """MembersCardUserInfo操作用クラス(非同期版)"""
+    __slots__ = ['_db']
+
+    def __init__(self, db):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        db : google.cloud.firestore.AsyncClient
+            非同期Firestoreクライアント
+        """
+        self._db = db
+
+    @property
+    def db(self):
+        """非同期Firestoreクライアント"""
+        return self._db
+
+    async def get_item(self, user_id):
+        """
+        データ取得
+
+        Parameters
+        ----------
+        user_id : str
+            ユーザーID
+
+        Returns
+        -------
+        item : dict
+            会員ユーザー情報(versionにバージョンを付与する)
+        """
+        doc = await self._db.collection('MembersCardUserInfo').document(
+            user_id).get()
+        return versioned_item(doc)
+
+    async def get_version(self, user_id):
+        """
+        会員データのバージョンのみを取得する(フィールドは読み込まない)
+
+        Parameters
+        ----------
+        user_id : str
+            ユーザーID
+
+        Returns
+        -------
+        version : str
+            会員データのバージョン。会員データが無い場合はNone
+        """
+        doc = await self._db.collection('MembersCardUserInfo').document(
+            user_id).get(field_paths=[])
+        return document_version(doc.update_time) if doc.exists else None
+
+    async def put_item(self, user_id, barcode_num, expiration_date, point):
+        """
+        データ登録
+
+        Parameters
+        ----------
+        user_id : str
+            ユーザーID
+        barcode_num : int
+            バーコード番号
+        expiration_date : str
+            ポイント期限日
+        point : int
+            ポイント
+
+        Returns
+        -------
+        response : dict
+            レスポンス情報(versionに登録した会員データのバージョン)
+        """
+        batch = self._db.batch()
+        add_member_writes(self._db, batch, user_id, barcode_num,
+                          expiration_date, point)
+        results = await batch.commit()
+        return {'result': 'success',
+                VERSION_FIELD: document_version(results[0].update_time)}
+
+    async def add_point(self, user_id, add_point, expiration_date,
+                        ledger=None):
+        """
+        ポイントを加算し、期限日を更新する。
+
+        Parameters
+        ----------
+        user_id : str
+            ユーザーID
+        add_point : int
+            加算するポイント
+        expiration_date : str
+            ポイント期限日
+        ledger : dict, optional
+            同じバッチで取引台帳に追記する取引
+
+        Returns
+        -------
+        item : dict
+            更新後の会員ユーザー情報(versionにバージョンを付与する)
+        """
+        user_ref = self._db.collection('MembersCardUserInfo').document(user_id)
+        batch = self._db.batch()
+        add_expiration_writes(self._db, batch, user_ref, {
+            'point': increment(add_point),
+            'updatedTime': datetime.now(
+                JST).strftime("%Y/%m/%d %H:%M:%S")
+        }, user_id, expiration_date)
+        if ledger is not None:
+            add_ledger_writes(self._db, batch, [ledger])
+        await batch.commit()
+        return versioned_item(await user_ref.get())
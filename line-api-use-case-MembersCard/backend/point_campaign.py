@@ -0,0 +1,438 @@
+"""
+ポイントキャンペーンのバッチジョブ
+
+会員IDをファイルまたはFirestoreのクエリから読み込み、Firestoreのバッチ書き込みの
+上限件数ごとにまとめてポイントを加算する。バッチは並列にコミットし、
+完了したバッチをチェックポイントファイルに記録するため、中断後に再開できる。
+
+クエリで対象を選ぶ場合は、書き込みを始める前に全ての会員IDを取得してファイルに固定する
+(加算で更新日時が変わった会員を再度取得しないため)。再開時は固定したファイルを読み込むため、
+チェックポイントのバッチの連番は同じ会員を指す。
+会員ごとの完了マーカー(PointCampaigns/{キャンペーンID}/members/{会員ID})を
+加算と同じバッチで作成するため、コミット済みの会員を再実行しても二重に加算されない。
+
+使い方(backendディレクトリで実行):
+    python point_campaign.py --campaign-id 2021-03-visit --points 500 \\
+        --updated-from "2021/03/01" --updated-to "2021/04/01"
+    python point_campaign.py --campaign-id test --points 500 \\
+        --ids-file members.txt --firestore fake
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from common.utils import JST
+from members_card_user_info import (
+    create_firestore_client, increment, is_already_exists)
+
+# Firestoreのバッチ書き込みの上限件数
+MAX_BATCH_WRITES = 500
+# 1会員あたりポイントの加算と完了マーカーの作成の2件を書き込む
+WRITES_PER_MEMBER = 2
+# 1バッチあたりの会員数
+DEFAULT_BATCH_SIZE = MAX_BATCH_WRITES // WRITES_PER_MEMBER
+# バッチのコミットの最大試行回数
+MAX_ATTEMPTS = 5
+# 進捗を出力する間隔(秒)
+REPORT_INTERVAL = 10
+
+COLLECTION = 'MembersCardUserInfo'
+
+logger = logging.getLogger(__name__)
+
+
+def read_ids_file(path):
+    """
+    ファイルから会員IDを1行ずつ読み込む
+
+    Parameters
+    ----------
+    path : str
+        1行に1件の会員IDを記載したファイルのパス
+
+    Yields
+    ------
+    user_id : str
+        会員ID
+    """
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            user_id = line.strip()
+            if user_id:
+                yield user_id
+
+
+def query_ids(db, updated_from=None, updated_to=None, page_size=1000):
+    """
+    Firestoreのクエリで会員IDを順に取得する。
+    updatedTimeは'%Y/%m/%d %H:%M:%S'形式の文字列のため、文字列の範囲で絞り込む。
+
+    Parameters
+    ----------
+    db : google.cloud.firestore.Client
+        Firestoreクライアント
+    updated_from : str, optional
+        更新日時の下限(この値を含む)
+    updated_to : str, optional
+        更新日時の上限(この値を含まない)
+    page_size : int
+        1回のクエリで取得する件数
+
+    Yields
+    ------
+    user_id : str
+        会員ID
+    """
+    query = db.collection(COLLECTION)
+    order = '__name__'
+    if updated_from:
+        query = query.where('updatedTime', '>=', updated_from)
+        order = 'updatedTime'
+    if updated_to:
+        query = query.where('updatedTime', '<', updated_to)
+        order = 'updatedTime'
+    query = query.order_by(order).select([order] if order != '__name__'
+                                         else [])
+
+    last = None
+    while True:
+        page = query.limit(page_size)
+        if last is not None:
+            page = page.start_after(last)
+        docs = list(page.stream())
+        for doc in docs:
+            yield doc.id
+        if len(docs) < page_size:
+            return
+        last = docs[-1]
+
+
+def freeze_ids(user_ids, path):
+    """
+    会員IDを全て取得してファイルに保存し、保存したファイルから読み込む。
+    ファイルが既に存在する場合(再開時)は取得せずにファイルを読み込む。
+
+    Parameters
+    ----------
+    user_ids : iterable
+        会員IDのイテラブル(クエリ等)
+    path : str
+        保存するファイルのパス
+
+    Returns
+    -------
+    user_ids : iterator
+        保存した会員ID
+    """
+    if not os.path.exists(path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for user_id in user_ids:
+                f.write(user_id + '\n')
+        os.replace(tmp_path, path)
+    return read_ids_file(path)
+
+
+def chunked(iterable, size):
+    """
+    イテラブルを指定件数ごとのリストに分割する
+
+    Yields
+    ------
+    chunk : list
+        最大size件のリスト
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Checkpoint:
+    """
+    完了したバッチの連番を記録するチェックポイントクラス
+    連番は固定した会員IDの並び(ファイル)の位置を表すため、会員IDの並びが変わらない場合のみ使用できる。
+    """
+    __slots__ = ['_path', '_lock', 'watermark', 'completed', 'failed']
+
+    def __init__(self, path):
+        """
+        初期化メソッド。ファイルが存在する場合は読み込む。
+
+        Parameters
+        ----------
+        path : str
+            チェックポイントファイルのパス。Noneの場合は保存しない。
+        """
+        self._path = path
+        self._lock = threading.Lock()
+        # watermark以下の連番は全て完了している
+        self.watermark = -1
+        self.completed = set()
+        self.failed = set()
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+            self.watermark = data['watermark']
+            self.completed = set(data['completed'])
+
+    def is_done(self, seq):
+        """連番のバッチが完了済みか判定する"""
+        return seq <= self.watermark or seq in self.completed
+
+    def mark_done(self, seq):
+        """連番のバッチを完了として記録する"""
+        with self._lock:
+            self.completed.add(seq)
+            while self.watermark + 1 in self.completed:
+                self.watermark += 1
+                self.completed.discard(self.watermark)
+            self._save()
+
+    def mark_failed(self, seq):
+        """連番のバッチを失敗として記録する"""
+        with self._lock:
+            self.failed.add(seq)
+
+    def _save(self):
+        """チェックポイントファイルを書き換える(ロック取得済みで呼び出す)"""
+        if not self._path:
+            return
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'watermark': self.watermark,
+                       'completed': sorted(self.completed)}, f)
+        os.replace(tmp_path, self._path)
+
+
+class PointCampaignJob:
+    """ポイントキャンペーンのバッチジョブクラス"""
+
+    def __init__(self, db, campaign_id, points, checkpoint,
+                 batch_size=DEFAULT_BATCH_SIZE, workers=8):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        db : google.cloud.firestore.Client
+            Firestoreクライアント
+        campaign_id : str
+            キャンペーンID
+        points : int
+            会員ごとに加算するポイント
+        checkpoint : Checkpoint
+            チェックポイント
+        batch_size : int
+            1バッチあたりの会員数(最大250)
+        workers : int
+            並列にコミットするバッチ数
+        """
+        if not 0 < batch_size <= MAX_BATCH_WRITES // WRITES_PER_MEMBER:
+            raise ValueError('batch_sizeは1〜%sです' % (
+                MAX_BATCH_WRITES // WRITES_PER_MEMBER))
+        self._db = db
+        self._campaign_ref = db.collection('PointCampaigns').document(
+            campaign_id)
+        self._points = points
+        self._checkpoint = checkpoint
+        self._batch_size = batch_size
+        self._workers = workers
+        self._lock = threading.Lock()
+        self.credited = 0
+        self.skipped = 0
+        self.already_credited = 0
+
+    def run(self, user_ids):
+        """
+        ジョブを実行する
+
+        Parameters
+        ----------
+        user_ids : iterable
+            会員IDのイテラブル
+
+        Returns
+        -------
+        report : dict
+            処理件数とスループット
+        """
+        start = time.monotonic()
+        last_report = start
+        # 読み込みが書き込みより先行しすぎないよう、実行中のバッチ数を制限する
+        slots = threading.BoundedSemaphore(self._workers * 2)
+
+        def submit(seq, chunk):
+            try:
+                self._commit(seq, chunk)
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(self._workers) as executor:
+            for seq, chunk in enumerate(chunked(user_ids, self._batch_size)):
+                if self._checkpoint.is_done(seq):
+                    continue
+                slots.acquire()
+                executor.submit(submit, seq, chunk)
+                now = time.monotonic()
+                if now - last_report >= REPORT_INTERVAL:
+                    last_report = now
+                    logger.info('%s件処理済み (%.1f docs/sec)', self.credited,
+                                self.credited / (now - start))
+
+        elapsed = time.monotonic() - start
+        report = {
+            'credited': self.credited,
+            'skipped': self.skipped,
+            'alreadyCredited': self.already_credited,
+            'failedBatches': sorted(self._checkpoint.failed),
+            'seconds': round(elapsed, 3),
+            'docsPerSec': round(self.credited / elapsed, 1) if elapsed else 0,
+        }
+        logger.info('ジョブが完了しました: %s', report)
+        return report
+
+    def _commit(self, seq, user_ids):
+        """
+        1バッチ分のポイントを加算する
+
+        Parameters
+        ----------
+        seq : int
+            バッチの連番
+        user_ids : list
+            会員IDのリスト
+        """
+        delay = 0.5
+        attempts = 0
+        races = 0
+        while True:
+            try:
+                pending, credited, missing = self._pending(user_ids)
+                self._write(pending)
+                with self._lock:
+                    self.credited += len(pending)
+                    self.already_credited += credited
+                    self.skipped += missing
+                self._checkpoint.mark_done(seq)
+                return
+            except Exception as e:
+                if (is_already_exists(e) or type(e).__name__ == 'NotFound') \
+                        and races < len(user_ids):
+                    # 他の実行が加算した会員、または削除された会員を除いて再実行する。
+                    # 再実行のたびに対象の会員が減るため、試行回数には数えない
+                    races += 1
+                    continue
+                attempts += 1
+                if attempts >= MAX_ATTEMPTS:
+                    logger.exception('バッチ%sのコミットに失敗しました', seq)
+                    self._checkpoint.mark_failed(seq)
+                    return
+                time.sleep(delay)
+                delay *= 2
+
+    def _pending(self, user_ids):
+        """
+        加算が必要な会員を取得する。
+        完了マーカーがある会員(加算済み)と、会員データが無い会員を除く。
+
+        Parameters
+        ----------
+        user_ids : list
+            会員IDのリスト
+
+        Returns
+        -------
+        pending : list
+            (会員ドキュメントの参照, 完了マーカーの参照)のリスト
+        credited : int
+            加算済みの会員数
+        missing : int
+            会員データが無い会員数
+        """
+        markers = self._campaign_ref.collection('members')
+        # 同じ会員IDが重複して指定された場合も1回だけ加算する
+        user_ids = list(dict.fromkeys(user_ids))
+        marker_refs = [markers.document(user_id) for user_id in user_ids]
+        credited = {doc.id for doc in
+                    self._db.get_all(marker_refs, field_paths=[])
+                    if doc.exists}
+        refs = [self._db.collection(COLLECTION).document(user_id)
+                for user_id in user_ids if user_id not in credited]
+        existing = {doc.id for doc in
+                    self._db.get_all(refs, field_paths=[]) if doc.exists}
+        pending = [(ref, markers.document(ref.id)) for ref in refs
+                   if ref.id in existing]
+        return pending, len(credited), len(refs) - len(existing)
+
+    def _write(self, pending):
+        """
+        ポイントの加算と会員ごとの完了マーカーを1つのバッチでコミットする。
+        完了マーカーは作成のみ許可するため、加算済みの会員を含む場合はバッチ全体が失敗する。
+
+        Parameters
+        ----------
+        pending : list
+            (会員ドキュメントの参照, 完了マーカーの参照)のリスト
+        """
+        if not pending:
+            return
+        now = datetime.now(JST).strftime("%Y/%m/%d %H:%M:%S")
+        batch = self._db.batch()
+        for ref, marker_ref in pending:
+            batch.update(ref, {
+                'point': increment(self._points),
+                'updatedTime': now,
+            })
+            batch.create(marker_ref, {'point': self._points,
+                                      'createdTime': now})
+        batch.commit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ポイントキャンペーンのバッチジョブ')
+    parser.add_argument('--campaign-id', required=True, help='キャンペーンID')
+    parser.add_argument('--points', type=int, required=True, help='加算するポイント')
+    parser.add_argument('--ids-file', help='会員IDを1行に1件記載したファイル')
+    parser.add_argument('--updated-from', help='対象会員の更新日時の下限(yyyy/MM/dd)')
+    parser.add_argument('--updated-to', help='対象会員の更新日時の上限(yyyy/MM/dd、含まない)')
+    parser.add_argument('--checkpoint', help='チェックポイントファイルのパス')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--firestore', default=None,
+                        help='firestore, emulator, fake のいずれか')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    db = create_firestore_client(args.firestore) if args.firestore \
+        else create_firestore_client()
+    checkpoint_path = args.checkpoint or \
+        'point_campaign_%s.json' % args.campaign_id
+    checkpoint = Checkpoint(checkpoint_path)
+
+    if args.ids_file:
+        user_ids = read_ids_file(args.ids_file)
+    else:
+        # 書き込みを始める前に対象の会員を固定する(再開時は固定済みのファイルを使用する)
+        user_ids = freeze_ids(
+            query_ids(db, args.updated_from, args.updated_to),
+            checkpoint_path + '.ids')
+
+    job = PointCampaignJob(db, args.campaign_id, args.points, checkpoint,
+                           args.batch_size, args.workers)
+    report = job.run(user_ids)
+    print(json.dumps(report, ensure_ascii=False))
+    return 1 if report['failedBatches'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,248 @@
+"""
+ポイント加算のまとめ書きモジュール
+
+POSレジから短時間に届いた取引を一定時間(ウィンドウ)ためて、同じ会員の取引は
+1回の加算に、複数の会員は1回のバッチ書き込みにまとめてFirestoreに反映する。
+取引台帳には取引ごとに1件ずつ、ポイントの加算と同じバッチで追記する。
+取引ごとの結果はFutureで呼び出し元に返す。
+同じ店舗ID・取引IDの取引は1回のみ加算し、再送された取引は加算済みとして扱う。
+"""
+import os
+import time
+import logging
+import threading
+from concurrent.futures import Future
+import point_ledger
+from members_card_user_info import is_already_exists
+
+# 環境変数の宣言
+POS_COALESCE_WINDOW_MS = float(os.getenv('POS_COALESCE_WINDOW_MS', '50'))
+
+# Firestoreのバッチ書き込みの上限件数
+MAX_BATCH_WRITES = 500
+# 1会員あたり会員データの更新と期限日の索引の登録の2件を書き込む
+WRITES_PER_MEMBER = 2
+
+logger = logging.getLogger(__name__)
+
+
+class PointCoalescer:
+    """会員ごとにポイント加算をまとめて書き込むクラス"""
+    __slots__ = ['_table', '_window', '_max_writes', '_pending', '_ready',
+                 '_transactions', '_cond', '_thread', '_stopping', 'flushes',
+                 'writes', 'duplicates']
+
+    def __init__(self, table, window=POS_COALESCE_WINDOW_MS / 1000,
+                 max_writes=MAX_BATCH_WRITES):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        table : MembersCardUserInfo
+            テーブル操作クラス
+        window : float
+            取引をためる時間(秒)
+        max_writes : int
+            1回のバッチの書き込み件数
+        """
+        self._table = table
+        self._window = window
+        self._max_writes = max_writes
+        # (期限日, ユーザーID)をキーとした[加算ポイント, (Future, ポイント, 取引)のリスト]
+        self._pending = {}
+        # 1回のバッチに収まる上限まで取引がたまった((期限日, ユーザーID), 加算)のリスト
+        self._ready = []
+        # 書き込み待ちのPOSレジの取引の(店舗ID, 取引ID) -> Future
+        self._transactions = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self.flushes = 0
+        self.writes = 0
+        # 加算済みのため書き込まなかった取引の件数
+        self.duplicates = 0
+
+    def submit(self, user_id, points, expiration_date, ledger=None):
+        """
+        ポイント加算を登録する
+
+        Parameters
+        ----------
+        user_id : str
+            ユーザーID
+        points : int
+            加算するポイント
+        expiration_date : str
+            ポイント期限日
+        ledger : dict, optional
+            取引台帳に追記する取引
+
+        Returns
+        -------
+        future : Future
+            書き込みが完了すると結果が設定される。
+            同じ店舗ID・取引IDの取引が書き込み待ちの場合はそのFutureを返す
+        """
+        transaction = (ledger['storeId'], ledger['transactionId']) \
+            if ledger is not None and ledger.get('transactionId') is not None \
+            else None
+        with self._cond:
+            if transaction is not None and transaction in self._transactions:
+                self.duplicates += 1
+                return self._transactions[transaction]
+            if self._thread is None:
+                self._start()
+            future = Future()
+            key = (expiration_date, user_id)
+            entry = self._pending.get(key)
+            if entry is not None and \
+                    len(entry[1]) * point_ledger.MAX_WRITES_PER_ENTRY >= \
+                    self._max_writes - WRITES_PER_MEMBER:
+                # 1回のバッチに収まらないため、別の加算として書き込む
+                self._ready.append((key, self._pending.pop(key)))
+                entry = None
+            if entry is None:
+                entry = self._pending[key] = [0, []]
+            entry[0] += points
+            entry[1].append((future, points, ledger))
+            if transaction is not None:
+                self._transactions[transaction] = future
+            self._cond.notify()
+        return future
+
+    def _start(self):
+        """書き込みスレッドを起動する(ロック取得済みで呼び出す)"""
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, name='point-coalescer', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        """
+        登録済みの加算を書き込み、書き込みスレッドを停止する
+
+        Parameters
+        ----------
+        timeout : float
+            停止を待つ時間(秒)
+        """
+        with self._cond:
+            thread = self._thread
+            if thread is None:
+                return
+            self._stopping = True
+            self._cond.notify()
+        thread.join(timeout)
+        with self._cond:
+            self._thread = None
+
+    def after_fork(self):
+        """
+        フォークした子プロセスで、親プロセスから引き継いだ書き込みスレッドとロックを破棄する。
+        書き込みスレッドは次回の登録時に起動する。
+        """
+        self._pending = {}
+        self._ready = []
+        self._transactions = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def _run(self):
+        """ウィンドウごとに登録済みの加算をまとめて書き込む"""
+        while True:
+            with self._cond:
+                while not self._pending and not self._ready and \
+                        not self._stopping:
+                    self._cond.wait()
+                if not self._pending and not self._ready:
+                    return
+            if not self._stopping:
+                # ウィンドウの間に届いた取引を同じ書き込みにまとめる
+                time.sleep(self._window)
+            with self._cond:
+                pending = self._ready + list(self._pending.items())
+                self._pending = {}
+                self._ready = []
+                # 以降に届いた同じ取引は、取引の記録により加算済みと判定する
+                self._transactions = {}
+            self._flush(pending)
+
+    def _flush(self, pending):
+        """
+        期限日ごとに、書き込み件数がバッチの上限に収まる会員数ずつ書き込む
+
+        Parameters
+        ----------
+        pending : list
+            ((期限日, ユーザーID), [加算ポイント, (Future, ポイント, 取引)のリスト])のリスト
+        """
+        groups = {}
+        for (expiration_date, user_id), entry in pending:
+            groups.setdefault(expiration_date, []).append((user_id, entry))
+        for expiration_date, entries in groups.items():
+            chunk = []
+            writes = 0
+            for user_id, entry in entries:
+                size = WRITES_PER_MEMBER + \
+                    len(entry[1]) * point_ledger.MAX_WRITES_PER_ENTRY
+                if chunk and writes + size > self._max_writes:
+                    self._commit(expiration_date, chunk)
+                    chunk = []
+                    writes = 0
+                chunk.append((user_id, entry))
+                writes += size
+            if chunk:
+                self._commit(expiration_date, chunk)
+        self.flushes += 1
+
+    def _commit(self, expiration_date, entries):
+        """
+        1回のバッチで書き込み、Futureに結果を設定する。
+        バッチが失敗した場合は失敗した会員を特定するため1会員ずつ書き込み直し、
+        取引の記録が既にあった場合は加算済みの取引を特定するため1取引ずつ書き込み直す。
+        """
+        credits = {}
+        ledger = []
+        for user_id, entry in entries:
+            # 上限を超えて分割した同じ会員の加算は1回にまとめる
+            credits[user_id] = credits.get(user_id, 0) + entry[0]
+            ledger.extend(submission[2] for submission in entry[1]
+                          if submission[2] is not None)
+        try:
+            self._table.add_points(credits, expiration_date, ledger)
+            self.writes += 1
+        except Exception as e:
+            if len(entries) > 1:
+                logger.warning(
+                    'バッチでのポイント加算に失敗したため1件ずつ再実行します')
+                for entry in entries:
+                    self._commit(expiration_date, [entry])
+                return
+            user_id, entry = entries[0]
+            if is_already_exists(e) and len(entry[1]) > 1:
+                for submission in entry[1]:
+                    self._commit(expiration_date,
+                                 [(user_id, [submission[1], [submission]])])
+                return
+            if is_already_exists(e) and self._is_recorded(entry[1][0][2]):
+                # POSレジが再送した取引は加算済みとして扱う
+                self.duplicates += 1
+                entry[1][0][0].set_result(True)
+                return
+            logger.exception('ポイントの加算に失敗しました: %s', user_id)
+            for submission in entry[1]:
+                submission[0].set_exception(e)
+            return
+        for _, entry in entries:
+            for submission in entry[1]:
+                submission[0].set_result(True)
+
+    def _is_recorded(self, transaction):
+        """取引が加算済みか確認する。確認できない場合はFalse"""
+        try:
+            return point_ledger.is_recorded(self._table.db, transaction)
+        except Exception:
+            logger.exception('取引の記録を確認できません')
+            return False
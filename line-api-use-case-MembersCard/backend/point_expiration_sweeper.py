@@ -0,0 +1,386 @@
+"""
+ポイント失効のバッチジョブ
+
+ポイント期限日の索引(PointExpiryIndex/{yyyymmdd}/members)から期限日を過ぎた日付の
+会員のみを読み込み、ポイントを0にする。処理済みの日付はPointExpirySweeper/stateに
+記録するため、1日あたりの処理量は会員総数ではなく対象日の会員数に比例する。
+
+索引は期限日が延長されても旧日付のものを残しているため、会員データの
+期限日と一致しない索引は失効させずに削除する。
+
+索引の導入前に登録された会員(pointExpirationAtが無い会員)は索引に含まれないため、
+初回の実行時に全会員を1度だけ走査して索引を作成する(backfill)。
+作成した索引のうち既に処理済みの期限日のものは、同じ実行で失効させる。
+
+使い方(backendディレクトリで実行):
+    python point_expiration_sweeper.py
+    python point_expiration_sweeper.py --backfill
+    python point_expiration_sweeper.py --remind-days 7 --channel-access-token xxxxxxxxxx
+"""
+import sys
+import json
+import logging
+import argparse
+from datetime import datetime, timedelta
+from common.utils import JST
+from members_card_user_info import (
+    create_firestore_client, expiry_bucket_ref, expiry_index_ref,
+    expiration_timestamp)
+
+COLLECTION = 'MembersCardUserInfo'
+# 1会員あたり会員データの更新と索引の削除の2件を書き込むため、500件の半分とする
+MEMBERS_PER_BATCH = 250
+# 索引を読み込む件数
+PAGE_SIZE = 1000
+# 前回の処理日が無い場合に遡る日数
+DEFAULT_LOOKBACK_DAYS = 30
+# 索引の作成(backfill)が完了した日時を記録する状態のフィールド
+BACKFILLED_FIELD = 'indexBackfilledAt'
+
+logger = logging.getLogger(__name__)
+
+
+def daterange(start, end):
+    """
+    startからendの前日までの日付を返す
+
+    Yields
+    ------
+    day : date
+        日付
+    """
+    day = start
+    while day < end:
+        yield day
+        day += timedelta(days=1)
+
+
+def chunked(items, size):
+    """リストを指定件数ごとに分割する"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class PointExpirationSweeper:
+    """ポイント失効のバッチジョブクラス"""
+
+    def __init__(self, db, today=None):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        db : google.cloud.firestore.Client
+            Firestoreクライアント
+        today : date, optional
+            処理日。指定が無い場合は日本時間の当日
+        """
+        self._db = db
+        self.today = today or datetime.now(JST).date()
+        self._state_ref = db.collection('PointExpirySweeper').document(
+            'state')
+        self.report = {'days': 0, 'expired': 0, 'staleIndexes': 0,
+                       'expiredPoints': 0, 'backfilled': 0}
+
+    def due_days(self):
+        """
+        失効処理が必要な期限日(前回処理日の翌日から前日まで)を取得する
+
+        Returns
+        -------
+        days : list
+            期限日のリスト
+        """
+        state = self._state_ref.get()
+        last = state.to_dict().get('lastSweptDay') if state.exists else None
+        if last:
+            start = datetime.strptime(last, '%Y%m%d').date() + \
+                timedelta(days=1)
+        else:
+            start = self.today - timedelta(days=DEFAULT_LOOKBACK_DAYS)
+        return list(daterange(start, self.today))
+
+    def run(self, backfill=False):
+        """
+        期限日を過ぎた会員のポイントを失効させる。
+        索引の作成が完了していない場合は、先に索引を作成する。
+
+        Parameters
+        ----------
+        backfill : bool
+            Trueの場合、完了済みでも索引の作成を再度行う
+
+        Returns
+        -------
+        report : dict
+            処理日数、失効件数、削除した旧索引の件数、失効ポイント数、索引を作成した会員数
+        """
+        days = self.due_days()
+        state = self._state_ref.get()
+        if backfill or not state.exists or \
+                not state.to_dict().get(BACKFILLED_FIELD):
+            # 今回の処理対象より前の期限日の会員は、処理済みの日付のため個別に失効させる
+            start = days[0] if days else self.today
+            for day in sorted(day for day in self.backfill() if day < start):
+                self.sweep_day(day.strftime('%Y/%m/%d'))
+                self.report['days'] += 1
+            self._state_ref.set({BACKFILLED_FIELD: datetime.now(JST).strftime(
+                "%Y/%m/%d %H:%M:%S")}, merge=True)
+        for day in days:
+            self.sweep_day(day.strftime('%Y/%m/%d'))
+            self._state_ref.set({'lastSweptDay': day.strftime('%Y%m%d')},
+                                merge=True)
+            self.report['days'] += 1
+        logger.info('ポイント失効処理が完了しました: %s', self.report)
+        return self.report
+
+    def backfill(self):
+        """
+        索引の導入前に登録された会員(pointExpirationAtが無い会員)の索引を作成する
+
+        Returns
+        -------
+        days : set
+            全会員(索引の作成済みの会員を含む)の期限日。
+            中断後の再実行でも、処理済みの日付の会員を失効させるために使用する。
+        """
+        days = set()
+        for docs in self._member_pages():
+            targets = []
+            for doc in docs:
+                item = doc.to_dict()
+                if not item.get('pointExpirationDate'):
+                    continue
+                days.add(datetime.strptime(
+                    item['pointExpirationDate'], '%Y/%m/%d').date())
+                if item.get('pointExpirationAt') is None:
+                    targets.append(doc)
+            for chunk in chunked(targets, MEMBERS_PER_BATCH):
+                self._index_members(chunk)
+        logger.info('ポイント期限日の索引を作成しました: %s件',
+                    self.report['backfilled'])
+        return days
+
+    def _member_pages(self):
+        """
+        全会員の期限日をページ単位で読み込む
+
+        Yields
+        ------
+        docs : list
+            会員データのスナップショットのリスト
+        """
+        query = self._db.collection(COLLECTION).order_by('__name__').select(
+            ['pointExpirationDate', 'pointExpirationAt']).limit(PAGE_SIZE)
+        last = None
+        while True:
+            page = query.start_after(last) if last is not None else query
+            docs = list(page.stream())
+            if docs:
+                yield docs
+            if len(docs) < PAGE_SIZE:
+                return
+            last = docs[-1]
+
+    def _index_members(self, docs):
+        """
+        会員データにpointExpirationAtを設定し、期限日の索引を作成する
+
+        Parameters
+        ----------
+        docs : list
+            会員データのスナップショットのリスト
+        """
+        batch = self._db.batch()
+        for doc in docs:
+            expiration_date = doc.to_dict()['pointExpirationDate']
+            expires_at = expiration_timestamp(expiration_date)
+            # 読み込み後に期限日が更新された場合に上書きしないよう、更新日時を条件とする
+            batch.update(doc.reference, {'pointExpirationAt': expires_at},
+                         option=self._db.write_option(
+                             last_update_time=doc.update_time))
+            batch.set(expiry_index_ref(self._db, expiration_date, doc.id), {
+                'userId': doc.id,
+                'pointExpirationAt': expires_at,
+            })
+        try:
+            batch.commit()
+        except Exception as e:
+            if type(e).__name__ != 'FailedPrecondition':
+                raise
+            # 処理中に更新された会員がいるため、読み込み直して再実行する
+            logger.info('会員データが更新されたため再実行します')
+            docs = [doc for doc in self._db.get_all(
+                [doc.reference for doc in docs],
+                field_paths=['pointExpirationDate', 'pointExpirationAt'])
+                if doc.exists and doc.to_dict().get('pointExpirationDate')
+                and doc.to_dict().get('pointExpirationAt') is None]
+            if docs:
+                self._index_members(docs)
+            return
+        self.report['backfilled'] += len(docs)
+
+    def sweep_day(self, expiration_date):
+        """
+        指定した期限日の会員のポイントを失効させる
+
+        Parameters
+        ----------
+        expiration_date : str
+            '%Y/%m/%d'形式のポイント期限日
+        """
+        for user_ids in self._index_pages(expiration_date):
+            for chunk in chunked(user_ids, MEMBERS_PER_BATCH):
+                self._expire(expiration_date, chunk)
+
+    def due_members(self, expiration_date):
+        """
+        指定した期限日にポイントが失効する会員を取得する
+
+        Parameters
+        ----------
+        expiration_date : str
+            '%Y/%m/%d'形式のポイント期限日
+
+        Yields
+        ------
+        item : dict
+            会員ユーザー情報
+        """
+        for user_ids in self._index_pages(expiration_date):
+            refs = [self._db.collection(COLLECTION).document(user_id)
+                    for user_id in user_ids]
+            for doc in self._db.get_all(refs):
+                item = doc.to_dict() if doc.exists else None
+                if item and item.get('pointExpirationDate') == \
+                        expiration_date and item.get('point'):
+                    yield item
+
+    def _index_pages(self, expiration_date):
+        """
+        索引から会員IDをページ単位で読み込む
+
+        Yields
+        ------
+        user_ids : list
+            会員IDのリスト
+        """
+        query = expiry_bucket_ref(self._db, expiration_date).order_by(
+            '__name__').select([]).limit(PAGE_SIZE)
+        last = None
+        while True:
+            page = query.start_after(last) if last is not None else query
+            docs = list(page.stream())
+            if docs:
+                yield [doc.id for doc in docs]
+            if len(docs) < PAGE_SIZE:
+                return
+            last = docs[-1]
+
+    def _expire(self, expiration_date, user_ids):
+        """
+        会員データを確認し、ポイントを0にして索引を削除する
+
+        Parameters
+        ----------
+        expiration_date : str
+            '%Y/%m/%d'形式のポイント期限日
+        user_ids : list
+            会員IDのリスト
+        """
+        refs = [self._db.collection(COLLECTION).document(user_id)
+                for user_id in user_ids]
+        now = datetime.now(JST).strftime("%Y/%m/%d %H:%M:%S")
+        batch = self._db.batch()
+        expired = 0
+        points = 0
+        stale = 0
+        for doc in self._db.get_all(refs):
+            batch.delete(expiry_index_ref(self._db, expiration_date, doc.id))
+            item = doc.to_dict() if doc.exists else None
+            if not item or item.get('pointExpirationDate') != expiration_date:
+                # 期限日が延長された会員の旧索引
+                stale += 1
+                continue
+            if item.get('point'):
+                expired += 1
+                points += item['point']
+            # 読み込み後に購入された場合にポイントを失わないよう、更新日時を条件とする
+            batch.update(doc.reference, {
+                'point': 0,
+                'pointExpirationDate': '',
+                'pointExpirationAt': None,
+                'updatedTime': now,
+            }, option=self._db.write_option(last_update_time=doc.update_time))
+        try:
+            batch.commit()
+        except Exception as e:
+            if type(e).__name__ != 'FailedPrecondition':
+                raise
+            # 処理中に更新された会員がいるため、読み込み直して再実行する
+            logger.info('会員データが更新されたため再実行します')
+            return self._expire(expiration_date, user_ids)
+        self.report['expired'] += expired
+        self.report['expiredPoints'] += points
+        self.report['staleIndexes'] += stale
+
+
+def send_reminders(sweeper, expiration_date, channel_access_token):
+    """
+    ポイントが失効する会員にお知らせを一斉送信する
+
+    Parameters
+    ----------
+    sweeper : PointExpirationSweeper
+        ポイント失効のバッチジョブ
+    expiration_date : str
+        '%Y/%m/%d'形式のポイント期限日
+    channel_access_token : str
+        OAのチャネルアクセストークン
+
+    Returns
+    -------
+    report : dict
+        一斉送信の結果
+    """
+    from broadcast import Broadcaster
+    message_json = json.dumps({
+        'type': 'text',
+        'text': '保有ポイントの有効期限は%sです。' % expiration_date,
+    }, ensure_ascii=False)
+    notices = ((item['userId'], message_json)
+               for item in sweeper.due_members(expiration_date))
+    return Broadcaster(channel_access_token).send(notices)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ポイント失効のバッチジョブ')
+    parser.add_argument('--remind-days', type=int,
+                        help='指定した日数後に失効する会員にお知らせを送信する')
+    parser.add_argument('--channel-access-token',
+                        help='お知らせを送信するOAのチャネルアクセストークン')
+    parser.add_argument('--backfill', action='store_true',
+                        help='完了済みでも全会員を走査して期限日の索引を作成する')
+    parser.add_argument('--firestore', default=None,
+                        help='firestore, emulator, fake のいずれか')
+    args = parser.parse_args(argv)
+    if args.remind_days is not None and not args.channel_access_token:
+        parser.error('--remind-daysには--channel-access-tokenが必要です')
+
+    logging.basicConfig(level=logging.INFO)
+    db = create_firestore_client(args.firestore) if args.firestore \
+        else create_firestore_client()
+    sweeper = PointExpirationSweeper(db)
+    report = sweeper.run(args.backfill)
+
+    if args.remind_days is not None:
+        remind_date = (sweeper.today + timedelta(days=args.remind_days)
+                       ).strftime('%Y/%m/%d')
+        report['reminder'] = send_reminders(
+            sweeper, remind_date, args.channel_access_token)
+    print(json.dumps(report, ensure_ascii=False))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,312 @@
+"""
+ポイント取引台帳モジュール
+
+購入によるポイント加算ごとに取引台帳(PointLedger/{entryId})へ1件追記する。
+台帳は会員データの更新と同じバッチで書き込むため、ポイントと台帳が食い違うことはない。
+台帳は追記のみで、更新・削除は行わない。
+
+entryIdは発生日時(ミリ秒)を先頭に付けるため、IDの順に読み込むと発生順になる。
+POSレジの取引は店舗IDと取引IDから決まるID(PosTransactions/{storeId}_{transactionId})にも
+同じバッチで作成のみで記録し、POSレジが再送した取引を二重に加算しない。
+日別・店舗別の集計(LedgerRollups)はledger_aggregatorのバッチジョブが台帳から作成し、
+ダッシュボードは集計済みのドキュメントを日数分だけ読み込む。
+"""
+import time
+import uuid
+from datetime import datetime, timedelta
+from common.utils import JST
+
+LEDGER_COLLECTION = 'PointLedger'
+ROLLUP_COLLECTION = 'LedgerRollups'
+# 加算済みのPOSレジの取引を記録するコレクション
+TRANSACTION_COLLECTION = 'PosTransactions'
+# 集計済みの位置を記録するドキュメントのID
+ROLLUP_CHECKPOINT_ID = '_checkpoint'
+# LIFFアプリからの購入の店舗ID
+ONLINE_STORE_ID = 'online'
+# 店舗IDの最大長
+MAX_STORE_ID_LENGTH = 64
+# POSレジの取引IDの最大長
+MAX_TRANSACTION_ID_LENGTH = 128
+# 1回の問い合わせで取得できる集計の最大日数
+MAX_ROLLUP_DAYS = 366
+# 1件の取引あたりの書き込み件数の上限(台帳とPOSレジの取引の記録)
+MAX_WRITES_PER_ENTRY = 2
+
+
+def is_valid_store_id(store_id):
+    """
+    店舗IDの形式を確認する(集計ドキュメントのIDに使用するため)
+
+    Parameters
+    ----------
+    store_id : str
+        店舗ID
+
+    Returns
+    -------
+    result : bool
+        1〜64文字の英数字・ハイフン・アンダースコアの場合True
+    """
+    return _is_valid_id(store_id, MAX_STORE_ID_LENGTH)
+
+
+def is_valid_transaction_id(transaction_id):
+    """
+    POSレジの取引IDの形式を確認する(取引の記録のドキュメントのIDに使用するため)
+
+    Parameters
+    ----------
+    transaction_id : str
+        取引ID
+
+    Returns
+    -------
+    result : bool
+        1〜128文字の英数字・ハイフン・アンダースコアの場合True
+    """
+    return _is_valid_id(transaction_id, MAX_TRANSACTION_ID_LENGTH)
+
+
+def _is_valid_id(value, max_length):
+    """英数字・ハイフン・アンダースコアのみからなる文字列か確認する"""
+    return isinstance(value, str) and \
+        0 < len(value) <= max_length and value.isascii() and \
+        value.replace('-', '').replace('_', '').isalnum()
+
+
+def entry_id_prefix(timestamp):
+    """
+    指定した日時より前の取引のentryIdの上限を作成する
+
+    Parameters
+    ----------
+    timestamp : float
+        UNIX時間(秒)
+
+    Returns
+    -------
+    prefix : str
+        この値より小さいentryIdの取引は指定した日時より前に発生している
+    """
+    return '%013d' % int(timestamp * 1000)
+
+
+def ledger_entry(user_id, points, sales, store_id, source, occurred_at=None,
+                 transaction_id=None):
+    """
+    取引台帳に書き込む取引を作成する
+
+    Parameters
+    ----------
+    user_id : str
+        ユーザーID
+    points : int
+        付与したポイント
+    sales : int
+        売上金額(税込)
+    store_id : str
+        店舗ID
+    source : str
+        取引の種類(buy: LIFFアプリからの購入 / pos: POSレジの取引)
+    occurred_at : float, optional
+        発生日時のUNIX時間(秒)。指定が無い場合は現在日時
+    transaction_id : str, optional
+        POSレジの取引ID。指定した場合、同じ店舗ID・取引IDの取引は1回のみ記録できる
+
+    Returns
+    -------
+    entry : dict
+        取引
+    """
+    occurred_at = time.time() if occurred_at is None else occurred_at
+    return {
+        'entryId': '%s-%s' % (entry_id_prefix(occurred_at),
+                              uuid.uuid4().hex[:16]),
+        'userId': user_id,
+        'source': source,
+        'storeId': store_id,
+        'transactionId': transaction_id,
+        'points': points,
+        'sales': sales,
+        'occurredAt': occurred_at,
+        'day': datetime.fromtimestamp(occurred_at, JST).strftime('%Y%m%d'),
+    }
+
+
+def ledger_ref(db, entry_id):
+    """
+    取引台帳のドキュメントの参照を取得する
+
+    Parameters
+    ----------
+    db : google.cloud.firestore.Client
+        Firestoreクライアント
+    entry_id : str
+        取引のID
+
+    Returns
+    -------
+    reference : DocumentReference
+        取引のドキュメントの参照
+    """
+    return db.collection(LEDGER_COLLECTION).document(entry_id)
+
+
+def transaction_ref(db, store_id, transaction_id):
+    """
+    POSレジの取引の記録のドキュメントの参照を取得する
+
+    Parameters
+    ----------
+    db : google.cloud.firestore.Client
+        Firestoreクライアント
+    store_id : str
+        店舗ID
+    transaction_id : str
+        POSレジの取引ID
+
+    Returns
+    -------
+    reference : DocumentReference
+        取引の記録のドキュメントの参照
+    """
+    return db.collection(TRANSACTION_COLLECTION).document(
+        '%s_%s' % (store_id, transaction_id))
+
+
+def is_recorded(db, entry):
+    """
+    POSレジの取引が加算済みか確認する
+
+    Parameters
+    ----------
+    db : google.cloud.firestore.Client
+        Firestoreクライアント
+    entry : dict
+        ledger_entryで作成した取引
+
+    Returns
+    -------
+    result : bool
+        同じ店舗ID・取引IDの取引が記録済みの場合True(取引IDが無い場合は常にFalse)
+    """
+    if entry is None or entry.get('transactionId') is None:
+        return False
+    return transaction_ref(db, entry['storeId'],
+                           entry['transactionId']).get().exists
+
+
+def add_ledger_writes(db, batch, entries):
+    """
+    取引台帳への追記をバッチに追加する。取引IDがある取引は取引の記録も作成する。
+    同じIDの取引、または同じ店舗ID・取引IDの記録が既にある場合は
+    バッチ全体を失敗させる(作成のみ許可)。
+
+    Parameters
+    ----------
+    db : google.cloud.firestore.Client
+        Firestoreクライアント
+    batch : WriteBatch
+        書き込みバッチ
+    entries : list
+        ledger_entryで作成した取引のリスト
+    """
+    for entry in entries:
+        batch.create(ledger_ref(db, entry['entryId']), entry)
+        if entry.get('transactionId') is not None:
+            batch.create(transaction_ref(
+                db, entry['storeId'], entry['transactionId']), {
+                    'entryId': entry['entryId'],
+                    'userId': entry['userId'],
+                    'occurredAt': entry['occurredAt'],
+                })
+
+
+def rollup_id(day, store_id=None):
+    """
+    集計ドキュメントのIDを作成する
+
+    Parameters
+    ----------
+    day : str
+        '%Y%m%d'形式の日付
+    store_id : str, optional
+        店舗ID。指定が無い場合は全店舗の集計
+
+    Returns
+    -------
+    rollup_id : str
+        集計ドキュメントのID
+    """
+    return day if store_id is None else '%s_%s' % (day, store_id)
+
+
+def days_between(start_day, end_day):
+    """
+    start_dayからend_dayまで(両端を含む)の日付を返す
+
+    Parameters
+    ----------
+    start_day : str
+        '%Y%m%d'形式の開始日
+    end_day : str
+        '%Y%m%d'形式の終了日
+
+    Returns
+    -------
+    days : list
+        '%Y%m%d'形式の日付のリスト
+
+    Raises
+    ------
+    ValueError
+        日付の形式が不正な場合、または最大日数を超える場合
+    """
+    start = datetime.strptime(start_day, '%Y%m%d')
+    end = datetime.strptime(end_day, '%Y%m%d')
+    count = (end - start).days + 1
+    if count <= 0 or count > MAX_ROLLUP_DAYS:
+        raise ValueError('集計期間が不正です: %s-%s' % (start_day, end_day))
+    return [(start + timedelta(days=i)).strftime('%Y%m%d')
+            for i in range(count)]
+
+
+def read_rollups(db, start_day, end_day, store_id=None):
+    """
+    日別の集計を取得する。台帳の件数に関係なく、日数分のドキュメントのみを読み込む。
+
+    Parameters
+    ----------
+    db : google.cloud.firestore.Client
+        Firestoreクライアント
+    start_day : str
+        '%Y%m%d'形式の開始日
+    end_day : str
+        '%Y%m%d'形式の終了日
+    store_id : str, optional
+        店舗ID。指定が無い場合は全店舗の集計
+
+    Returns
+    -------
+    rollups : list
+        日付順の集計(day, storeId, transactions, points, sales)。取引が無い日は0
+    """
+    days = days_between(start_day, end_day)
+    collection = db.collection(ROLLUP_COLLECTION)
+    refs = [collection.document(rollup_id(day, store_id)) for day in days]
+    found = {}
+    for doc in db.get_all(refs):
+        if doc.exists:
+            found[doc.id] = doc.to_dict()
+    rollups = []
+    for day, ref in zip(days, refs):
+        item = found.get(ref.id, {})
+        rollups.append({
+            'day': day,
+            'storeId': store_id,
+            'transactions': item.get('transactions', 0),
+            'points': item.get('points', 0),
+            'sales': item.get('sales', 0),
+        })
+    return rollups
@@ -0,0 +1,137 @@
+"""
+金額計算モジュール
+
+金額は最小通貨単位(円)の整数、率はベーシスポイント(1/10000)の整数で扱い、
+消費税・付与ポイントの端数処理を整数演算のみで行う。
+"""
+
+# 率の分母(1bp = 0.01%)
+BASIS_POINTS = 10000
+# 消費税率 10%
+TAX_RATE_BP = 1000
+# ポイント付与率 5%
+POINT_RATE_BP = 500
+
+# 端数処理
+ROUND_FLOOR = 'floor'
+ROUND_CEILING = 'ceiling'
+ROUND_HALF_UP = 'half_up'
+
+TAX_ROUNDING = ROUND_FLOOR
+POINT_ROUNDING = ROUND_FLOOR
+
+
+def apply_rate(amount, rate_bp, rounding=ROUND_FLOOR):
+    """
+    金額に率を掛け、端数処理した整数を返す
+
+    Parameters
+    ----------
+    amount : int
+        金額(最小通貨単位)
+    rate_bp : int
+        率(ベーシスポイント)
+    rounding : str
+        端数処理。floor, ceiling, half_up のいずれか
+
+    Returns
+    -------
+    result : int
+        端数処理後の金額
+    """
+    numerator = amount * rate_bp
+    if rounding == ROUND_FLOOR:
+        return numerator // BASIS_POINTS
+    if rounding == ROUND_CEILING:
+        return -(-numerator // BASIS_POINTS)
+    if rounding == ROUND_HALF_UP:
+        # 0から遠い方向に丸める
+        half = BASIS_POINTS // 2
+        if numerator >= 0:
+            return (numerator + half) // BASIS_POINTS
+        return -((-numerator + half) // BASIS_POINTS)
+    raise ValueError('未対応の端数処理です: %s' % rounding)
+
+
+def calc_tax(amount):
+    """
+    消費税を計算する
+
+    Parameters
+    ----------
+    amount : int
+        税抜金額
+
+    Returns
+    -------
+    tax : int
+        消費税
+    """
+    return apply_rate(amount, TAX_RATE_BP, TAX_ROUNDING)
+
+
+def calc_point(amount):
+    """
+    付与ポイントを計算する
+
+    Parameters
+    ----------
+    amount : int
+        ポイント付与対象の商品代金
+
+    Returns
+    -------
+    point : int
+        付与ポイント
+    """
+    return apply_rate(amount, POINT_RATE_BP, POINT_ROUNDING)
+
+
+def price_cart(amounts, fee=0, postage=0, discount=0):
+    """
+    明細金額から小計・消費税・合計金額・付与ポイントを計算する
+
+    Parameters
+    ----------
+    amounts : iterable
+        明細毎の金額(単価×数量)
+    fee : int
+        決済手数料
+    postage : int
+        送料
+    discount : int
+        値引き額
+
+    Returns
+    -------
+    result : dict
+        subtotal, tax, total, point
+    """
+    merchandise = sum(amounts)
+    subtotal = merchandise + postage + fee - discount
+    tax = calc_tax(subtotal)
+    return {
+        'subtotal': subtotal,
+        'tax': tax,
+        'total': subtotal + tax,
+        # ポイントは商品代金に対して付与する
+        'point': calc_point(merchandise),
+    }
+
+
+def price_carts(carts):
+    """
+    複数のカートをまとめて計算する
+
+    Parameters
+    ----------
+    carts : iterable
+        (明細金額のリスト, 決済手数料, 送料, 値引き額)のタプル
+
+    Returns
+    -------
+    results : list
+        カート毎のprice_cartの結果
+    """
+    return [price_cart(amounts, fee, postage, discount)
+            for amounts, fee, postage, discount in carts]
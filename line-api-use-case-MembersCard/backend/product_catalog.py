@@ -0,0 +1,221 @@
+"""
+商品カタログモジュール
+
+商品データをSKUをキーとしたdictとしてメモリ上に保持する。
+読み込み元(ローカルのJSONファイルまたはFirestore)のバージョンを定期的に確認し、
+変更があった場合のみ再読み込みする。
+"""
+import os
+import json
+import time
+import logging
+import threading
+
+# 環境変数の宣言
+# file: ローカルのJSONファイル / firestore: Firestoreのコレクション
+PRODUCT_CATALOG_SOURCE = os.getenv('PRODUCT_CATALOG_SOURCE', 'file')
+PRODUCT_CATALOG_PATH = os.getenv(
+    'PRODUCT_CATALOG_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 'content', 'product_catalog.json'))
+# バージョンを確認する間隔(秒)
+PRODUCT_CATALOG_CHECK_INTERVAL = float(
+    os.getenv('PRODUCT_CATALOG_CHECK_INTERVAL', '60'))
+
+logger = logging.getLogger(__name__)
+
+
+class FileCatalogSource:
+    """ローカルのJSONファイルから商品データを読み込むクラス"""
+    __slots__ = ['_path']
+
+    def __init__(self, path=PRODUCT_CATALOG_PATH):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        path : str
+            商品カタログのJSONファイルのパス
+        """
+        self._path = path
+
+    def version(self):
+        """
+        商品データのバージョンを取得する
+
+        Returns
+        -------
+        version : str
+            ファイルの更新日時
+        """
+        return str(os.stat(self._path).st_mtime_ns)
+
+    def load(self):
+        """
+        商品データを読み込む
+
+        Returns
+        -------
+        version : str
+            商品データのバージョン
+        products : list
+            商品データのリスト
+        """
+        version = self.version()
+        with open(self._path, encoding='utf-8') as f:
+            data = json.load(f)
+        return version, data['products']
+
+
+class FirestoreCatalogSource:
+    """
+    Firestoreから商品データを読み込むクラス
+    ProductCatalogコレクションに商品毎のドキュメントを、
+    ProductCatalogMeta/currentのversionフィールドにバージョンを保持する。
+    """
+    __slots__ = ['_db']
+
+    def __init__(self, db=None):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        db : google.cloud.firestore.Client, optional
+            Firestoreクライアント。指定が無い場合は設定(FIRESTORE_BACKEND)に応じて作成する。
+        """
+        if db is None:
+            from members_card_user_info import create_firestore_client
+            db = create_firestore_client()
+        self._db = db
+
+    def version(self):
+        """商品データのバージョンを取得する"""
+        doc = self._db.collection('ProductCatalogMeta').document(
+            'current').get()
+        return doc.to_dict().get('version') if doc.exists else None
+
+    def load(self):
+        """商品データを読み込む"""
+        version = self.version()
+        products = [doc.to_dict() for doc in
+                    self._db.collection('ProductCatalog').stream()]
+        return version, products
+
+
+class ProductCatalog:
+    """SKUで索引付けした商品カタログクラス"""
+    __slots__ = ['_source', '_check_interval', '_products', '_version',
+                 '_checked_at', '_lock']
+
+    def __init__(self, source, check_interval=PRODUCT_CATALOG_CHECK_INTERVAL):
+        """
+        初期化メソッド。商品データを読み込む。
+
+        Parameters
+        ----------
+        source : obj
+            version()とload()を持つ読み込み元
+        check_interval : float
+            バージョンを確認する間隔(秒)
+        """
+        self._source = source
+        self._check_interval = check_interval
+        self._products = {}
+        self._version = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.reload()
+
+    @property
+    def version(self):
+        """読み込み済みの商品データのバージョン"""
+        return self._version
+
+    def reload(self):
+        """商品データを読み込み直す"""
+        version, products = self._source.load()
+        # 読み込み中の参照に影響しないよう、新しいdictに差し替える
+        self._products = {product['sku']: product for product in products}
+        self._version = version
+        self._checked_at = time.monotonic()
+        logger.info('商品カタログを読み込みました version: %s, %s件',
+                    version, len(products))
+
+    def refresh_if_stale(self):
+        """確認間隔を過ぎている場合、バージョンが変わっていれば読み込み直す"""
+        if time.monotonic() - self._checked_at < self._check_interval:
+            return
+        if not self._lock.acquire(blocking=False):
+            # 他スレッドが確認中の場合は現在のデータを使う
+            return
+        try:
+            self._checked_at = time.monotonic()
+            if self._source.version() != self._version:
+                self.reload()
+        except Exception:
+            logger.exception('商品カタログの更新に失敗しました')
+        finally:
+            self._lock.release()
+
+    def get(self, sku):
+        """
+        SKUに対応する商品データを取得する
+
+        Parameters
+        ----------
+        sku : str
+            SKU
+
+        Returns
+        -------
+        product : dict
+            商品データ
+
+        Raises
+        ------
+        KeyError
+            カタログに存在しないSKUの場合
+        """
+        self.refresh_if_stale()
+        return self._products[sku]
+
+    def lookup(self, skus):
+        """
+        複数のSKUに対応する商品データをまとめて取得する
+
+        Parameters
+        ----------
+        skus : iterable
+            SKUのリスト
+
+        Returns
+        -------
+        products : list
+            商品データのリスト
+        """
+        self.refresh_if_stale()
+        products = self._products
+        return [products[sku] for sku in skus]
+
+
+def create_catalog(source=PRODUCT_CATALOG_SOURCE):
+    """
+    設定に応じた商品カタログを作成する
+
+    Parameters
+    ----------
+    source : str
+        file, firestore のいずれか
+
+    Returns
+    -------
+    catalog : ProductCatalog
+        商品カタログ
+    """
+    if source == 'file':
+        return ProductCatalog(FileCatalogSource())
+    if source == 'firestore':
+        return ProductCatalog(FirestoreCatalogSource())
+    raise ValueError('未対応の商品カタログです: %s' % source)
@@ -0,0 +1,294 @@
+"""
+電子レシート送信キュー(アウトボックス)モジュール
+
+ポイント更新後のレシート送信をリクエストスレッドから切り離し、
+ワーカースレッドでMessaging APIに送信する。
+OUTBOX_JOURNAL_PATHを指定した場合は未送信のレシートをSQLiteに保存し、
+コンテナ再起動後に再送する。
+"""
+import os
+import json
+import time
+import uuid
+import queue
+import sqlite3
+import logging
+import threading
+
+# 環境変数の宣言
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '2'))
+OUTBOX_MAX_QUEUE = int(os.getenv('OUTBOX_MAX_QUEUE', '1000'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_BACKOFF_SECONDS = float(os.getenv('OUTBOX_BACKOFF_SECONDS', '1'))
+OUTBOX_JOURNAL_PATH = os.getenv('OUTBOX_JOURNAL_PATH', '')
+
+# 再送間隔の上限(秒)
+MAX_BACKOFF_SECONDS = 60
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxJournal:
+    """未送信レシートを保存するSQLiteジャーナルクラス"""
+    __slots__ = ['_path', '_conn', '_lock']
+
+    def __init__(self, path):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        path : str
+            SQLiteファイルのパス
+        """
+        self._path = path
+        self._connect()
+
+    def _connect(self):
+        """SQLiteファイルに接続し、テーブルが無い場合は作成する"""
+        self._conn = sqlite3.connect(self._path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS outbox ('
+            ' id TEXT PRIMARY KEY,'
+            ' user_id TEXT NOT NULL,'
+            ' message TEXT NOT NULL,'
+            ' created_at REAL NOT NULL)')
+        self._lock = threading.Lock()
+
+    def reopen(self):
+        """
+        SQLiteファイルに接続し直す。
+        SQLiteの接続はフォークした子プロセスで使用できないため、子プロセスで呼び出す。
+        """
+        self._connect()
+
+    def add(self, job):
+        """
+        ジャーナルにレシートを追加する
+
+        Parameters
+        ----------
+        job : dict
+            送信ジョブ
+        """
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO outbox VALUES (?, ?, ?, ?)',
+                (job['id'], job['userId'], json.dumps(job['message']),
+                 job['createdAt']))
+
+    def remove(self, job_id):
+        """
+        ジャーナルからレシートを削除する
+
+        Parameters
+        ----------
+        job_id : str
+            送信ジョブのID
+        """
+        with self._lock:
+            self._conn.execute('DELETE FROM outbox WHERE id = ?', (job_id,))
+
+    def pending(self):
+        """
+        未送信のレシートを登録順に取得する
+
+        Returns
+        -------
+        jobs : list
+            送信ジョブのリスト
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT id, user_id, message, created_at FROM outbox'
+                ' ORDER BY created_at').fetchall()
+        return [{'id': row[0], 'userId': row[1],
+                 'message': json.loads(row[2]), 'createdAt': row[3]}
+                for row in rows]
+
+
+class ReceiptOutbox:
+    """電子レシートの非同期送信クラス"""
+    __slots__ = ['_sender', '_is_retryable', '_queue', '_workers',
+                 '_max_attempts', '_backoff', '_journal', '_threads',
+                 '_lock', '_stopping', 'dropped']
+
+    def __init__(self, sender, is_retryable=None,
+                 max_queue_size=OUTBOX_MAX_QUEUE, workers=OUTBOX_WORKERS,
+                 max_attempts=OUTBOX_MAX_ATTEMPTS,
+                 backoff=OUTBOX_BACKOFF_SECONDS,
+                 journal_path=OUTBOX_JOURNAL_PATH):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        sender : callable
+            sender(user_id, message, retry_key)の形式で送信を行う関数
+        is_retryable : callable, optional
+            例外を受け取り再送するか判定する関数。指定が無い場合は常に再送する。
+        max_queue_size : int
+            キューの最大件数
+        workers : int
+            ワーカースレッド数
+        max_attempts : int
+            1件あたりの最大送信試行回数
+        backoff : float
+            再送間隔の初期値(秒)。試行毎に2倍にする。
+        journal_path : str
+            SQLiteジャーナルのパス。空文字の場合は保存しない。
+        """
+        self._sender = sender
+        self._is_retryable = is_retryable or (lambda e: True)
+        self._queue = queue.Queue(max_queue_size)
+        self._workers = workers
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        self._journal = OutboxJournal(journal_path) if journal_path else None
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        # キューが満杯で追加できなかったレシートの件数
+        self.dropped = 0
+
+    def start(self):
+        """ワーカースレッドを起動し、ジャーナルに残っているレシートを再投入する"""
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping.clear()
+            if self._journal is not None:
+                for job in self._journal.pending():
+                    self._queue.put(job)
+                logger.info('未送信のレシートを再投入しました: %s件',
+                            self._queue.qsize())
+            for i in range(self._workers):
+                thread = threading.Thread(
+                    target=self._run, name='receipt-outbox-%d' % i,
+                    daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def enqueue(self, user_id, message):
+        """
+        レシートを送信キューに追加する
+
+        Parameters
+        ----------
+        user_id : str
+            送信対象のユーザーID
+        message : str
+            Flexmessageのメッセージオブジェクトを変換したJSON文字列
+
+        Returns
+        -------
+        result : bool
+            キューに追加できた場合True
+        """
+        if not self._threads:
+            self.start()
+        job = {
+            'id': str(uuid.uuid4()),
+            'userId': user_id,
+            'message': message,
+            'createdAt': time.time(),
+        }
+        if self._journal is not None:
+            self._journal.add(job)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            # ジャーナルが有効な場合は次回起動時に再送される
+            with self._lock:
+                self.dropped += 1
+            logger.error('送信キューが満杯のためレシートを追加できません: %s',
+                         job['id'])
+            return False
+        return True
+
+    def stop(self, timeout=10):
+        """
+        キューが空になるまで待機し、ワーカースレッドを停止する
+
+        Parameters
+        ----------
+        timeout : float
+            待機する最大時間(秒)
+        """
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self._stopping.set()
+        with self._lock:
+            for thread in self._threads:
+                thread.join(max(0, deadline - time.monotonic()))
+            self._threads = []
+
+    def after_fork(self):
+        """
+        フォークした子プロセスで、親プロセスから引き継いだキュー・ロック・ジャーナルの接続を
+        作り直す。ワーカースレッドは引き継がれないため、次回の追加時に起動する。
+        ジャーナルのレシートは各プロセスで再投入するが、同じIDをリトライキーとして
+        送信するため重複しては送信されない。
+        """
+        self._queue = queue.Queue(self._queue.maxsize)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        if self._journal is not None:
+            self._journal.reopen()
+
+    def qsize(self):
+        """
+        送信待ちの件数を取得する
+
+        Returns
+        -------
+        size : int
+            送信待ちの件数
+        """
+        return self._queue.qsize()
+
+    def _run(self):
+        """ワーカースレッドの処理"""
+        while not self._stopping.is_set():
+            try:
+                job = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self._deliver(job)
+            finally:
+                self._queue.task_done()
+
+    def _deliver(self, job):
+        """
+        レシートを送信する。失敗時はバックオフしながら再送する。
+
+        Parameters
+        ----------
+        job : dict
+            送信ジョブ
+        """
+        delay = self._backoff
+        for attempt in range(1, self._max_attempts + 1):
+            try:
+                # 再送時に重複送信されないようジョブIDをリトライキーとして使う
+                self._sender(job['userId'], job['message'], job['id'])
+                break
+            except Exception as e:
+                if not self._is_retryable(e) or attempt == self._max_attempts:
+                    logger.error('レシートの送信に失敗しました: %s', job['id'],
+                                 exc_info=True)
+                    break
+                logger.warning('レシートの送信を再試行します(%s回目): %s',
+                               attempt, job['id'])
+                if self._stopping.wait(delay):
+                    # 停止中はジャーナルに残して次回起動時に再送する
+                    return
+                delay = min(delay * 2, MAX_BACKOFF_SECONDS)
+
+        if self._journal is not None:
+            self._journal.remove(job['id'])
@@ -0,0 +1,219 @@
+"""
+電子レシートのテンプレートモジュール
+
+Flexメッセージのレイアウトをインポート時に1度だけ読み込んで検証し、
+スロット("{{name}}"の文字列)以外の部分をJSON文字列の断片として保持する。
+リクエスト毎の処理はスロットへの値の埋め込みのみで、送信用のJSONを直接生成する。
+"{{@name}}"のスロットには文字列ではなくJSONの断片(明細行の並び等)をそのまま埋め込む。
+"{{t:key}}"の文字列は文言カタログの文言で、言語毎にコンパイル時に置き換える。
+"""
+import os
+import re
+import json
+from locale_catalog import LOCALE_CATALOG
+
+CONTENT_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'content')
+TEMPLATE_PATH = os.path.join(CONTENT_DIR, 'receipt_template.json')
+ITEM_TEMPLATE_PATH = os.path.join(CONTENT_DIR, 'receipt_item_template.json')
+
+# スロットとして扱う文字列値の形式
+SLOT_PATTERN = re.compile(r'"\{\{(@?[a-z0-9_]+)\}\}"')
+# Flexメッセージの代替テキストの最大文字数
+# https://developers.line.biz/ja/reference/messaging-api/#flex-message
+MAX_ALT_TEXT_LENGTH = 400
+# 文言カタログの文言に置き換える文字列値の形式
+LABEL_PATTERN = re.compile(r'^\{\{t:([A-Za-z0-9_.-]+)\}\}$')
+
+
+class TemplateError(Exception):
+    """テンプレートが不正な場合の例外"""
+
+
+class CompiledTemplate:
+    """スロット埋め込み用に分割済みのテンプレートクラス"""
+    __slots__ = ['_fragments', '_slots', 'slot_names']
+
+    def __init__(self, template, validator=None):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        template : dict
+            スロットを含むFlexメッセージの辞書型データ
+        validator : callable, optional
+            テンプレートの検証関数。指定が無い場合はvalidateを使用する。
+        """
+        (validator or validate)(template)
+        text = json.dumps(template, ensure_ascii=False, separators=(',', ':'))
+        # 分割後は偶数番目がJSONの断片、奇数番目がスロット名となる
+        parts = SLOT_PATTERN.split(text)
+        self._fragments = parts[0::2]
+        # (スロット名, JSONの断片をそのまま埋め込むか)
+        self._slots = [(slot.lstrip('@'), slot.startswith('@'))
+                       for slot in parts[1::2]]
+        self.slot_names = frozenset(name for name, _ in self._slots)
+        # 埋め込み後のJSONが壊れないことを確認する
+        json.loads(self.render(**{
+            name: 'null' if raw else name for name, raw in self._slots}))
+
+    def render(self, **values):
+        """
+        スロットに値を埋め込み、JSON文字列を生成する
+
+        Parameters
+        ----------
+        **values : str
+            スロット名をキーとした埋め込む値。
+            "{{@name}}"のスロットにはJSONの断片を指定する。
+
+        Returns
+        -------
+        payload : str
+            Flexメッセージ(送信用)のJSON文字列
+        """
+        missing = self.slot_names.difference(values)
+        if missing:
+            raise TemplateError('スロットの値が不足しています: %s' %
+                                ', '.join(sorted(missing)))
+        dumps = json.dumps
+        fragments = self._fragments
+        out = [fragments[0]]
+        for i, (slot, raw) in enumerate(self._slots, 1):
+            if raw:
+                out.append(values[slot])
+            else:
+                out.append(dumps(str(values[slot]), ensure_ascii=False))
+            out.append(fragments[i])
+        return ''.join(out)
+
+    def render_many(self, rows):
+        """
+        複数行分の値を埋め込み、カンマ区切りのJSONの断片を生成する
+
+        Parameters
+        ----------
+        rows : iterable
+            スロット名をキーとした埋め込む値のdict
+
+        Returns
+        -------
+        fragment : str
+            配列の要素として埋め込むJSONの断片
+        """
+        return ','.join([self.render(**row) for row in rows])
+
+
+def validate(template):
+    """
+    テンプレートがFlexメッセージとして妥当か検証する
+
+    Parameters
+    ----------
+    template : dict
+        スロットを含むFlexメッセージの辞書型データ
+    """
+    if template.get('type') != 'flex':
+        raise TemplateError('typeがflexではありません')
+    alt_text = template.get('altText', '')
+    if not alt_text or len(alt_text) > MAX_ALT_TEXT_LENGTH:
+        raise TemplateError('altTextが不正です')
+    contents = template.get('contents', {})
+    if contents.get('type') not in ('bubble', 'carousel'):
+        raise TemplateError('contentsのtypeが不正です')
+
+
+def validate_component(template):
+    """
+    テンプレートがFlexメッセージのコンポーネントとして妥当か検証する
+
+    Parameters
+    ----------
+    template : dict
+        スロットを含むコンポーネントの辞書型データ
+    """
+    if not isinstance(template, dict) or 'type' not in template:
+        raise TemplateError('コンポーネントのtypeがありません')
+
+
+def localize(template, labels):
+    """
+    テンプレートの"{{t:key}}"の文字列を文言に置き換える
+
+    Parameters
+    ----------
+    template : obj
+        スロットを含むFlexメッセージの辞書型データ(またはその一部)
+    labels : dict
+        キーをキーとした文言
+
+    Returns
+    -------
+    template : obj
+        文言を置き換えたデータ(元のデータは変更しない)
+    """
+    if isinstance(template, dict):
+        return {key: localize(value, labels)
+                for key, value in template.items()}
+    if isinstance(template, list):
+        return [localize(value, labels) for value in template]
+    if isinstance(template, str):
+        match = LABEL_PATTERN.match(template)
+        if match:
+            try:
+                return labels[match.group(1)]
+            except KeyError:
+                raise TemplateError('文言がありません: %s' % match.group(1))
+    return template
+
+
+def load_template(path=TEMPLATE_PATH, validator=None):
+    """
+    テンプレートファイルを読み込み、コンパイルする
+
+    Parameters
+    ----------
+    path : str
+        テンプレートファイルのパス
+    validator : callable, optional
+        テンプレートの検証関数
+
+    Returns
+    -------
+    template : CompiledTemplate
+        コンパイル済みのテンプレート
+    """
+    with open(path, encoding='utf-8') as f:
+        return CompiledTemplate(json.load(f), validator)
+
+
+def load_localized_templates(path=TEMPLATE_PATH, validator=None,
+                             catalog=LOCALE_CATALOG):
+    """
+    テンプレートファイルを読み込み、言語毎に文言を置き換えてコンパイルする
+
+    Parameters
+    ----------
+    path : str
+        テンプレートファイルのパス
+    validator : callable, optional
+        テンプレートの検証関数
+    catalog : LocaleCatalog
+        文言カタログ
+
+    Returns
+    -------
+    templates : dict
+        言語をキーとしたコンパイル済みのテンプレート
+    """
+    with open(path, encoding='utf-8') as f:
+        template = json.load(f)
+    return {locale: CompiledTemplate(
+                localize(template, catalog.table(locale)), validator)
+            for locale in catalog.locales}
+
+
+# インポート時に1度だけ読み込む
+RECEIPT_TEMPLATES = load_localized_templates()
+RECEIPT_ITEM_TEMPLATE = load_template(ITEM_TEMPLATE_PATH, validate_component)
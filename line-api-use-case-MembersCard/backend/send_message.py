@@ -1,17 +1,17 @@
 import os
+import json
 import logging
 import datetime
-from dateutil.tz import gettz
-import math
-from decimal import Decimal
-from linebot import LineBotApi
-from linebot.models import FlexSendMessage
-from linebot.exceptions import (
-    LineBotApiError, InvalidSignatureError)
+import uuid
 from common import utils
+from common import http_client
+from receipt_template import RECEIPT_TEMPLATES, RECEIPT_ITEM_TEMPLATE
+from locale_catalog import LOCALE_CATALOG
 
 # 環境変数の宣言
 LOGGER_LEVEL = os.getenv("LOGGER_LEVEL")
+PUSH_URL = os.getenv(
+    'LINE_PUSH_URL', 'https://api.line.me/v2/bot/message/push')
 
 # ログ出力の設定
 logger = logging.getLogger()
@@ -21,420 +21,186 @@ else:
     logger.setLevel(logging.INFO)
 
 
-def send_push_message(channel_access_token, user_id, product_obj, language, liffId):
+class MessagingApiError(Exception):
+    """Messaging APIがエラーを返却した場合の例外"""
+
+    def __init__(self, status_code, body, retry_after=None):
+        super().__init__('%s: %s' % (status_code, body))
+        self.status_code = status_code
+        self.body = body
+        # Retry-Afterヘッダーで指定された再送までの待ち時間(秒)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
     """
-    プッシュメッセージを送信する
+    Retry-Afterヘッダーの秒数を読み取る
 
     Parameters
     ----------
-    channel_access_token : str
-        OAのチャネルアクセストークン
-    user_id : str
-        送信対象のユーザーID
-    product_obj : dict
-        データベースより取得した商品データ
-    language : str
-        多言語化対応用のパラメータ
+    value : str
+        Retry-Afterヘッダーの値
+
+    Returns
+    -------
+    seconds : float
+        再送までの待ち時間(秒)。秒数で指定されていない場合はNone
     """
-    logger.info('productObj: %s', product_obj)
-    modified_product_obj = modify_product_obj(product_obj, language)
-
-    flex_dict = make_flex_recept(**modified_product_obj, language=language, liffId=liffId)
-
-    try:
-        line_bot_api = LineBotApi(channel_access_token)
-        # flexdictを生成する
-        flex_dict = FlexSendMessage.new_from_json_dict(flex_dict)
-        # push message 送信
-        response = line_bot_api.push_message(user_id, flex_dict)
-    except LineBotApiError as e:
-        logger.error(
-            'Got exception from LINE Messaging API: %s\n' % e.message)
-        for m in e.error.details:
-            logger.error('  %s: %s' % (m.property, m.message))
-        raise Exception
-    except InvalidSignatureError as e:
-        logger.error('Occur Exception: %s', e)
-        raise Exception
-        
-        
-def modify_product_obj(product_obj, language, discount=0):
+    if value is None or not value.strip().isdigit():
+        return None
+    return float(value.strip())
+
+
+def make_receipt_message(summary, language, liffId):
     """
-    データベースより取得した商品データをメッセージ送信に適した状態のdict型に加工する
+    電子レシートのフレックスメッセージのJSON文字列を作成する
+    言語毎にコンパイル済みのテンプレートに値を埋め込むため、SDKのモデルを経由しない。
 
     Parameters
     ----------
-    product_obj : dict
-        データベースより取得した商品データ
+    summary : dict
+        Cart.priceで計算した明細と金額
     language : str
         多言語化対応用のパラメータ
-    discount : int, optional
-        値引き率。
-        指定が無い場合0とする。
+    liffId : str
+        会員証のLIFF ID
 
     Returns
     -------
-    dict
-        加工後の商品データ
+    message_json : str
+        FlexmessageのJSON文字列
     """
-    now = datetime.datetime.now(
-        gettz('Asia/Tokyo')).strftime('%Y/%m/%d %H:%M:%S')
-    subtotal = product_obj['unitPrice1'] + product_obj['unitPrice2'] + \
-        product_obj['postage'] + product_obj['fee'] - discount                  # 複数商品を出力するため
-    tax = math.floor(subtotal * Decimal(0.10))
-    total = subtotal + tax
-    point = math.floor((product_obj['unitPrice1'] * Decimal(0.05)) + \
-        (product_obj['unitPrice2'] * Decimal(0.05)))                            # 複数商品を出力するため
-    logger.info('point: %s', point)
-    modified_product_obj = {
-        'date': now,
-        'product_name1': product_obj['productName1'][language],                 # 複数商品を出力するため
-        'product_name2': product_obj['productName2'][language],                 # 複数商品を出力するため
-        'product_price1': utils.separate_comma(product_obj['unitPrice1']),      # 複数商品を出力するため
-        'product_price2': utils.separate_comma(product_obj['unitPrice2']),      # 複数商品を出力するため
-        'postage': utils.separate_comma(product_obj['postage']),
-        'fee': utils.separate_comma(product_obj['fee']),
-        'discount': utils.separate_comma(discount),
-        'subtotal': utils.separate_comma(subtotal),
-        'tax': utils.separate_comma(tax),
-        'total': utils.separate_comma(total),
-        'point': utils.separate_comma(point),
-    }
+    logger.info('summary: %s', summary)
 
-    return modified_product_obj
+    locale = LOCALE_CATALOG.resolve(language)
+    return RECEIPT_TEMPLATES[locale].render(
+        **modify_summary(summary, locale),
+        liff_uri="https://liff.line.me/{liff_id}?lang={language}".format(
+            liff_id=liffId, language=locale))
 
 
-def make_flex_recept(date, product_name1, product_name2, product_price1, product_price2, postage,
-                     fee, discount, subtotal, tax, total,
-                     point, language, liffId):
+def modify_summary(summary, language):
     """
-    電子レシートのフレックスメッセージのdict型データを作成する
+    明細と金額の計算結果をレシートのテンプレートに埋め込む値に加工する
 
     Parameters
     ----------
-    date: str
-        yyyy/MM/dd hh:mm:ss形式の日付時刻
-    product_name1: str      #複数商品を出力するため
-        商品名
-    product_name2: str      #複数商品を出力するため
-        商品名
-    product_price1: str     #複数商品を出力するため
-        商品代金
-    product_price2: str     #複数商品を出力するため
-        商品代金
-    postage: str
-        送料
-    commission: str
-        手数料
-    discount: str
-        値下げ料
-    subtotal: str
-        小計
-    tax: str
-        消費税
-    total: str
-        合計
-    point: str
-        付与ポイント
-    language: str
-        言語設定
+    summary : dict
+        Cart.priceで計算した明細と金額
+    language : str
+        文言カタログで解決済みの言語
 
     Returns
     -------
-    result : dict
-        Flexmessageの元になる辞書型データ
+    dict
+        テンプレートのスロット名をキーとした値
     """
+    separate_comma = utils.separate_comma
+    pick = LOCALE_CATALOG.pick
+    rows = []
+    for item in summary['items']:
+        name = pick(item['name'], language)
+        if item['quantity'] > 1:
+            name = '%s ×%s' % (name, item['quantity'])
+        rows.append({'name': name, 'amount': separate_comma(item['amount'])})
+
     return {
-        "type": "flex",
-        "altText": "お買い上げありがとうございます。電子レシートを発行します。",
-        "contents": {
-            "type": "bubble",
-            "header": {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {
-                        "type": "text",
-                        "text": "Use Case STORE",
-                        "size": "xxl",
-                        "weight": "bold"
-                    },
-                    {
-                        "type": "text",
-                        "text": date,
-                        "color": "#767676"
-                    },
-                    {
-                        "type": "text",
-                        "wrap": True,
-                        "text": "※デジタル会員証のハンズオンアプリであるため、実際の課金は行われません",
-                        "color": "#ff6347"
-                    }
-                ]
-            },
-            "body": {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {
-                        "type": "box",
-                        "layout": "vertical",
-                        "margin": "lg",
-                        "spacing": "sm",
-                        "contents": [
-                            {
-                                "type": "box",
-                                "layout": "baseline",
-                                "spacing": "sm",
-                                "contents": [
-                                    {
-                                        "type": "text",
-                                        "text": product_name1,
-                                        "color": "#5B5B5B",
-                                        "size": "sm",
-                                        "flex": 5
-                                    },
-                                    {
-                                        "type": "text",
-                                        "text": product_price1,
-                                        "wrap": True,
-                                        "color": "#666666",
-                                        "size": "sm",
-                                        "flex": 2,
-                                        "align": "end"
-                                    }
-                                ]
-                            },
-                            {
-                                "type": "box",
-                                "layout": "baseline",
-                                "spacing": "sm",
-                                "contents": [
-                                    {
-                                        "type": "text",
-                                        "text": product_name2,
-                                        "color": "#5B5B5B",
-                                        "size": "sm",
-                                        "flex": 5
-                                    },
-                                    {
-                                        "type": "text",
-                                        "text": product_price2,
-                                        "wrap": True,
-                                        "color": "#666666",
-                                        "size": "sm",
-                                        "flex": 2,
-                                        "align": "end"
-                                    }
-                                ]
-                            },
-                            {
-                                "type": "box",
-                                "layout": "baseline",
-                                "spacing": "sm",
-                                "contents": [
-                                    {
-                                        "type": "text",
-                                        "text": "送料（税抜）",
-                                        "color": "#5B5B5B",
-                                        "size": "sm",
-                                        "flex": 5
-                                    },
-                                    {
-                                        "type": "text",
-                                        "text": postage,
-                                        "wrap": True,
-                                        "color": "#666666",
-                                        "size": "sm",
-                                        "flex": 2,
-                                        "align": "end"
-                                    }
-                                ]
-                            },
-                            {
-                                "type": "box",
-                                "layout": "baseline",
-                                "spacing": "sm",
-                                "contents": [
-                                    {
-                                        "type": "text",
-                                        "text": "決算手数料（税抜）",
-                                        "color": "#5B5B5B",
-                                        "size": "sm",
-                                        "flex": 5
-                                    },
-                                    {
-                                        "type": "text",
-                                        "text": fee,
-                                        "wrap": True,
-                                        "color": "#666666",
-                                        "size": "sm",
-                                        "flex": 2,
-                                        "align": "end"
-                                    }
-                                ]
-                            },
-                            {
-                                "type": "box",
-                                "layout": "baseline",
-                                "spacing": "sm",
-                                "contents": [
-                                    {
-                                        "type": "text",
-                                        "text": "値引き",
-                                        "color": "#5B5B5B",
-                                        "size": "sm",
-                                        "flex": 5
-                                    },
-                                    {
-                                        "type": "text",
-                                        "text": discount,
-                                        "wrap": True,
-                                        "color": "#666666",
-                                        "size": "sm",
-                                        "flex": 2,
-                                        "align": "end"
-                                    }
-                                ]
-                            },
-                            {
-                                "type": "box",
-                                "layout": "baseline",
-                                "spacing": "sm",
-                                "contents": [
-                                    {
-                                        "type": "text",
-                                        "text": "小計（税抜）",
-                                        "color": "#5B5B5B",
-                                        "size": "sm",
-                                        "flex": 5
-                                    },
-                                    {
-                                        "type": "text",
-                                        "text": subtotal,
-                                        "wrap": True,
-                                        "color": "#666666",
-                                        "size": "sm",
-                                        "flex": 2,
-                                        "align": "end"
-                                    }
-                                ]
-                            },
-                            {
-                                "type": "box",
-                                "layout": "baseline",
-                                "spacing": "sm",
-                                "contents": [
-                                    {
-                                        "type": "text",
-                                        "text": "消費税",
-                                        "color": "#5B5B5B",
-                                        "size": "sm",
-                                        "flex": 5
-                                    },
-                                    {
-                                        "type": "text",
-                                        "text": tax,
-                                        "wrap": True,
-                                        "color": "#666666",
-                                        "size": "sm",
-                                        "flex": 2,
-                                        "align": "end"
-                                    }
-                                ]
-                            },
-                            {
-                                "type": "box",
-                                "layout": "baseline",
-                                "spacing": "sm",
-                                "contents": [
-                                    {
-                                        "type": "text",
-                                        "text": "お会計金額",
-                                        "color": "#5B5B5B",
-                                        "size": "sm",
-                                        "flex": 5
-                                    },
-                                    {
-                                        "type": "text",
-                                        "text": total,
-                                        "wrap": True,
-                                        "color": "#666666",
-                                        "size": "sm",
-                                        "flex": 2,
-                                        "align": "end"
-                                    }
-                                ]
-                            },
-                            {
-                                "type": "box",
-                                "layout": "baseline",
-                                "spacing": "sm",
-                                "contents": [
-                                    {
-                                        "type": "text",
-                                        "text": "付与ポイント",
-                                        "color": "#5B5B5B",
-                                        "size": "sm",
-                                        "flex": 5
-                                    },
-                                    {
-                                        "type": "text",
-                                        "text": point,
-                                        "wrap": True,
-                                        "color": "#666666",
-                                        "size": "sm",
-                                        "flex": 2,
-                                        "align": "end"
-                                    }
-                                ]
-                            },
-                        ],
-                        "paddingBottom": "xxl"
-                    },
-                    {
-                        "type": "box",
-                        "layout": "vertical",
-                        "contents": [
-                            {
-                                "type": "text",
-                                "text": "商品のご購入ありがとうございます。\n本メッセージは、Use Case STOREおよびUse Case GROUPの店舗で商品をご購入されたお客様にお届けしています。",
-                                "wrap": True,
-                                "size": "sm",
-                                "color": "#767676"
-                            }
-                        ]
-                    }
-                ],
-                "paddingTop": "0%"
-            },
-            "footer": {
-                "type": "box",
-                "layout": "vertical",
-                "spacing": "sm",
-                "contents": [
-                    {
-                        "type": "button",
-                        "style": "link",
-                        "height": "sm",
-                        "action": {
-                            "type": "uri",
-                            "label": "会員証を表示",
-                            "uri": "https://liff.line.me/{liff_id}?lang={language}".format(liff_id=liffId, language=language)  # noqa: E501
-                        },
-                        "color": "#0033cc"
-                    }
-                ],
-                "flex": 0
-            }
-        }
+        'date': datetime.datetime.now(
+            utils.JST).strftime('%Y/%m/%d %H:%M:%S'),
+        'items': RECEIPT_ITEM_TEMPLATE.render_many(rows),
+        'postage': separate_comma(summary['postage']),
+        'fee': separate_comma(summary['fee']),
+        'discount': separate_comma(summary['discount']),
+        'subtotal': separate_comma(summary['subtotal']),
+        'tax': separate_comma(summary['tax']),
+        'total': separate_comma(summary['total']),
+        'point': separate_comma(summary['point']),
     }
-    
+
+
+def push_message_json(channel_access_token, user_id, message_json,
+                      retry_key=None):
     """
-    廃止となった
-    https://developers.line.biz/ja/news/2020/?month=10&day=08&article=flex-message-update-2-released#update-spacer
-    {
-        "type": "spacer",
-        "size": "md"
+    JSON文字列のメッセージをプッシュ送信する
+    https://developers.line.biz/ja/reference/messaging-api/#send-push-message
+
+    Parameters
+    ----------
+    channel_access_token : str
+        OAのチャネルアクセストークン
+    user_id : str
+        送信対象のユーザーID
+    message_json : str
+        メッセージオブジェクトのJSON文字列
+    retry_key : str, optional
+        リトライキー(UUID)。指定が無い場合は新規に発行する。
+    """
+    headers, body = _push_request(
+        channel_access_token, user_id, message_json, retry_key)
+    response = http_client.request(
+        'POST', PUSH_URL, headers=headers, data=body)
+    _check_push_response(response.status_code, response.text)
+
+
+async def apush_message_json(client, channel_access_token, user_id,
+                             message_json, retry_key=None):
+    """
+    JSON文字列のメッセージをプッシュ送信する(非同期版)
+
+    Parameters
+    ----------
+    client : httpx.AsyncClient
+        HTTPクライアント
+    channel_access_token : str
+        OAのチャネルアクセストークン
+    user_id : str
+        送信対象のユーザーID
+    message_json : str
+        メッセージオブジェクトのJSON文字列
+    retry_key : str, optional
+        リトライキー(UUID)。指定が無い場合は新規に発行する。
+    """
+    headers, body = _push_request(
+        channel_access_token, user_id, message_json, retry_key)
+    response = await client.post(PUSH_URL, headers=headers, content=body)
+    _check_push_response(response.status_code, response.text)
+
+
+def _push_request(channel_access_token, user_id, message_json, retry_key):
+    """プッシュ送信のリクエストヘッダーとボディを作成する"""
+    headers = {
+        'Authorization': 'Bearer ' + channel_access_token,
+        'Content-Type': 'application/json',
+        'X-Line-Retry-Key': retry_key or str(uuid.uuid4()),
     }
+    body = '{"to":%s,"messages":[%s]}' % (json.dumps(user_id), message_json)
+    return headers, body.encode('utf-8')
+
+
+def _check_push_response(status_code, text):
+    """プッシュ送信のレスポンスを確認し、失敗した場合は例外を送出する"""
+    # 409は同じリトライキーのリクエストが受理済みのため成功として扱う
+    if status_code in (200, 409):
+        return
+    logger.error('Got exception from LINE Messaging API: %s %s',
+                 status_code, text)
+    raise MessagingApiError(status_code, text)
+
+
+def is_retryable_error(error):
+    """
+    送信エラーが再送で回復する可能性があるか判定する
+
+    Parameters
+    ----------
+    error : Exception
+        送信時に発生した例外
+
+    Returns
+    -------
+    result : bool
+        429/5xx、通信エラーの場合True
     """
+    if isinstance(error, MessagingApiError):
+        return error.status_code == 429 or error.status_code >= 500
+    return True
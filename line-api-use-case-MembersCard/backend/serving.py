@@ -0,0 +1,193 @@
+"""
+gunicornの起動設定モジュール
+
+SERVING_PROFILEで起動方法を選択する。
+    gthread: スレッドのワーカー。ワーカーごとにアプリケーションを読み込む
+    preload: スレッドのワーカー。親プロセスでアプリケーションを読み込んでからフォークする
+    gevent: geventのワーカー。1プロセスで多数の接続を処理する
+    asgi: uvicornのワーカーで非同期版(asgi_app)を起動する。init/buyと/metricsは
+          イベントループで処理し、それ以外(lookup、/pos/transactions、/reports/daily、
+          /diagnostics/*)はワーカー内でmain.appをGUNICORN_THREADS個のスレッドで実行する
+ワーカー数はコンテナのCPUの割り当て(cgroupのクォータとCPUアフィニティ)から求める。
+preloadの場合、Firestoreクライアントや接続プールは親プロセスでは作成せず、
+フォーク後にワーカーごとに作成する(gRPCのチャネルやソケットはプロセス間で共有できない)。
+
+使い方(backendディレクトリで実行):
+    gunicorn -c serving.py
+    python serving.py  # 選択される設定を表示する
+"""
+import os
+import sys
+import json
+import math
+
+# 環境変数の宣言
+# gthread, preload, gevent, asgi のいずれか
+SERVING_PROFILE = os.getenv('SERVING_PROFILE', 'gthread')
+# 使用するCPU数(指定が無い場合はコンテナの割り当てから求める)
+SERVING_CPUS = os.getenv('SERVING_CPUS', '')
+# ワーカー数(指定が無い場合はCPU数×GUNICORN_WORKERS_PER_CPU)
+GUNICORN_WORKERS = os.getenv('GUNICORN_WORKERS', '')
+GUNICORN_WORKERS_PER_CPU = float(os.getenv('GUNICORN_WORKERS_PER_CPU', '1'))
+# スレッドのワーカー、およびasgiでmain.appを実行するスレッドの数
+GUNICORN_THREADS = int(os.getenv('GUNICORN_THREADS', '8'))
+# geventのワーカー1つあたりの同時接続数
+GEVENT_CONNECTIONS = int(os.getenv('GEVENT_CONNECTIONS', '256'))
+PORT = os.getenv('PORT', '8080')
+
+# cgroup v2のCPUクォータ("クォータ 期間"、制限が無い場合はクォータが"max")
+CGROUP_V2_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+# cgroup v1のCPUクォータのディレクトリ(制限が無い場合はcpu.cfs_quota_usが-1)
+CGROUP_V1_CPU_DIRS = ('/sys/fs/cgroup/cpu', '/sys/fs/cgroup/cpu,cpuacct')
+
+PROFILES = {
+    'gthread': {'worker_class': 'gthread', 'preload_app': False,
+                'wsgi_app': 'main:app'},
+    'preload': {'worker_class': 'gthread', 'preload_app': True,
+                'wsgi_app': 'main:app'},
+    'gevent': {'worker_class': 'gevent', 'preload_app': False,
+               'wsgi_app': 'main:app'},
+    'asgi': {'worker_class': 'uvicorn.workers.UvicornWorker',
+             'preload_app': False, 'wsgi_app': 'asgi_app:app'},
+}
+
+
+def _read(path):
+    """ファイルの内容を取得する。読めない場合はNone"""
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cpu_quota():
+    """
+    cgroupのCPUクォータを取得する
+
+    Returns
+    -------
+    quota : float
+        割り当てられたCPU数(0.5等の小数を含む)。制限が無い・取得できない場合はNone
+    """
+    value = _read(CGROUP_V2_CPU_MAX)
+    if value is not None:
+        quota, _, period = value.partition(' ')
+        if quota == 'max':
+            return None
+        try:
+            return int(quota) / int(period or 100000)
+        except ValueError:
+            return None
+    for directory in CGROUP_V1_CPU_DIRS:
+        quota = _read(os.path.join(directory, 'cpu.cfs_quota_us'))
+        period = _read(os.path.join(directory, 'cpu.cfs_period_us'))
+        if quota is None or period is None:
+            continue
+        try:
+            quota, period = int(quota), int(period)
+        except ValueError:
+            return None
+        return quota / period if quota > 0 and period > 0 else None
+    return None
+
+
+def available_cpus():
+    """
+    使用できるCPU数を求める。
+    SERVING_CPUSの指定、cgroupのクォータ(切り上げ)、CPUアフィニティの少ない方とする。
+
+    Returns
+    -------
+    cpus : int
+        CPU数(1以上)
+    """
+    if SERVING_CPUS:
+        return max(1, int(SERVING_CPUS))
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+
+def profile_settings(profile=SERVING_PROFILE, cpus=None):
+    """
+    起動方法とCPU数に応じたgunicornの設定を作成する
+
+    Parameters
+    ----------
+    profile : str
+        gthread, preload, gevent, asgi のいずれか
+    cpus : int, optional
+        CPU数。指定が無い場合はavailable_cpusで求める
+
+    Returns
+    -------
+    settings : dict
+        gunicornの設定名と値
+    """
+    if profile not in PROFILES:
+        raise ValueError('未対応の起動方法です: %s' % profile)
+    if cpus is None:
+        cpus = available_cpus()
+    settings = dict(PROFILES[profile])
+    settings.update({
+        'bind': ':%s' % PORT,
+        'workers': int(GUNICORN_WORKERS) if GUNICORN_WORKERS
+        else max(1, round(cpus * GUNICORN_WORKERS_PER_CPU)),
+        # Cloud Runがインスタンスのスケールを管理するため、ワーカーのタイムアウトは無効にする
+        'timeout': 0,
+    })
+    if settings['worker_class'] == 'gthread':
+        settings['threads'] = GUNICORN_THREADS
+    elif settings['worker_class'] == 'gevent':
+        settings['worker_connections'] = GEVENT_CONNECTIONS
+    return settings
+
+
+def post_fork(server, worker):
+    """
+    ワーカーのフォーク直後に呼び出されるgunicornのフック。
+    preloadで親プロセスが読み込んだアプリケーションのオブジェクトを作り直す。
+    """
+    # preload以外ではアプリケーションはフォーク後に読み込むため、作り直す対象が無い
+    startup = sys.modules.get('common.startup')
+    if startup is not None:
+        startup.after_fork()
+
+
+def post_worker_init(worker):
+    """
+    ワーカーの初期化後に呼び出されるgunicornのフック。
+    geventのワーカーでは、gRPC(Firestore)がgeventのイベントループで動作するよう設定する。
+    """
+    if worker.cfg.worker_class_str != 'gevent':
+        return
+    try:
+        from grpc.experimental import gevent as grpc_gevent
+    except ImportError:
+        return
+    grpc_gevent.init_gevent()
+
+
+if __name__ == '__main__':
+    print(json.dumps(dict(profile_settings(), cpus=available_cpus(),
+                          cpuQuota=cpu_quota()), ensure_ascii=False))
+else:
+    # gunicornは設定ファイルのモジュール変数のうち、設定名と一致するものを読み込む
+    globals().update(profile_settings())
+    if SERVING_PROFILE == 'gevent':
+        # 1つのワーカーで多数の接続を処理するため、外部APIの接続プールも同数にする
+        os.environ.setdefault('HTTP_POOL_MAXSIZE', str(GEVENT_CONNECTIONS))
+    elif SERVING_PROFILE == 'asgi':
+        # init/buy以外のリクエストをmain.appで処理するスレッドの数
+        os.environ.setdefault('ASGI_WSGI_THREADS', str(GUNICORN_THREADS))
+    if PROFILES[SERVING_PROFILE]['preload_app']:
+        # 親プロセスではFirestoreクライアント等を作成せず、フォーク後に作成する
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        from common import startup as _startup
+        _startup.defer_until_fork()
@@ -0,0 +1,9 @@
+"""
+テスト共通の設定
+
+backendディレクトリのモジュールをテストから読み込めるようにする。
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,93 @@
+"""
+一斉送信(Broadcaster)のテスト
+
+再送を含む全てのリクエストがレート制限を通ること、429の場合に
+Retry-Afterの秒数待ってから同じリトライキーで再送することを確認する。
+"""
+import pytest
+import broadcast
+from broadcast import Broadcaster
+from send_message import MessagingApiError, parse_retry_after
+
+
+class Response:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = ''
+
+
+class CountingLimiter:
+    def __init__(self):
+        self.acquired = 0
+
+    def acquire(self, tokens=1):
+        self.acquired += tokens
+
+
+@pytest.fixture
+def requests(monkeypatch):
+    sent = []
+    responses = []
+
+    def request(method, url, headers=None, data=None):
+        sent.append(headers['X-Line-Retry-Key'])
+        return responses.pop(0)
+
+    monkeypatch.setattr(broadcast.http_client, 'request', request)
+    return sent, responses
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(broadcast.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+def make_broadcaster():
+    broadcaster = Broadcaster('token')
+    broadcaster._limiter = CountingLimiter()
+    return broadcaster
+
+
+def test_every_attempt_takes_a_token(requests, sleeps):
+    sent, responses = requests
+    responses.extend([Response(500), Response(503), Response(200)])
+    broadcaster = make_broadcaster()
+    broadcaster.multicast(['U1'], '{}')
+    assert broadcaster._limiter.acquired == 3
+    assert len(set(sent)) == 1
+
+
+def test_retry_after_is_honoured(requests, sleeps):
+    sent, responses = requests
+    responses.extend([Response(429, {'Retry-After': '7'}), Response(200)])
+    make_broadcaster().multicast(['U1'], '{}')
+    assert sleeps == [7.0]
+
+
+def test_retry_after_is_capped(requests, sleeps, monkeypatch):
+    monkeypatch.setattr(broadcast, 'MULTICAST_MAX_RETRY_AFTER', 10)
+    sent, responses = requests
+    responses.extend([Response(429, {'Retry-After': '3600'}), Response(200)])
+    make_broadcaster().multicast(['U1'], '{}')
+    assert sleeps == [10]
+
+
+def test_client_error_is_not_retried(requests, sleeps):
+    sent, responses = requests
+    responses.append(Response(400))
+    broadcaster = make_broadcaster()
+    with pytest.raises(MessagingApiError):
+        broadcaster.multicast(['U1'], '{}')
+    assert broadcaster._limiter.acquired == 1
+    assert sleeps == []
+
+
+@pytest.mark.parametrize('value, seconds', [
+    ('5', 5.0), (' 12 ', 12.0), (None, None), ('', None),
+    ('Wed, 21 Oct 2015 07:28:00 GMT', None), ('-1', None),
+])
+def test_parse_retry_after(value, seconds):
+    assert parse_retry_after(value) == seconds
@@ -0,0 +1,131 @@
+"""
+初回のinitの同時実行のテスト
+
+同じユーザーのinitを複数スレッドから同時に呼び出した場合に、会員データの作成が
+1回だけ行われ、全ての呼び出しに同じ結果が返却されることを確認する。
+"""
+import time
+import threading
+import pytest
+from barcode_allocator import to_barcode
+from common.fake_firestore import FakeFirestoreClient
+from common.single_flight import SingleFlight
+from members_card_user_info import (
+    MembersCardUserInfo, barcode_index_ref, is_already_exists, VERSION_FIELD)
+
+THREADS = 16
+USER_ID = 'U%032d' % 1
+TIMEOUT = 10
+
+
+def run_concurrently(func, count=THREADS):
+    """
+    複数スレッドから同時に処理を呼び出す
+
+    Returns
+    -------
+    outcomes : list
+        スレッドごとの(結果, 例外)
+    """
+    barrier = threading.Barrier(count)
+    outcomes = [None] * count
+
+    def worker(index):
+        barrier.wait()
+        try:
+            outcomes[index] = (func(index), None)
+        except Exception as e:
+            outcomes[index] = (None, e)
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(TIMEOUT)
+    assert all(outcome is not None for outcome in outcomes)
+    return outcomes
+
+
+def wait_until(predicate):
+    """条件が満たされるまで待つ"""
+    deadline = time.monotonic() + TIMEOUT
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+class GatedAllocator:
+    """他の呼び出しが実行中の処理を待ち始めるまで採番を止めるバーコード採番クラス"""
+
+    def __init__(self, flight, waiters):
+        self._flight = flight
+        self._waiters = waiters
+        self.calls = 0
+
+    def allocate(self):
+        self.calls += 1
+        wait_until(lambda: self._flight.shared >= self._waiters)
+        return to_barcode(self.calls)
+
+
+@pytest.fixture
+def db():
+    return FakeFirestoreClient(latency=0.001)
+
+
+def test_single_flight_shares_one_result():
+    flight = SingleFlight()
+    calls = []
+
+    def func():
+        calls.append(None)
+        wait_until(lambda: flight.shared == THREADS - 1)
+        return {'userId': USER_ID}
+
+    outcomes = run_concurrently(lambda _: flight.do(USER_ID, func))
+    assert len(calls) == 1
+    results = [result for result, error in outcomes]
+    assert all(result is results[0] for result in results)
+
+
+def test_put_item_creates_member_only_once(db):
+    table = MembersCardUserInfo(db)
+    outcomes = run_concurrently(
+        lambda i: table.put_item(USER_ID, to_barcode(i + 1), '', 0))
+
+    winners = [i for i, (result, error) in enumerate(outcomes)
+               if error is None]
+    assert len(winners) == 1
+    assert all(is_already_exists(error)
+               for result, error in outcomes if error is not None)
+    assert db.commits == 1
+    # 失敗した登録のバーコード番号の索引は作成されない
+    barcode_num = table.get_item(USER_ID)['barcodeNum']
+    assert barcode_num == to_barcode(winners[0] + 1)
+    for i in range(THREADS):
+        assert barcode_index_ref(db, to_barcode(i + 1)).get().exists == (
+            i == winners[0])
+
+
+def test_init_flight_creates_member_once(db, monkeypatch):
+    pytest.importorskip('flask')
+    import main
+    flight = SingleFlight()
+    allocator = GatedAllocator(flight, THREADS - 1)
+    monkeypatch.setattr(main, 'init_flight', flight)
+    monkeypatch.setattr(main, 'user_info_table_controller',
+                        MembersCardUserInfo(db))
+    monkeypatch.setattr(main, 'barcode_allocator', allocator)
+
+    outcomes = run_concurrently(
+        lambda _: main.init_flight.do(USER_ID, lambda: main.init(USER_ID)))
+
+    assert [error for result, error in outcomes] == [None] * THREADS
+    assert allocator.calls == 1
+    assert db.commits == 1
+    results = [result for result, error in outcomes]
+    assert all(result is results[0] for result in results)
+    stored = main.user_info_table_controller.get_item(USER_ID)
+    assert results[0]['barcodeNum'] == stored['barcodeNum']
+    assert results[0][VERSION_FIELD] == stored[VERSION_FIELD]
@@ -0,0 +1,95 @@
+"""
+ポイントキャンペーンのバッチジョブ(PointCampaignJob)のテスト
+
+加算済みの会員を二重に加算しないこと、コミットに失敗し続けたバッチが
+失敗として記録されることを確認する。
+"""
+import pytest
+import point_campaign
+from common import fake_firestore
+from point_campaign import Checkpoint, PointCampaignJob
+
+USER_IDS = ['U%032d' % i for i in range(10)]
+
+
+class RacingBatch(fake_firestore.FakeWriteBatch):
+    """コミットの直前に、他の実行が先頭の会員を加算したものとして完了マーカーを作成する"""
+
+    def commit(self):
+        client = self._client
+        if client.races:
+            client.races -= 1
+            marker = client.collection('PointCampaigns').document(
+                'test').collection('members').document(USER_IDS[0])
+            if not marker.get().exists:
+                marker.create({'point': 0})
+                client.document('MembersCardUserInfo/' + USER_IDS[0]).update(
+                    {'point': fake_firestore.Increment(100)})
+        return super().commit()
+
+
+class RacingFirestoreClient(fake_firestore.FakeFirestoreClient):
+    """コミットのたびに完了マーカーの作成が競合するFirestore"""
+
+    def __init__(self, races):
+        super().__init__()
+        self.races = races
+
+    def batch(self):
+        return RacingBatch(self)
+
+
+@pytest.fixture(autouse=True)
+def fake_increment(monkeypatch):
+    # インメモリのFirestoreの加算を使用し、再試行の待ち時間を省く
+    monkeypatch.setattr(point_campaign, 'increment', fake_firestore.Increment)
+    monkeypatch.setattr(point_campaign.time, 'sleep', lambda seconds: None)
+
+
+def add_members(db):
+    for user_id in USER_IDS:
+        db.collection('MembersCardUserInfo').document(user_id).set(
+            {'userId': user_id, 'point': 0})
+
+
+def points(db):
+    return [db.collection('MembersCardUserInfo').document(user_id).get()
+            .to_dict()['point'] for user_id in USER_IDS]
+
+
+def run(db, batch_size=5):
+    job = PointCampaignJob(db, 'test', 100, Checkpoint(None),
+                           batch_size=batch_size, workers=2)
+    return job.run(USER_IDS)
+
+
+def test_rerun_does_not_credit_twice():
+    db = fake_firestore.FakeFirestoreClient()
+    add_members(db)
+    assert run(db)['credited'] == len(USER_IDS)
+    report = run(db)
+    assert report['credited'] == 0
+    assert report['alreadyCredited'] == len(USER_IDS)
+    assert points(db) == [100] * len(USER_IDS)
+
+
+def test_race_is_retried_without_using_attempts():
+    db = RacingFirestoreClient(races=1)
+    add_members(db)
+    report = run(db, batch_size=len(USER_IDS))
+    assert report['failedBatches'] == []
+    assert report['credited'] == len(USER_IDS) - 1
+    assert points(db) == [100] * len(USER_IDS)
+
+
+def test_batch_failing_on_every_attempt_is_recorded(monkeypatch):
+    db = fake_firestore.FakeFirestoreClient()
+    add_members(db)
+
+    def fail(self):
+        raise fake_firestore.AlreadyExists('conflict')
+
+    monkeypatch.setattr(fake_firestore.FakeWriteBatch, 'commit', fail)
+    report = run(db)
+    assert report['failedBatches'] == [0, 1]
+    assert report['credited'] == 0
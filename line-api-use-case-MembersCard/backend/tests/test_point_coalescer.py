@@ -0,0 +1,94 @@
+"""
+POSレジの取引のポイント加算(PointCoalescer)のテスト
+
+同じ店舗ID・取引IDの取引を再送した場合に、ポイントが1回のみ加算されることを確認する。
+"""
+import pytest
+import point_ledger
+import members_card_user_info
+from common import fake_firestore
+from members_card_user_info import MembersCardUserInfo
+from point_coalescer import PointCoalescer
+
+EXPIRATION_DATE = '2030/12/31'
+TIMEOUT = 10
+
+
+@pytest.fixture
+def table(monkeypatch):
+    # インメモリのFirestoreの加算を使用する
+    monkeypatch.setattr(members_card_user_info, 'increment',
+                        fake_firestore.Increment)
+    table = MembersCardUserInfo(fake_firestore.FakeFirestoreClient())
+    for user_id in ('UA', 'UB'):
+        table.put_item(user_id, int(user_id == 'UB'), '', 0)
+    return table
+
+
+@pytest.fixture
+def coalescer(table):
+    coalescer = PointCoalescer(table, window=0.01)
+    yield coalescer
+    coalescer.stop()
+
+
+def submit(coalescer, user_id, points, transaction_id, store_id='store-1'):
+    ledger = point_ledger.ledger_entry(
+        user_id, points, points * 20, store_id, 'pos',
+        transaction_id=transaction_id)
+    return coalescer.submit(user_id, points, EXPIRATION_DATE, ledger)
+
+
+def points(table, user_id):
+    return table.get_item(user_id)['point']
+
+
+def test_resent_transaction_is_credited_once(table, coalescer):
+    assert submit(coalescer, 'UA', 10, 'T1').result(TIMEOUT) is True
+    assert submit(coalescer, 'UA', 10, 'T1').result(TIMEOUT) is True
+    assert points(table, 'UA') == 10
+    assert coalescer.duplicates == 1
+
+
+def test_same_transaction_in_one_window_shares_future(table, coalescer):
+    first = submit(coalescer, 'UA', 10, 'T1')
+    assert submit(coalescer, 'UA', 10, 'T1') is first
+    assert first.result(TIMEOUT) is True
+    assert points(table, 'UA') == 10
+
+
+def test_duplicate_does_not_fail_other_transactions(table, coalescer):
+    submit(coalescer, 'UA', 10, 'T1').result(TIMEOUT)
+    futures = [submit(coalescer, 'UA', 10, 'T1'),
+               submit(coalescer, 'UA', 5, 'T2'),
+               submit(coalescer, 'UB', 7, 'T3')]
+    assert [future.result(TIMEOUT) for future in futures] == [True] * 3
+    assert points(table, 'UA') == 15
+    assert points(table, 'UB') == 7
+    assert coalescer.duplicates == 1
+
+
+def test_transaction_id_is_scoped_to_store(table, coalescer):
+    submit(coalescer, 'UA', 10, 'T1', store_id='store-1').result(TIMEOUT)
+    submit(coalescer, 'UA', 10, 'T1', store_id='store-2').result(TIMEOUT)
+    assert points(table, 'UA') == 20
+
+
+def test_transactions_without_id_are_not_deduplicated(table, coalescer):
+    submit(coalescer, 'UA', 10, None).result(TIMEOUT)
+    submit(coalescer, 'UA', 10, None).result(TIMEOUT)
+    assert points(table, 'UA') == 20
+
+
+@pytest.mark.parametrize('transaction_id, valid', [
+    ('T0000000001', True),
+    ('a-b_c', True),
+    ('x' * 128, True),
+    ('x' * 129, False),
+    ('', False),
+    ('a/b', False),
+    ('取引', False),
+    (1, False),
+])
+def test_is_valid_transaction_id(transaction_id, valid):
+    assert point_ledger.is_valid_transaction_id(transaction_id) is valid
@@ -0,0 +1,89 @@
+"""
+金額計算(pricing)のテスト
+
+ランダムに生成したカートについて、整数演算の結果を10進(Decimal)で計算した
+参照実装の結果と比較する。
+"""
+import math
+import random
+from decimal import Decimal, ROUND_FLOOR
+import pytest
+import pricing
+
+SEED = 20210101
+CARTS = 20000
+
+
+def reference(amounts, fee, postage, discount):
+    """文字列から生成した率で10進で厳密に計算した結果"""
+    merchandise = sum(amounts)
+    subtotal = merchandise + postage + fee - discount
+    tax = int((subtotal * Decimal('0.10')).to_integral_value(ROUND_FLOOR))
+    point = int((merchandise * Decimal('0.05')).to_integral_value(
+        ROUND_FLOOR))
+    return {'subtotal': subtotal, 'tax': tax, 'total': subtotal + tax,
+            'point': point}
+
+
+def legacy(amounts, fee, postage, discount):
+    """整数化する前のDecimal(0.10)、Decimal(0.05)による計算結果"""
+    subtotal = sum(amounts) + postage + fee - discount
+    tax = math.floor(subtotal * Decimal(0.10))
+    point = math.floor(sum(amount * Decimal(0.05) for amount in amounts))
+    return {'subtotal': subtotal, 'tax': tax, 'total': subtotal + tax,
+            'point': point}
+
+
+def random_cart(rng):
+    """明細金額・決済手数料・送料・値引き額をランダムに生成する"""
+    amounts = [rng.randrange(1, 1000) * rng.choice((1, 10, 100))
+               * rng.randrange(1, 10)
+               for _ in range(rng.randrange(1, 51))]
+    return (amounts, rng.choice((0, 300)), rng.choice((0, 500)),
+            rng.randrange(0, 1000) * rng.choice((1, 10, 100)))
+
+
+@pytest.fixture(scope='module')
+def carts():
+    rng = random.Random(SEED)
+    return [random_cart(rng) for _ in range(CARTS)]
+
+
+def test_price_cart_matches_decimal_reference(carts):
+    for cart in carts:
+        assert pricing.price_cart(*cart) == reference(*cart), cart
+
+
+def test_price_cart_matches_legacy_for_non_negative_subtotal(carts):
+    # 小計が負の10の倍数の場合のみ、floatの誤差で従来の計算は1円少なくなる
+    checked = 0
+    for cart in carts:
+        result = pricing.price_cart(*cart)
+        if result['subtotal'] < 0:
+            continue
+        assert result == legacy(*cart), cart
+        checked += 1
+    assert checked > CARTS // 2
+
+
+def test_price_carts_matches_price_cart(carts):
+    assert pricing.price_carts(carts[:100]) == [
+        pricing.price_cart(*cart) for cart in carts[:100]]
+
+
+@pytest.mark.parametrize('rounding, mode', [
+    (pricing.ROUND_FLOOR, 'ROUND_FLOOR'),
+    (pricing.ROUND_CEILING, 'ROUND_CEILING'),
+    (pricing.ROUND_HALF_UP, 'ROUND_HALF_UP'),
+])
+def test_apply_rate_rounding_boundaries(rounding, mode):
+    for rate_bp in (1, 500, 1000, 3333):
+        rate = Decimal(rate_bp) / pricing.BASIS_POINTS
+        for amount in range(-500, 501):
+            expected = int((amount * rate).to_integral_value(mode))
+            assert pricing.apply_rate(amount, rate_bp, rounding) == expected
+
+
+def test_apply_rate_rejects_unknown_rounding():
+    with pytest.raises(ValueError):
+        pricing.apply_rate(100, 500, 'banker')
@@ -0,0 +1,435 @@
+"""
+LIFFのIDトークン検証用モジュール
+
+LINEの公開鍵(JWKS)をキャッシュし、ES256署名・aud・iss・exp・nonceを
+ローカルで検証する。ローカル検証ができない場合はLINEの検証APIにフォールバックする。
+https://developers.line.biz/ja/docs/line-login/verify-id-token/
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from common import http_client
+from common.ttl_cache import TTLCache
+
+# 環境変数の宣言
+JWKS_URL = os.getenv(
+    'LINE_JWKS_URL', 'https://api.line.me/oauth2/v2.1/certs')
+VERIFY_URL = os.getenv(
+    'LINE_VERIFY_URL', 'https://api.line.me/oauth2/v2.1/verify')
+JWKS_CACHE_TTL = int(os.getenv('LINE_JWKS_CACHE_TTL', '3600'))
+# local: ローカル検証のみ / remote: 検証APIのみ / local_with_fallback: ローカル検証後、失敗時に検証API
+TOKEN_VERIFY_MODE = os.getenv('TOKEN_VERIFY_MODE', 'local_with_fallback')
+# 検証済みトークンのキャッシュ件数(0の場合キャッシュしない)
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', '10000'))
+
+ISSUER = 'https://access.line.me'
+ALGORITHMS = ['ES256']
+# unknown kid による再取得の最短間隔(秒)
+JWKS_MIN_REFRESH_INTERVAL = 10
+# exp判定の許容誤差(秒)
+LEEWAY = 5
+
+logger = logging.getLogger(__name__)
+
+
+class TokenVerificationError(Exception):
+    """IDトークンが不正な場合の例外"""
+
+
+class TokenExpiredError(TokenVerificationError):
+    """IDトークンの有効期限が切れている場合の例外"""
+
+
+class JwksCache:
+    """LINEの公開鍵をkid単位で保持するキャッシュクラス"""
+    __slots__ = ['_url', '_ttl', '_keys', '_fetched_at', '_lock', '_alock']
+
+    def __init__(self, url=JWKS_URL, ttl=JWKS_CACHE_TTL):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        url : str
+            JWKSの取得先URL
+        ttl : int
+            キャッシュの有効期間(秒)
+        """
+        self._url = url
+        self._ttl = ttl
+        self._keys = {}
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        # 非同期版の再取得用のロック(イベントループ上で最初に使用する時に作成する)
+        self._alock = None
+
+    def get_key(self, kid):
+        """
+        kidに対応する公開鍵を取得する。
+        TTL切れ、または未知のkidの場合はJWKSを再取得する。
+
+        Parameters
+        ----------
+        kid : str
+            JWTヘッダーのkid
+
+        Returns
+        -------
+        key : EllipticCurvePublicKey
+            公開鍵。見つからない場合はNone
+        """
+        key, stale = self._lookup(kid)
+        if not stale:
+            return key
+
+        with self._lock:
+            # 他スレッドが更新済みの場合は再取得しない
+            key, stale = self._lookup(kid)
+            if not stale:
+                return key
+            self._refresh()
+            return self._keys.get(kid)
+
+    async def aget_key(self, kid, client):
+        """
+        kidに対応する公開鍵を取得する(非同期版)。
+        JWKSの再取得はイベントループを止めないよう、httpxのクライアントで行う。
+
+        Parameters
+        ----------
+        kid : str
+            JWTヘッダーのkid
+        client : httpx.AsyncClient
+            JWKSの取得に使用するHTTPクライアント
+
+        Returns
+        -------
+        key : EllipticCurvePublicKey
+            公開鍵。見つからない場合はNone
+        """
+        key, stale = self._lookup(kid)
+        if not stale:
+            return key
+
+        if self._alock is None:
+            self._alock = asyncio.Lock()
+        async with self._alock:
+            # 待っている間に他のリクエストが更新済みの場合は再取得しない
+            key, stale = self._lookup(kid)
+            if not stale:
+                return key
+            response = await client.get(self._url)
+            response.raise_for_status()
+            self._replace(response.json())
+            return self._keys.get(kid)
+
+    def _lookup(self, kid):
+        """
+        キャッシュから公開鍵を取得し、再取得が必要かを判定する
+
+        Returns
+        -------
+        key : EllipticCurvePublicKey
+            公開鍵。見つからない場合はNone
+        stale : bool
+            JWKSを再取得する必要がある場合True
+        """
+        key = self._keys.get(kid)
+        elapsed = time.monotonic() - self._fetched_at
+        if key is not None:
+            return key, elapsed >= self._ttl
+        # 未知のkidによる再取得は最短間隔を空ける
+        return None, elapsed >= JWKS_MIN_REFRESH_INTERVAL
+
+    def _refresh(self):
+        """JWKSを取得してキャッシュを置き換える"""
+        response = http_client.request('GET', self._url)
+        response.raise_for_status()
+        self._replace(response.json())
+
+    def _replace(self, jwks):
+        """取得したJWKSでキャッシュを置き換える"""
+        from jwt.algorithms import ECAlgorithm
+        keys = {}
+        for jwk in jwks.get('keys', []):
+            if jwk.get('kty') != 'EC':
+                continue
+            keys[jwk['kid']] = ECAlgorithm.from_jwk(json.dumps(jwk))
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+        logger.info('JWKSを更新しました kids: %s', list(keys))
+
+
+class IdTokenVerifier:
+    """IDトークン検証クラス"""
+    __slots__ = ['_channel_id', '_mode', '_jwks', '_cache']
+
+    def __init__(self, channel_id, mode=TOKEN_VERIFY_MODE, jwks_cache=None,
+                 cache_size=TOKEN_CACHE_SIZE):
+        """
+        初期化メソッド
+
+        Parameters
+        ----------
+        channel_id : str
+            LIFFアプリを追加したLINEログインチャネルのチャネルID
+        mode : str
+            local, remote, local_with_fallback のいずれか
+        jwks_cache : JwksCache, optional
+            公開鍵キャッシュ。指定が無い場合は新規に作成する。
+        cache_size : int, optional
+            検証済みトークンのキャッシュ件数。0の場合キャッシュしない。
+        """
+        self._channel_id = channel_id
+        self._mode = mode
+        self._jwks = jwks_cache or JwksCache()
+        self._cache = TTLCache(cache_size) if cache_size > 0 else None
+
+    def verify(self, id_token, nonce=None):
+        """
+        IDトークンを検証し、ペイロードを返す
+
+        Parameters
+        ----------
+        id_token : str
+            LIFFで取得したIDトークン
+        nonce : str, optional
+            期待するnonce。指定が無い場合は検証しない。
+
+        Returns
+        -------
+        claims : dict
+            検証済みのIDトークンのペイロード
+
+        Raises
+        ------
+        TokenExpiredError
+            有効期限切れの場合
+        TokenVerificationError
+            その他の理由で検証に失敗した場合
+        """
+        if self._cache is None:
+            return self._verify(id_token, nonce)
+
+        # 同一トークンの再検証を避けるため、検証結果をトークンの有効期限までキャッシュする
+        cache_key = (hashlib.sha256(id_token.encode()).digest(), nonce)
+        claims = self._cache.get(cache_key)
+        if claims is None:
+            claims = self._verify(id_token, nonce)
+            self._cache.set(cache_key, claims, expires_at=claims.get('exp'))
+        return claims
+
+    async def averify(self, id_token, client, nonce=None):
+        """
+        IDトークンを検証し、ペイロードを返す(非同期版)。
+        ローカル検証はCPU処理のみのためそのまま実行し、公開鍵の再取得と
+        検証APIの呼び出しは非同期で行う。
+
+        Parameters
+        ----------
+        id_token : str
+            LIFFで取得したIDトークン
+        client : httpx.AsyncClient
+            検証APIの呼び出しに使用するHTTPクライアント
+        nonce : str, optional
+            期待するnonce。指定が無い場合は検証しない。
+
+        Returns
+        -------
+        claims : dict
+            検証済みのIDトークンのペイロード
+        """
+        cache_key = (hashlib.sha256(id_token.encode()).digest(), nonce)
+        if self._cache is not None:
+            claims = self._cache.get(cache_key)
+            if claims is not None:
+                return claims
+        if self._mode == 'remote':
+            claims = await self.averify_remote(id_token, client, nonce)
+        else:
+            try:
+                claims = await self.averify_local(
+                    id_token, client, nonce)
+            except TokenVerificationError:
+                raise
+            except Exception:
+                if self._mode != 'local_with_fallback':
+                    raise TokenVerificationError('ローカル検証に失敗しました')
+                logger.warning('ローカル検証ができないため検証APIを使用します',
+                               exc_info=True)
+                claims = await self.averify_remote(id_token, client, nonce)
+        if self._cache is not None:
+            self._cache.set(cache_key, claims, expires_at=claims.get('exp'))
+        return claims
+
+    def _verify(self, id_token, nonce):
+        """キャッシュを介さずにIDトークンを検証する"""
+        if self._mode == 'remote':
+            return self.verify_remote(id_token, nonce)
+        try:
+            return self.verify_local(id_token, nonce)
+        except TokenVerificationError:
+            raise
+        except Exception:
+            # 公開鍵が取得できない、ES256以外のトークン等
+            if self._mode != 'local_with_fallback':
+                raise TokenVerificationError('ローカル検証に失敗しました')
+            logger.warning('ローカル検証ができないため検証APIを使用します',
+                           exc_info=True)
+            return self.verify_remote(id_token, nonce)
+
+    def cache_stats(self):
+        """
+        検証済みトークンキャッシュの統計情報を取得する
+
+        Returns
+        -------
+        stats : dict
+            ヒット数、ミス数等。キャッシュ無効時は空のdict
+        """
+        if self._cache is None:
+            return {}
+        return self._cache.stats()
+
+    def verify_local(self, id_token, nonce=None):
+        """
+        IDトークンを公開鍵でローカル検証する
+
+        Parameters
+        ----------
+        id_token : str
+            LIFFで取得したIDトークン
+        nonce : str, optional
+            期待するnonce
+
+        Returns
+        -------
+        claims : dict
+            検証済みのIDトークンのペイロード
+        """
+        key = self._jwks.get_key(self._kid(id_token))
+        return self._decode(id_token, key, nonce)
+
+    async def averify_local(self, id_token, client, nonce=None):
+        """
+        IDトークンを公開鍵でローカル検証する(非同期版)
+
+        Parameters
+        ----------
+        id_token : str
+            LIFFで取得したIDトークン
+        client : httpx.AsyncClient
+            公開鍵の再取得に使用するHTTPクライアント
+        nonce : str, optional
+            期待するnonce
+
+        Returns
+        -------
+        claims : dict
+            検証済みのIDトークンのペイロード
+        """
+        key = await self._jwks.aget_key(self._kid(id_token), client)
+        return self._decode(id_token, key, nonce)
+
+    @staticmethod
+    def _kid(id_token):
+        """IDトークンのヘッダーからkidを取得する"""
+        # PyJWT(cryptography)は読み込みに時間がかかるため、最初の検証時に読み込む
+        import jwt
+        header = jwt.get_unverified_header(id_token)
+        if header.get('alg') not in ALGORITHMS:
+            raise ValueError('未対応のアルゴリズムです: %s' % header.get('alg'))
+        return header.get('kid')
+
+    def _decode(self, id_token, key, nonce):
+        """公開鍵で署名とクレームを検証する"""
+        import jwt
+        if key is None:
+            raise TokenVerificationError('未知のkidです')
+
+        try:
+            claims = jwt.decode(
+                id_token,
+                key,
+                algorithms=ALGORITHMS,
+                audience=self._channel_id,
+                issuer=ISSUER,
+                leeway=LEEWAY,
+                options={'require': ['exp', 'sub']},
+            )
+        except jwt.ExpiredSignatureError:
+            raise TokenExpiredError('IDトークンの有効期限切れです')
+        except jwt.InvalidTokenError as e:
+            raise TokenVerificationError(str(e))
+
+        if nonce is not None and claims.get('nonce') != nonce:
+            raise TokenVerificationError('nonceが一致しません')
+        return claims
+
+    def verify_remote(self, id_token, nonce=None):
+        """
+        LINEの検証APIでIDトークンを検証する
+        https://developers.line.biz/ja/reference/line-login/#verify-id-token
+
+        Parameters
+        ----------
+        id_token : str
+            LIFFで取得したIDトークン
+        nonce : str, optional
+            期待するnonce
+
+        Returns
+        -------
+        claims : dict
+            検証済みのIDトークンのペイロード
+        """
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        response = http_client.request('POST', VERIFY_URL, headers=headers,
+                                       data=self._remote_body(id_token, nonce))
+        return self._parse_remote_response(response.text)
+
+    async def averify_remote(self, id_token, client, nonce=None):
+        """
+        LINEの検証APIでIDトークンを検証する(非同期版)
+
+        Parameters
+        ----------
+        id_token : str
+            LIFFで取得したIDトークン
+        client : httpx.AsyncClient
+            HTTPクライアント
+        nonce : str, optional
+            期待するnonce
+
+        Returns
+        -------
+        claims : dict
+            検証済みのIDトークンのペイロード
+        """
+        response = await client.post(
+            VERIFY_URL, data=self._remote_body(id_token, nonce))
+        return self._parse_remote_response(response.text)
+
+    def _remote_body(self, id_token, nonce):
+        """検証APIのリクエストボディを作成する"""
+        body = {
+            'id_token': id_token,
+            'client_id': self._channel_id
+        }
+        if nonce is not None:
+            body['nonce'] = nonce
+        return body
+
+    @staticmethod
+    def _parse_remote_response(text):
+        """検証APIのレスポンスからペイロードを取得する"""
+        claims = json.loads(text)
+        if 'error' in claims:
+            if 'expired' in claims.get('error_description', ''):
+                raise TokenExpiredError(claims['error_description'])
+            raise TokenVerificationError(claims.get('error_description'))
+        return claims
@@ -1,24 +1,41 @@
-window.addEventListener('DOMContentLoaded', function(){
-    let lang = getParam("lang");
-    const defaultLang = "ja";
-    const supportedLangList = ["ja"]
-    let jsonPath = ''
+// 言語設定の定数宣言(backend/content/localesの言語と合わせる)
+const defaultLang = "ja";
+const supportedLangList = ["ja", "en", "th", "zh-TW"];
 
-    if(supportedLangList.indexOf(lang) >= 0){
-        jsonPath = "lang_message/" + lang + ".json";
-        localStorage.setItem('locale', lang);
-    } else {
-        lang = localStorage.getItem('locale');
-        if(supportedLangList.indexOf(lang) >= 0){
-            jsonPath = 'lang_message/'+ lang + '.json';
-        }else {
-            jsonPath = 'lang_message/'+ defaultLang + '.json';
-        }
+/**
+ * 指定された言語に対応する言語を決定する
+ * 大文字小文字・区切り文字の違いと地域の指定(en-US等)を吸収し、未対応の場合は既定言語とする
+ * @param {String} lang
+ * @return {String} 対応する言語。該当が無い場合はnull
+ */
+function resolveLang(lang) {
+    if (!lang) return null;
+    const normalized = lang.replace("_", "-").toLowerCase();
+    const aliases = {"zh-hant": "zh-TW", "zh-hk": "zh-TW", "zh-mo": "zh-TW"};
+    const base = normalized.split("-")[0];
+    for (const candidate of [normalized, (aliases[normalized] || "").toLowerCase(), base]) {
+        const found = supportedLangList.find((supported) => supported.toLowerCase() === candidate);
+        if (found) return found;
     }
+    return null;
+}
+
+// URLパラメーター、前回の言語、既定言語の順に言語を決定する
+let lang = resolveLang(getParam("lang"));
+if (lang) {
+    localStorage.setItem('locale', lang);
+} else {
+    lang = resolveLang(localStorage.getItem('locale')) || defaultLang;
+}
 
+// 画面の文言とメッセージは1つのファイルにまとめて1度だけ読み込む
+const langMessages = fetch("lang_message/" + lang + ".json").then((response) => response.json());
+
+window.addEventListener('DOMContentLoaded', function(){
     var glot = new Glottologist();
-    glot.import(jsonPath).then(() => {
-        glot.render();
+    langMessages.then((data) => {
+        Object.keys(data).forEach((key) => glot.assign(key, data[key]));
+        glot.render(lang);
     });
 });
 
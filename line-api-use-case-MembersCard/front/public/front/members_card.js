@@ -2,17 +2,18 @@
 const FUNCTION_URL = "https://backend-xxxxxxxxxxx.run.app"; 
 const liffId = "xxxxxxxxx-xxxxxxxxx";
 
-// 言語設定の定数宣言
-const defaultLang = "ja";
-const supportedLangList = ["ja"]
-
-// グローバル変数の宣言
+// グローバル変数の宣言(言語の設定langはindex.jsで決定する)
 let idToken = "";
-let lang = "";
-
-//多言語対応のメッセージ読み込み
+// 処理中の購入の冪等キー(再送・二重タップ時は同じキーを送る)
+let purchaseKey = null;
+// 通信エラー時の再送回数の上限
+const maxPurchaseRetries = 2;
+// 前回取得した会員データを保存するキー(変更が無い場合はサーバーから再取得しない)
+const memberCacheKey = "memberCard";
+
+//多言語対応のメッセージ読み込み(画面の文言と同じファイルを共有する)
 let message = {}
-$.getJSON("message.json", (data) =>{
+langMessages.then((data) => {
   message = data;
 })
 
@@ -68,12 +69,6 @@ function initializeApp() {
     document.getElementById("liffAppContent").classList.remove("hidden");
   }
 
-  //言語設定のグローバル変数を上書き
-  lang = getParam("lang") ? getParam("lang") : localStorage.getItem('locale');
-  if(supportedLangList.indexOf(lang) < 0){
-    lang = defaultLang;
-  }
-
   //DynamoDBのデータを特定ユーザーのidTokenより取得
   idToken = liff.getIDToken();
   getUserData(idToken);
@@ -85,18 +80,24 @@ function initializeApp() {
  * @param {String} idToken
  */
 function getUserData(idToken) {
+  const cached = loadMemberData();
   const body = {
     mode: "init",
     idToken: idToken,
   };
+  // 保持している会員データのバージョンを送り、変更が無ければ304を受け取る
+  if (cached && cached.version) {
+    body.version = cached.version;
+  }
   // URLを開く
   let request = new XMLHttpRequest();
   request.open("POST", FUNCTION_URL, true);
   request.responseType = "json";
 
   request.onload = function () {
-    if (request.readyState === 4 && request.status === 200) {
-      data = this.response;
+    if (request.readyState === 4 && (request.status === 200 || (request.status === 304 && cached))) {
+      data = request.status === 200 ? this.response : cached;
+      saveMemberData(data);
       displayBarcode(data.barcodeNum);
       displayPoint(data.point);
       displayExpirationDate(data.pointExpirationDate);
@@ -108,6 +109,28 @@ function getUserData(idToken) {
   request.send(JSON.stringify(body));
 }
 
+/**
+ * 前回取得した会員データを読み込む
+ * @return {Object} 会員データ。保存されていない場合はnull
+ */
+function loadMemberData() {
+  try {
+    return JSON.parse(localStorage.getItem(memberCacheKey));
+  } catch (e) {
+    return null;
+  }
+}
+
+/**
+ * 取得した会員データを保存する
+ * @param {Object} data
+ */
+function saveMemberData(data) {
+  if (data && data.version) {
+    localStorage.setItem(memberCacheKey, JSON.stringify(data));
+  }
+}
+
 /**
  * 画面にバーコードを表示する
  * @param {String} barcodeNum
@@ -142,21 +165,47 @@ function displayExpirationDate(expirationDate) {
  * APIに接続し、DBを更新し更新後の値を取得する。
  */
 function demoAddPoint() {
+  if (!purchaseKey) {
+    purchaseKey = createIdempotencyKey();
+  }
+  sendPurchase(purchaseKey, 0);
+}
+
+/**
+ * 購入リクエストを送信する。通信エラーの場合は同じ冪等キーで再送する。
+ * @param {String} key 冪等キー
+ * @param {Number} attempt 再送回数
+ */
+function sendPurchase(key, attempt) {
   const body = {
     mode: "buy",
     idToken: idToken,
     language: lang,
-    liffId: liffId
+    liffId: liffId,
+    idempotencyKey: key
   };
 
   let request = new XMLHttpRequest();
   request.open("POST", FUNCTION_URL, true);
   request.responseType = "json";
 
+  request.onerror = function () {
+    if (attempt < maxPurchaseRetries) {
+      setTimeout(() => sendPurchase(key, attempt + 1), 1000 * (attempt + 1));
+    } else {
+      alert(message.error[lang]);
+    }
+  };
+
   request.onload = function () {
     if (request.readyState === 4 && request.status === 200) {
+      // 購入が完了したため、次の購入は新しいキーで送信する
+      if (purchaseKey === key) {
+        purchaseKey = null;
+      }
       alert(message.scanBarcode[lang]);
       data = this.response;
+      saveMemberData(data);
       displayPoint(data.point);
       displayExpirationDate(data.pointExpirationDate);
     } else if(request.status === 403) {
@@ -172,6 +221,20 @@ function demoAddPoint() {
   request.send(JSON.stringify(body));
 }
 
+/**
+ * 冪等キーを作成する
+ * @return {String} UUID形式の文字列
+ */
+function createIdempotencyKey() {
+  if (window.crypto && crypto.randomUUID) {
+    return crypto.randomUUID();
+  }
+  return "xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx".replace(/[xy]/g, (c) => {
+    const r = (Math.random() * 16) | 0;
+    return (c === "x" ? r : (r & 0x3) | 0x8).toString(16);
+  });
+}
+
 function getParam(name, url) {
   if (!url) url = window.location.href;
   name = name.replace(/[\[\]]/g, "\\$&");